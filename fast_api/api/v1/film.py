@@ -22,14 +22,34 @@
 # И указываем тип возвращаемого объекта — Film
 
 import logging
+from functools import partial
 from http import HTTPStatus
 from typing import List, Literal, Optional
 from uuid import UUID
 
+from api.v1.pagination import get_cursor
 from core.config import ErrorMessage
-from fastapi import APIRouter, Depends, HTTPException, Query
-from models.film import FilmApi, FilmBriefApi, FilmGenreApi, FilmPeopleApi
+from db.cursor import Cursor
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from models.batch import BatchRequest
+from models.film import (
+    Film,
+    FilmApi,
+    FilmBatchApi,
+    FilmBrief,
+    FilmBriefApi,
+    FilmGenreApi,
+    FilmPeopleApi,
+)
 from services.film import FilmService, get_film_service
+from utils.response import (
+    CachedBody,
+    cached_json_response,
+    dump_models,
+    json_response,
+    ndjson_response,
+    wants_ndjson,
+)
 
 # Объект router, в котором регистрируем обработчики
 router = APIRouter()
@@ -40,27 +60,47 @@ async def film_search(
     query: str = Query(None, alias="query_string"),
     page_size: int = Query(10, alias="page[size]"),
     page_number: int = Query(1, alias="page[number]"),
+    cursor: Optional[Cursor] = Depends(get_cursor),
     film_service: FilmService = Depends(get_film_service),
 ) -> List[FilmBriefApi]:
     """
     Примеры обращений, которые должны обрабатываться API
     #GET /api/v1/film/search?query=star&page[size]=50&page[number]=1
+    #GET /api/v1/film/search?query=star&page[size]=50&page[cursor]=<X-Next-Cursor>
     """
     logging.debug(
         f"Получили параметры {query=}-{type(query)},"
         f" {page_size=}-{type(page_size)}, {page_number=}-{type(page_number)}"
     )
-    films = await film_service.search(query, page_size, page_number)
-    if not films:
+    body = await film_service.get_response(
+        "film_search",
+        (query, page_size, page_number, cursor and cursor.search_after),
+        partial(_render_search, film_service, query, page_size, page_number, cursor),
+        cacheable=not (cursor and cursor.consistent),
+    )
+    if not body:
         # Если выборка пустая, отдаём 404 статус
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail=ErrorMessage.FILM_NOT_FOUND
         )
+    return cached_json_response(body, film_service.CACHE_EXPIRE_IN_SECONDS)
+
+
+async def _render_search(
+    film_service: FilmService,
+    query: Optional[str],
+    page_size: int,
+    page_number: int,
+    cursor: Optional[Cursor],
+) -> Optional[CachedBody]:
+    films = await film_service.search(query, page_size, page_number, cursor)
+    if not films:
+        return None
     # Перекладываем данные из models.Film в Film
-    return [
-        FilmBriefApi(uuid=film.id, title=film.title, imdb_rating=film.imdb_rating)
-        for film in films
-    ]
+    return CachedBody.from_body(
+        dump_models(_film_brief_api(film) for film in films),
+        films.next_cursor,
+    )
 
 
 @router.get("/{film_id}", response_model=FilmApi)
@@ -72,14 +112,29 @@ async def film_details(
     #GET /api/v1/film/bf3bd131-b844-4585-9974-6c374cff2371
     #GET /api/v1/film/ff00b2a9-9e85-44af-922f-5f3504b82c15
     """
-    film = await film_service.get_by_id(film_id)
-    if not film:
+    body = await film_service.get_response(
+        "film_details",
+        (film_id,),
+        partial(_render_details, film_service, film_id),
+        entity_id=film_id,
+    )
+    if not body:
         # Если фильм не найден, отдаём 404 статус
         # Желательно пользоваться уже определёнными HTTP-статусами, которые содержат enum
         # Такой код будет более поддерживаемым
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail=ErrorMessage.FILM_NOT_FOUND
         )
+    # Готовое тело ответа уже соответствует модели FilmApi
+    return cached_json_response(body, film_service.CACHE_EXPIRE_IN_SECONDS)
+
+
+async def _render_details(
+    film_service: FilmService, film_id: str
+) -> Optional[CachedBody]:
+    film = await film_service.get_by_id(film_id)
+    if not film:
+        return None
 
     # Перекладываем данные из models.Film в Film
     # Обратите внимание, что у модели бизнес-логики есть поле description
@@ -87,20 +142,27 @@ async def film_details(
     # Если бы использовалась общая модель для бизнес-логики и формирования ответов API
     # вы бы предоставляли клиентам данные, которые им не нужны
     # и, возможно, данные, которые опасно возвращать
+    return CachedBody.from_body(dump_models(_film_api(film)))
+
+
+def _film_brief_api(film: FilmBrief) -> FilmBriefApi:
+    return FilmBriefApi.trusted(uuid=film.id, title=film.title, imdb_rating=film.imdb_rating)
+
+
+def _film_api(film: Film) -> FilmApi:
     genre_list = [
-        FilmGenreApi(uuid=genre["id"], name=genre["name"])
+        FilmGenreApi.trusted(uuid=genre["id"], name=genre["name"])
         for genre in film.genres or []
     ]
     actors_list = [
-        FilmPeopleApi(uuid=actor["id"], full_name=actor["name"])
+        FilmPeopleApi.trusted(uuid=actor["id"], full_name=actor["name"])
         for actor in film.actors or []
     ]
     writers_list = [
-        FilmPeopleApi(uuid=writer["id"], full_name=writer["name"])
+        FilmPeopleApi.trusted(uuid=writer["id"], full_name=writer["name"])
         for writer in film.writers or []
     ]
-
-    return FilmApi(
+    return FilmApi.trusted(
         uuid=film.uuid,
         title=film.title,
         imdb_rating=film.imdb_rating,
@@ -112,35 +174,94 @@ async def film_details(
     )
 
 
+@router.post("/batch", response_model=FilmBatchApi)
+async def film_batch(
+    request: BatchRequest, film_service: FilmService = Depends(get_film_service)
+) -> FilmBatchApi:
+    """
+    Пример обращений, которые должны обрабатываться API
+    #POST /api/v1/film/batch {"ids": ["bf3bd131-b844-4585-9974-6c374cff2371"]}
+    Фильмы возвращаются в порядке запроса, ненайденные перечисляются в missing
+    """
+    films = await film_service.get_many([str(film_id) for film_id in request.ids])
+    return json_response(
+        dump_models(
+            FilmBatchApi.trusted(
+                items=[_film_api(film) for film in films if film],
+                missing=[
+                    film_id for film_id, film in zip(request.ids, films) if not film
+                ],
+            )
+        )
+    )
+
+
 @router.get("/")
 async def film_list(
     sort: Literal["-imdb_rating", "+imdb_rating"] = "-imdb_rating",
     filter_genre: Optional[UUID] = Query(None, alias="filter[genre]"),
     page_size: int = Query(10, alias="page[size]"),
     page_number: int = Query(1, alias="page[number]"),
+    cursor: Optional[Cursor] = Depends(get_cursor),
+    accept: Optional[str] = Header(None),
     film_service: FilmService = Depends(get_film_service),
 ) -> List[FilmBriefApi]:
     """
     Примеры обращений, которые должны обрабатываться API
     #GET /api/v1/film?sort=-imdb_rating&page[size]=50&page[number]=1
+    #GET /api/v1/film?sort=-imdb_rating&page[size]=50&page[consistent]=true
     #GET /api/v1/film?filter[genre]=fb58fd7f-7afd-447f-b833-e51e45e2a778&sort=-imdb_rating&page[size]=50&page[number]=1
+    #GET /api/v1/film?sort=-imdb_rating&page[size]=10000 (Accept: application/x-ndjson)
     """
     logging.debug(
         f"Получили параметры {sort=}-{type(sort)}, {filter_genre=}-{type(filter_genre)},"
         f" {page_size=}-{type(page_size)}, {page_number=}-{type(page_number)}"
     )
+    if wants_ndjson(accept):
+        # Выгрузка отдается потоком без кэша, не собирая список в памяти
+        response = await ndjson_response(
+            film_service.stream_list(filter_genre, sort, page_size, page_number, cursor=cursor), _film_brief_api
+        )
+        if not response:
+            raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=ErrorMessage.FILM_NOT_FOUND)
+        return response
     # Получаем список фильмов
     # Доработать сортировку ort=-imdb_rating
-    films = await film_service.get_list(filter_genre, sort, page_size, page_number)
-    if not films:
+    body = await film_service.get_response(
+        "film_list",
+        (filter_genre, sort, page_size, page_number, cursor and cursor.search_after),
+        partial(
+            _render_list,
+            film_service, filter_genre, sort, page_size, page_number, cursor
+        ),
+        depends_on=f"genre:{filter_genre}" if filter_genre else None,
+        cacheable=not (cursor and cursor.consistent),
+    )
+    if not body:
         # Если выборка пустая, отдаём 404 статус
         # Желательно пользоваться уже определёнными HTTP-статусами, которые содержат enum
         # Такой код будет более поддерживаемым
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail=ErrorMessage.FILM_NOT_FOUND
         )
+    return cached_json_response(body, film_service.CACHE_EXPIRE_IN_SECONDS)
+
+
+async def _render_list(
+    film_service: FilmService,
+    filter_genre: Optional[UUID],
+    sort: str,
+    page_size: int,
+    page_number: int,
+    cursor: Optional[Cursor],
+) -> Optional[CachedBody]:
+    films = await film_service.get_list(
+        filter_genre, sort, page_size, page_number, cursor=cursor
+    )
+    if not films:
+        return None
     # Перекладываем данные из models.Film в Film
-    return [
-        FilmBriefApi(uuid=film.id, title=film.title, imdb_rating=film.imdb_rating)
-        for film in films
-    ]
+    return CachedBody.from_body(
+        dump_models(_film_brief_api(film) for film in films),
+        films.next_cursor,
+    )
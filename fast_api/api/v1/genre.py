@@ -1,12 +1,18 @@
 import logging
+from functools import partial
 from http import HTTPStatus
 from typing import List, Literal, Optional
 from uuid import UUID
 
+from api.v1.pagination import get_cursor
 from core.config import ErrorMessage
-from fastapi import APIRouter, Depends, HTTPException, Query
-from models.genre import Genre_API, GenreBrief_API
+from db.cursor import Cursor
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from models.batch import BatchRequest
+from models.genre import Genre, Genre_API, GenreBatch_API, GenreBrief, GenreBrief_API
 from services.genre import GenreService, get_genre_service
+from utils.response import (CachedBody, cached_json_response, dump_models, json_response, ndjson_response,
+                            wants_ndjson)
 
 router = APIRouter()
 
@@ -20,10 +26,23 @@ async def genre_details(
     Пример обращений, которые должны обрабатываться API
     #GET /api/v1/genre/fb58fd7f-7afd-447f-b833-e51e45e2a778
     """
+    body = await genre_service.get_response(
+        'genre_details', (genre_id,), partial(_render_details, genre_service, genre_id), entity_id=genre_id
+    )
+    if not body:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=ErrorMessage.GENRE_NOT_FOUND)
+    return cached_json_response(body, genre_service.CACHE_EXPIRE_IN_SECONDS)
+
+
+async def _render_details(genre_service: GenreService, genre_id: str) -> Optional[CachedBody]:
     genre = await genre_service.get_by_id(genre_id)
     if not genre:
-        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=ErrorMessage.GENRE_NOT_FOUND)
-    return Genre_API(
+        return None
+    return CachedBody.from_body(dump_models(_genre_api(genre)))
+
+
+def _genre_api(genre: Genre) -> Genre_API:
+    return Genre_API.trusted(
         uuid=genre.uuid,
         name=genre.name,
         description=genre.description,
@@ -31,25 +50,76 @@ async def genre_details(
     )
 
 
+@router.post('/batch', response_model=GenreBatch_API)
+async def genre_batch(
+        request: BatchRequest,
+        genre_service: GenreService = Depends(get_genre_service)
+) -> GenreBatch_API:
+    """
+    Пример обращений, которые должны обрабатываться API
+    #POST /api/v1/genre/batch {"ids": ["fb58fd7f-7afd-447f-b833-e51e45e2a778"]}
+    """
+    genres = await genre_service.get_many([str(genre_id) for genre_id in request.ids])
+    return json_response(dump_models(GenreBatch_API.trusted(
+        items=[_genre_api(genre) for genre in genres if genre],
+        missing=[genre_id for genre_id, genre in zip(request.ids, genres) if not genre]
+    )))
+
+
 @router.get('/')
 async def genre_list(
         sort: Literal["name.raw"] = "name.raw",
         filter_film: Optional[UUID] = Query(None, alias="filter[film]"),
         page_size: int = Query(10, alias="page[size]"),
         page_number: int = Query(1, alias="page[number]"),
+        cursor: Optional[Cursor] = Depends(get_cursor),
+        accept: Optional[str] = Header(None),
         genre_service: GenreService = Depends(get_genre_service)
 ) -> List[GenreBrief_API]:
     """
     Примеры обращений, которые должны обрабатываться API
     #GET /api/v1/genre?sort=name&page[size]=50&page[number]=1
+    #GET /api/v1/genre?sort=name.raw&page[size]=50&page[cursor]=<X-Next-Cursor>
     #GET /api/v1/genre?filter[film]=ff00b2a9-9e85-44af-922f-5f3504b82c15&sort=name.raw&page[size]=50&page[number]=1
+    #GET /api/v1/genre?page[size]=1000 (Accept: application/x-ndjson)
     """
     logging.debug(f"Получили параметры {sort=}-{type(sort)}, {filter_film=}-{type(filter_film)},"
                   f" {page_size=}-{type(page_size)}, {page_number=}-{type(page_number)}")
-    genres = await genre_service.get_list(filter_film, sort, page_size, page_number)
-    if not genres:
+    if wants_ndjson(accept):
+        response = await ndjson_response(
+            genre_service.stream_list(filter_film, sort, page_size, page_number, cursor), _genre_brief_api
+        )
+        if not response:
+            raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=ErrorMessage.GENRE_NOT_FOUND)
+        return response
+    body = await genre_service.get_response(
+        'genre_list',
+        (filter_film, sort, page_size, page_number, cursor and cursor.search_after),
+        partial(_render_list, genre_service, filter_film, sort, page_size, page_number, cursor),
+        depends_on=f"film:{filter_film}" if filter_film else None,
+        cacheable=not (cursor and cursor.consistent)
+    )
+    if not body:
         # Если выборка пустая, отдаём 404 статус
         # Желательно пользоваться уже определёнными HTTP-статусами, которые содержат enum
         # Такой код будет более поддерживаемым
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=ErrorMessage.GENRE_NOT_FOUND)
-    return [GenreBrief_API(uuid=genre.id, name=genre.name, description=genre.description) for genre in genres]
+    return cached_json_response(body, genre_service.CACHE_EXPIRE_IN_SECONDS)
+
+
+async def _render_list(
+        genre_service: GenreService,
+        filter_film: Optional[UUID],
+        sort: str,
+        page_size: int,
+        page_number: int,
+        cursor: Optional[Cursor]
+) -> Optional[CachedBody]:
+    genres = await genre_service.get_list(filter_film, sort, page_size, page_number, cursor)
+    if not genres:
+        return None
+    return CachedBody.from_body(dump_models(_genre_brief_api(genre) for genre in genres), genres.next_cursor)
+
+
+def _genre_brief_api(genre: GenreBrief) -> GenreBrief_API:
+    return GenreBrief_API.trusted(uuid=genre.id, name=genre.name, description=genre.description)
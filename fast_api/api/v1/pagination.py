@@ -0,0 +1,24 @@
+from http import HTTPStatus
+from typing import Optional
+
+from core.config import ErrorMessage
+from db.cursor import Cursor
+from fastapi import HTTPException, Query
+
+
+async def get_cursor(
+        page_cursor: Optional[str] = Query(None, alias="page[cursor]"),
+        consistent: bool = Query(False, alias="page[consistent]"),
+) -> Optional[Cursor]:
+    """
+    Курсор страницы из параметров запроса. Курсор следующей страницы
+    возвращается в заголовке X-Next-Cursor, с ним page[number] не учитывается.
+    page[consistent] начинает обход по point-in-time, который не сдвигается
+    при записи новых данных, дальше признак передается в самом курсоре
+    """
+    if page_cursor:
+        try:
+            return Cursor.decode(page_cursor)
+        except ValueError:
+            raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=ErrorMessage.INVALID_CURSOR)
+    return Cursor(consistent=True) if consistent else None
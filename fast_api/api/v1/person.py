@@ -1,12 +1,18 @@
 import logging
+from functools import partial
 from http import HTTPStatus
 from typing import List, Literal, Optional
 from uuid import UUID
 
+from api.v1.pagination import get_cursor
 from core.config import ErrorMessage
-from fastapi import APIRouter, Depends, HTTPException, Query
-from models.person import PersonAPI, PersonBriefAPI
+from db.cursor import Cursor
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from models.batch import BatchRequest
+from models.person import Person, PersonAPI, PersonBatchAPI, PersonBrief, PersonBriefAPI
 from services.person import PersonService, get_person_service
+from utils.response import (CachedBody, cached_json_response, dump_models, json_response, ndjson_response,
+                            wants_ndjson)
 
 router = APIRouter()
 
@@ -20,10 +26,23 @@ async def person_details(
     Примеры обращений, которые должны обрабатываться API
     #GET /api/v1/person/a5a8f573-3cee-4ccc-8a2b-91cb9f55250a
     """
+    body = await person_service.get_response(
+        'person_details', (person_id,), partial(_render_details, person_service, person_id), entity_id=person_id
+    )
+    if not body:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=ErrorMessage.PERSON_NOT_FOUND)
+    return cached_json_response(body, person_service.CACHE_EXPIRE_IN_SECONDS)
+
+
+async def _render_details(person_service: PersonService, person_id: str) -> Optional[CachedBody]:
     person = await person_service.get_by_id(person_id)
     if not person:
-        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=ErrorMessage.PERSON_NOT_FOUND)
-    return PersonAPI(
+        return None
+    return CachedBody.from_body(dump_models(_person_api(person)))
+
+
+def _person_api(person: Person) -> PersonAPI:
+    return PersonAPI.trusted(
         uuid=person.uuid,
         full_name=person.full_name,
         birth_date=person.birthdate,
@@ -31,6 +50,22 @@ async def person_details(
     )
 
 
+@router.post('/batch', response_model=PersonBatchAPI)
+async def person_batch(
+        request: BatchRequest,
+        person_service: PersonService = Depends(get_person_service)
+) -> PersonBatchAPI:
+    """
+    Пример обращений, которые должны обрабатываться API
+    #POST /api/v1/person/batch {"ids": ["a5a8f573-3cee-4ccc-8a2b-91cb9f55250a"]}
+    """
+    persons = await person_service.get_many([str(person_id) for person_id in request.ids])
+    return json_response(dump_models(PersonBatchAPI.trusted(
+        items=[_person_api(person) for person in persons if person],
+        missing=[person_id for person_id, person in zip(request.ids, persons) if not person]
+    )))
+
+
 @router.get('/')
 async def person_list(
         sort: Literal["full_name.raw"] = "full_name.raw",
@@ -38,19 +73,59 @@ async def person_list(
         filter_name: Optional[str] = Query(None, alias="search[name]"),
         page_size: int = Query(10, alias="page[size]"),
         page_number: int = Query(1, alias="page[number]"),
+        cursor: Optional[Cursor] = Depends(get_cursor),
+        accept: Optional[str] = Header(None),
         person_service: PersonService = Depends(get_person_service)
 ) -> List[PersonBriefAPI]:
     """
     Примеры обращений, которые должны обрабатываться API
     #GET /api/v1/person?sort=full_name.raw&page[size]=50&page[number]=1
+    #GET /api/v1/person?sort=full_name.raw&page[size]=50&page[cursor]=<X-Next-Cursor>
     #GET /api/v1/person?filter[film]=ff00b2a9-9e85-44af-922f-5f3504b82c15&sort=name&page[size]=50&page[number]=1
+    #GET /api/v1/person?page[size]=10000 (Accept: application/x-ndjson)
     """
     logging.debug(f"Получили параметры {sort=}-{type(sort)}, {filter_film=}-{type(filter_film)},"
                   f" {page_size=}-{type(page_size)}, {page_number=}-{type(page_number)}")
-    persons = await person_service.get_list(filter_film, filter_name, sort, page_size, page_number)
-    if not persons:
+    if wants_ndjson(accept):
+        response = await ndjson_response(
+            person_service.stream_list(filter_film, filter_name, sort, page_size, page_number, cursor),
+            _person_brief_api,
+        )
+        if not response:
+            raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail='persons not found')
+        return response
+    body = await person_service.get_response(
+        'person_list',
+        (filter_film, filter_name, sort, page_size, page_number, cursor and cursor.search_after),
+        partial(_render_list, person_service, filter_film, filter_name, sort, page_size, page_number, cursor),
+        depends_on=f"film:{filter_film}" if filter_film else None,
+        cacheable=not (cursor and cursor.consistent)
+    )
+    if not body:
         # Если выборка пустая, отдаём 404 статус
         # Желательно пользоваться уже определёнными HTTP-статусами, которые содержат enum
         # Такой код будет более поддерживаемым
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail='persons not found')
-    return [PersonBriefAPI(uuid=p.id, full_name=p.full_name, birth_date=p.birth_date) for p in persons]
+    return cached_json_response(body, person_service.CACHE_EXPIRE_IN_SECONDS)
+
+
+async def _render_list(
+        person_service: PersonService,
+        filter_film: Optional[UUID],
+        filter_name: Optional[str],
+        sort: str,
+        page_size: int,
+        page_number: int,
+        cursor: Optional[Cursor]
+) -> Optional[CachedBody]:
+    persons = await person_service.get_list(filter_film, filter_name, sort, page_size, page_number, cursor)
+    if not persons:
+        return None
+    return CachedBody.from_body(
+        dump_models(_person_brief_api(person) for person in persons),
+        persons.next_cursor
+    )
+
+
+def _person_brief_api(person: PersonBrief) -> PersonBriefAPI:
+    return PersonBriefAPI.trusted(uuid=person.id, full_name=person.full_name, birth_date=person.birth_date)
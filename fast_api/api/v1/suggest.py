@@ -0,0 +1,22 @@
+import orjson
+from core import config
+from fastapi import APIRouter, Depends, Query
+from models.suggest import SuggestApi
+from services.suggest import SuggestService, get_suggest_service
+from utils.response import json_response
+
+router = APIRouter()
+
+
+@router.get('', response_model=SuggestApi)
+async def suggest(
+        prefix: str = Query(..., min_length=1),
+        limit: int = Query(5, ge=1, le=config.SUGGEST_MAX_LIMIT),
+        suggest_service: SuggestService = Depends(get_suggest_service)
+) -> SuggestApi:
+    """
+    Подсказки для строки поиска по началу слов названий фильмов и имен людей.
+    Отвечает из памяти процесса, без обращений к ElasticSearch и Redis
+    #GET /api/v1/suggest?prefix=star
+    """
+    return json_response(orjson.dumps(suggest_service.suggest(prefix, limit)))
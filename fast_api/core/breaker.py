@@ -0,0 +1,95 @@
+"""
+Предохранители (circuit breaker) для обращений к ElasticSearch и Redis.
+
+После нескольких сбоев подряд предохранитель размыкается, и обращения
+к сервису сразу завершаются ошибкой CircuitOpenError, не дожидаясь
+таймаута клиента. Через reset_timeout пропускается одно пробное обращение:
+если оно удалось, предохранитель замыкается, иначе снова размыкается
+"""
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+from core.deadline import DeadlineExceeded
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Все предохранители процесса по имени сервиса, их состояние отдается по адресу /health
+breakers: Dict[str, 'CircuitBreaker'] = {}
+
+
+class CircuitOpenError(Exception):
+    """Предохранитель разомкнут, запрос к сервису не отправлялся"""
+
+
+class CircuitBreaker:
+    """
+    Предохранитель одного сервиса. is_failure отличает сбой сервиса
+    от ошибки в самом запросе: например, 404 от ElasticSearch сбоем не считается
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float,
+                 is_failure: Callable[[BaseException], bool]):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.is_failure = is_failure
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial = False
+        breakers[name] = self
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    @contextmanager
+    def guard(self):
+        """Выполнить обращение к сервису, если предохранитель его пропускает"""
+        state = self.state
+        if state == OPEN or (state == HALF_OPEN and self.trial):
+            raise CircuitOpenError(f'{self.name} is unavailable')
+        trial = state == HALF_OPEN
+        self.trial = self.trial or trial
+        try:
+            yield
+        except DeadlineExceeded:
+            # Сервис не успел ответить к сроку запроса, о его состоянии это ничего не говорит
+            raise
+        except Exception as e:
+            if self.is_failure(e):
+                self._failure()
+            else:
+                self._success()
+            raise
+        else:
+            self._success()
+        finally:
+            if trial:
+                self.trial = False
+
+    def as_dict(self) -> dict:
+        return {'state': self.state, 'failures': self.failures}
+
+    def _failure(self):
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning('%s недоступен после %d сбоев подряд, предохранитель разомкнут',
+                               self.name, self.failures)
+            self.opened_at = time.monotonic()
+
+    def _success(self):
+        if self.opened_at is not None:
+            logger.info('%s снова доступен, предохранитель замкнут', self.name)
+        self.failures = 0
+        self.opened_at = None
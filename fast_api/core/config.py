@@ -1,3 +1,4 @@
+import json
 import os
 from logging import config as logging_config
 
@@ -9,15 +10,120 @@ logging_config.dictConfig(LOGGING)
 # Название проекта. Используется в Swagger-документации
 PROJECT_NAME = os.getenv('PROJECT_NAME', 'movies')
 
+# Число процессов API, 0 - по числу ядер. Каждый процесс открывает свои пулы соединений
+API_WORKERS = int(os.getenv('API_WORKERS', 1))
+# Каталог, в котором процессы API складывают метрики Prometheus, чтобы /metrics отдавал их сумму.
+# Нужен, если процессов больше одного
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+
 # Настройки Redis
 REDIS_HOST = os.getenv('REDIS_HOST', '127.0.0.1')
 REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
 REDIS_AUTH = os.getenv('REDIS_AUTH', "password")
+# Размер пула соединений с Redis одного процесса API
+REDIS_POOL_MINSIZE = int(os.getenv('REDIS_POOL_MINSIZE', 10))
+REDIS_POOL_MAXSIZE = int(os.getenv('REDIS_POOL_MAXSIZE', 20))
+
+# Значения кэша не короче этого размера в байтах сжимаются, 0 - отключает сжатие
+CACHE_COMPRESS_MIN_SIZE = int(os.getenv('CACHE_COMPRESS_MIN_SIZE', 2048))
+CACHE_COMPRESS_LEVEL = int(os.getenv('CACHE_COMPRESS_LEVEL', 6))
+
+# Настройки локального кэша процесса (первый уровень перед Redis)
+LOCAL_CACHE_MAXSIZE = int(os.getenv('LOCAL_CACHE_MAXSIZE', 10000))
+LOCAL_CACHE_TTL = float(os.getenv('LOCAL_CACHE_TTL', 60))
+# Канал Redis, через который экземпляры API сообщают друг другу об измененных ключах
+CACHE_INVALIDATION_CHANNEL = os.getenv('CACHE_INVALIDATION_CHANNEL', 'cache:invalidate')
+# Сколько экземпляр API может не перечитывать поколение ключей списков, если пропустил уведомление
+GENERATION_LOCAL_TTL = float(os.getenv('GENERATION_LOCAL_TTL', 5))
+# Кэшировать готовые тела ответов API, а не только данные из ElasticSearch
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+# Канал, в который ETL публикует идентификаторы записанных в ElasticSearch документов
+ETL_CHANNEL = os.getenv('ETL_CHANNEL', 'cache:etl')
+# Пауза перед повторной подпиской на каналы после разрыва соединения с Redis, удваивается до наибольшей
+RESUBSCRIBE_MIN_DELAY_IN_SECONDS = float(os.getenv('RESUBSCRIBE_MIN_DELAY_IN_SECONDS', 0.5))
+RESUBSCRIBE_MAX_DELAY_IN_SECONDS = float(os.getenv('RESUBSCRIBE_MAX_DELAY_IN_SECONDS', 30))
+# Время мягкого истечения ключей кэша. При работающем ETL ключи сбрасываются
+# по его уведомлениям, поэтому его можно увеличить до часов
+CACHE_EXPIRE_IN_SECONDS = int(os.getenv('CACHE_EXPIRE_IN_SECONDS', 60 * 5))
+# Время жизни закэшированных пустых результатов поиска и списков
+NEGATIVE_CACHE_EXPIRE_IN_SECONDS = int(os.getenv('NEGATIVE_CACHE_EXPIRE_IN_SECONDS', 30))
+# Теневые копии значений кэша живут дольше самих значений и не сбрасываются при изменении данных.
+# Они отдаются, только если ElasticSearch недоступен
+SHADOW_CACHE_EXPIRE_IN_SECONDS = int(os.getenv('SHADOW_CACHE_EXPIRE_IN_SECONDS', 60 * 60 * 24))
+# Страниц списков и результатов поиска много, а после переиндексации их ключи меняются,
+# поэтому их теневые копии живут недолго. Готовые ответы теневых копий не имеют
+SHADOW_LIST_CACHE_EXPIRE_IN_SECONDS = int(os.getenv('SHADOW_LIST_CACHE_EXPIRE_IN_SECONDS', 60 * 60 * 2))
+# Предохранители ElasticSearch и Redis: после стольких сбоев подряд обращения
+# сразу завершаются ошибкой, пока не пройдет время до пробного обращения
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT_IN_SECONDS = float(os.getenv('BREAKER_RESET_TIMEOUT_IN_SECONDS', 10))
+# Наибольшее время одного обращения к ElasticSearch и к Redis. Оно меньше срока запроса:
+# не ответивший к этому времени сервис считается сбоем предохранителя, а у запроса
+# остается время на ответ из теневой копии
+ELASTIC_CALL_TIMEOUT_IN_SECONDS = float(os.getenv('ELASTIC_CALL_TIMEOUT_IN_SECONDS', 2))
+REDIS_CALL_TIMEOUT_IN_SECONDS = float(os.getenv('REDIS_CALL_TIMEOUT_IN_SECONDS', 0.5))
+# Наибольшее число идентификаторов в одном пакетном запросе
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', 100))
 
+# Прогрев кэша при запуске: первые страницы списка фильмов по рейтингу,
+# все жанры и самые запрашиваемые фильмы и люди
+WARMUP_ENABLED = os.getenv('WARMUP_ENABLED', 'true').lower() == 'true'
+WARMUP_FILM_PAGES = int(os.getenv('WARMUP_FILM_PAGES', 5))
+WARMUP_PAGE_SIZE = int(os.getenv('WARMUP_PAGE_SIZE', 10))
+WARMUP_POPULAR_COUNT = int(os.getenv('WARMUP_POPULAR_COUNT', 100))
+# Прогрев прерывается по истечении этого времени и выполняет не больше стольких запросов одновременно
+WARMUP_TIMEOUT_IN_SECONDS = float(os.getenv('WARMUP_TIMEOUT_IN_SECONDS', 30))
+WARMUP_CONCURRENCY = int(os.getenv('WARMUP_CONCURRENCY', 8))
+# Как часто счетчики обращений к сущностям переносятся в общий рейтинг и сколько сущностей в нем хранится
+POPULARITY_FLUSH_INTERVAL = float(os.getenv('POPULARITY_FLUSH_INTERVAL', 10))
+POPULARITY_MAX_SIZE = int(os.getenv('POPULARITY_MAX_SIZE', 1000))
+
+# Запрос с этим заголовком получает в ответе разбивку времени обработки в заголовке Server-Timing
+SERVER_TIMING_HEADER = os.getenv('SERVER_TIMING_HEADER', 'X-Debug-Timing')
+# Крайний срок обработки запроса по умолчанию и для отдельных обработчиков
+# (JSON вида {"/api/v1/film/batch": 10} по шаблону пути). Клиент может сократить срок заголовком, в секундах
+REQUEST_TIMEOUT_IN_SECONDS = float(os.getenv('REQUEST_TIMEOUT_IN_SECONDS', 5))
+REQUEST_TIMEOUTS_IN_SECONDS = {
+    '/api/v1/film/batch': 10.0,
+    '/api/v1/genre/batch': 10.0,
+    '/api/v1/person/batch': 10.0,
+    **json.loads(os.getenv('REQUEST_TIMEOUTS_IN_SECONDS', '{}')),
+}
+REQUEST_TIMEOUT_HEADER = os.getenv('REQUEST_TIMEOUT_HEADER', 'X-Request-Timeout')
+# Запросы дольше порога пишутся в журнал с разбивкой по этапам, но только указанная доля из них
+SLOW_REQUEST_THRESHOLD_IN_SECONDS = float(os.getenv('SLOW_REQUEST_THRESHOLD_IN_SECONDS', 0.5))
+SLOW_REQUEST_LOG_SAMPLE_RATE = float(os.getenv('SLOW_REQUEST_LOG_SAMPLE_RATE', 0.1))
+
+# Подсказки при вводе запроса: индекс названий фильмов и имен в памяти процесса.
+# Индексируются первые SUGGEST_MAX_WORDS слов, при запуске индекс читается страницами по SUGGEST_BUILD_PAGE_SIZE
+SUGGEST_ENABLED = os.getenv('SUGGEST_ENABLED', 'true').lower() == 'true'
+SUGGEST_MAX_WORDS = int(os.getenv('SUGGEST_MAX_WORDS', 8))
+SUGGEST_BUILD_PAGE_SIZE = int(os.getenv('SUGGEST_BUILD_PAGE_SIZE', 1000))
+SUGGEST_MAX_LIMIT = int(os.getenv('SUGGEST_MAX_LIMIT', 20))
+# Процессы API, запущенные вместе, строят индекс подсказок по снимку в Redis, который оставляет
+# первый из них. Остальные ждут снимок не дольше SUGGEST_BUILD_WAIT_IN_SECONDS и потом читают
+# ElasticSearch сами. Снимок хранится SUGGEST_SNAPSHOT_EXPIRE_IN_SECONDS
+SUGGEST_BUILD_WAIT_IN_SECONDS = float(os.getenv('SUGGEST_BUILD_WAIT_IN_SECONDS', 60))
+SUGGEST_SNAPSHOT_EXPIRE_IN_SECONDS = int(os.getenv('SUGGEST_SNAPSHOT_EXPIRE_IN_SECONDS', 60))
 
 # Настройки Elasticsearch
 ELASTIC_HOST = os.getenv('ELASTIC_HOST', '127.0.0.1')
 ELASTIC_PORT = int(os.getenv('ELASTIC_PORT', 9200))
+# Сколько ElasticSearch хранит point-in-time согласованного обхода между запросами страниц
+ELASTIC_PIT_KEEP_ALIVE = os.getenv('ELASTIC_PIT_KEEP_ALIVE', '1m')
+# Читать краткие списки фильмов из doc values, не загружая _source документов.
+# По tests/benchmark/es_response.py ответ с doc values больше и разбирается дольше,
+# чем _source с filter_path, поэтому включать стоит только по замеру на своем ElasticSearch
+ELASTIC_LIST_DOCVALUES = os.getenv('ELASTIC_LIST_DOCVALUES', 'false').lower() == 'true'
+# По сколько документов читаются из ElasticSearch списки, которые отдаются потоком NDJSON
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 500))
+
+# Индексы ElasticSearch и соответствующие им пространства имен кэша
+INDEX_NAMESPACES = {
+    'movies': 'film',
+    'persons': 'person',
+    'genres': 'genre',
+}
 
 # Корень проекта
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -28,3 +134,5 @@ class ErrorMessage:
     FILM_NOT_FOUND = 'Film(s) not found'
     GENRE_NOT_FOUND = 'Genre(s) not found'
     PERSON_NOT_FOUND = 'Person(s) not found'
+    INVALID_CURSOR = 'Invalid page cursor'
+    DEADLINE_EXCEEDED = 'Request deadline exceeded'
@@ -0,0 +1,149 @@
+"""
+Крайний срок обработки запроса.
+
+Срок задается временем по умолчанию для обработчика и может быть сокращен
+клиентом в заголовке. Обращения к Redis и ElasticSearch получают только
+оставшееся время, а если к сроку ответ не начат, обработка запроса отменяется
+и клиент получает 504. Так брошенные клиентами запросы не занимают
+соединения пулов
+"""
+import asyncio
+import contextvars
+import logging
+from typing import Awaitable, Optional, TypeVar
+
+import orjson
+from core import config, metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Срок обработки запроса истек. Это не сбой сервиса, к которому обращались"""
+
+
+def remaining() -> Optional[float]:
+    """Сколько секунд осталось до крайнего срока, None - срок не задан"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - asyncio.get_event_loop().time()
+
+
+async def bounded(awaitable: Awaitable[T], limit: Optional[float] = None) -> T:
+    """
+    Дождаться обращения к сервису, но не дольше оставшегося до крайнего срока времени
+    и не дольше limit секунд. Если сервис не ответил за limit, это его сбой:
+    вызывающий получает asyncio.TimeoutError, а не DeadlineExceeded
+    """
+    timeout = remaining()
+    if timeout is None or (limit is not None and limit < timeout):
+        if limit is None:
+            return await awaitable
+        return await asyncio.wait_for(awaitable, limit)
+    if timeout <= 0:
+        # Обращение уже не нужно: закрываем корутину, не запуская ее
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        elif asyncio.isfuture(awaitable):
+            awaitable.cancel()
+        raise DeadlineExceeded()
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded() from None
+
+
+def renew(timeout: float):
+    """Назначить новый срок через timeout секунд, например для следующей части потокового ответа"""
+    _deadline.set(asyncio.get_event_loop().time() + timeout)
+
+
+def detached(awaitable: Awaitable[T], timeout: float) -> asyncio.Future:
+    """
+    Запустить фоновую задачу со своим сроком вместо срока запроса,
+    который ее запустил: запрос может завершиться раньше задачи
+    """
+    context = contextvars.copy_context()
+    context.run(_deadline.set, asyncio.get_event_loop().time() + timeout)
+    return context.run(asyncio.ensure_future, awaitable)
+
+
+class DeadlineMiddleware:
+    """
+    Задает крайний срок запроса: время по умолчанию для обработчика
+    (REQUEST_TIMEOUTS_IN_SECONDS по шаблону пути или REQUEST_TIMEOUT_IN_SECONDS),
+    сокращенное заголовком клиента. Срок ограничивает подготовку ответа:
+    если к сроку ответ не начат, обработка отменяется и клиент получает 504.
+    Начатый ответ не прерывается, потоковые ответы продлевают срок
+    на каждую свою часть (renew)
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.header = config.REQUEST_TIMEOUT_HEADER.lower().encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        timeout = self.timeout(scope)
+        token = _deadline.set(asyncio.get_event_loop().time() + timeout)
+        started = asyncio.Event()
+
+        async def send_tracking(message):
+            if message['type'] == 'http.response.start':
+                started.set()
+            await send(message)
+
+        # Обработка идет в своей задаче, которая получает срок из текущего контекста
+        task = asyncio.ensure_future(self.app(scope, receive, send_tracking))
+        waiter = asyncio.ensure_future(started.wait())
+        try:
+            await asyncio.wait({task, waiter}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not started.is_set() and not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await self.expired(send)
+                return
+            try:
+                await task
+            except DeadlineExceeded:
+                if started.is_set():
+                    logger.warning('Срок запроса %s истек после начала ответа', scope['path'])
+                    return
+                await self.expired(send)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            waiter.cancel()
+            _deadline.reset(token)
+
+    @staticmethod
+    async def expired(send):
+        await send({
+            'type': 'http.response.start',
+            'status': 504,
+            'headers': [(b'content-type', b'application/json')],
+        })
+        await send({
+            'type': 'http.response.body',
+            'body': orjson.dumps({'detail': config.ErrorMessage.DEADLINE_EXCEEDED}),
+        })
+
+    def timeout(self, scope) -> float:
+        timeout = config.REQUEST_TIMEOUTS_IN_SECONDS.get(metrics.route_path(scope), config.REQUEST_TIMEOUT_IN_SECONDS)
+        value = next((value for name, value in scope['headers'] if name == self.header), None)
+        if value is None:
+            return timeout
+        try:
+            requested = float(value)
+        except ValueError:
+            return timeout
+        # Клиент может только сократить срок
+        return min(timeout, requested) if requested > 0 else timeout
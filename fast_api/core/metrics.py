@@ -0,0 +1,220 @@
+"""
+Метрики API в формате Prometheus, отдаются по адресу /metrics
+"""
+import os
+import time
+from typing import Dict
+
+from core import config
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from starlette.routing import Match
+
+if config.PROMETHEUS_MULTIPROC_DIR:
+    # Файлы метрик создаются уже при объявлении метрик ниже
+    os.makedirs(config.PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+# Свой реестр без метрик процесса и платформы, которые собирает реестр по умолчанию
+registry = CollectorRegistry()
+
+# Последние прочитанные счетчики кэшей ElasticSearch: индекс -> кэш -> счетчики
+elastic_cache_stats: Dict[str, Dict[str, dict]] = {}
+
+# Обращения к Redis занимают доли миллисекунды, стандартные интервалы для них слишком грубые
+FAST_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0)
+
+REQUEST_LATENCY = Histogram(
+    'api_request_duration_seconds',
+    'Время обработки запроса к API',
+    ['method', 'route', 'status'],
+    registry=registry,
+)
+CACHE_REQUESTS = Counter(
+    'cache_requests_total',
+    'Обращения к кэшу сервисов: hit - свежее значение, stale - устаревшее, miss - промах, error - ошибка. '
+    'Уровень shadow - теневые копии, которые отдаются при недоступном хранилище',
+    ['namespace', 'layer', 'result'],
+    registry=registry,
+)
+ELASTIC_LATENCY = Histogram(
+    'elasticsearch_request_duration_seconds',
+    'Время запроса к ElasticSearch',
+    ['operation', 'index'],
+    registry=registry,
+)
+ELASTIC_IN_PROGRESS = Gauge(
+    'elasticsearch_requests_in_progress',
+    'Число выполняющихся запросов к ElasticSearch',
+    multiprocess_mode='livesum',
+    registry=registry,
+)
+REDIS_LATENCY = Histogram(
+    'redis_request_duration_seconds',
+    'Время запроса к Redis',
+    ['command'],
+    buckets=FAST_BUCKETS,
+    registry=registry,
+)
+
+
+class PoolCollector:
+    """
+    Заполненность пула соединений с Redis и локального кэша,
+    значения читаются в момент сбора метрик
+    """
+
+    def collect(self):
+        from db import cache
+
+        in_use = GaugeMetricFamily('redis_pool_connections_in_use', 'Занятые соединения пула Redis')
+        size = GaugeMetricFamily('redis_pool_connections_max', 'Наибольший размер пула Redis')
+        local = GaugeMetricFamily('local_cache_entries', 'Число значений в локальном кэше процесса')
+        if cache.redis is not None:
+            pool = cache.redis.connection
+            in_use.add_metric([], pool.size - pool.freesize)
+            size.add_metric([], pool.maxsize)
+        if cache.local is not None:
+            local.add_metric([], len(cache.local))
+        return [in_use, size, local]
+
+
+class CompressionCollector:
+    """Счетчики сжатия значений кэша из db.codec.stats"""
+
+    def collect(self):
+        from db import codec
+
+        stats = codec.stats
+        values = CounterMetricFamily('cache_compression_values', 'Значения кэша по результату сжатия',
+                                     labels=['result'])
+        values.add_metric(['compressed'], stats.compressed)
+        values.add_metric(['skipped'], stats.skipped)
+        values.add_metric(['decompressed'], stats.decompressed)
+        size = CounterMetricFamily('cache_compression_bytes', 'Размер сжатых значений до и после сжатия',
+                                   labels=['stage'])
+        size.add_metric(['in'], stats.bytes_in)
+        size.add_metric(['out'], stats.bytes_out)
+        seconds = CounterMetricFamily('cache_compression_seconds', 'Время сжатия и распаковки',
+                                      labels=['operation'])
+        seconds.add_metric(['compress'], stats.compress_seconds)
+        seconds.add_metric(['decompress'], stats.decompress_seconds)
+        ratio = GaugeMetricFamily('cache_compression_ratio', 'Степень сжатия значений кэша')
+        ratio.add_metric([], stats.ratio)
+        return [values, size, seconds, ratio]
+
+
+class BreakerCollector:
+    """Состояние предохранителей ElasticSearch и Redis"""
+
+    STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+    def collect(self):
+        from core import breaker
+
+        state = GaugeMetricFamily('circuit_breaker_state',
+                                  'Состояние предохранителя: 0 - замкнут, 1 - пробное обращение, 2 - разомкнут',
+                                  labels=['backend'])
+        failures = GaugeMetricFamily('circuit_breaker_failures', 'Сбоев сервиса подряд', labels=['backend'])
+        for name, item in breaker.breakers.items():
+            state.add_metric([name], self.STATES[item.state])
+            failures.add_metric([name], item.failures)
+        return [state, failures]
+
+
+class ElasticCacheCollector:
+    """
+    Попадания в кэш запросов шардов и кэш фильтров ElasticSearch.
+    Счетчики читаются из ElasticSearch перед сбором метрик и хранятся в elastic_cache_stats
+    """
+
+    def collect(self):
+        requests = CounterMetricFamily('elasticsearch_cache_requests', 'Обращения к кэшам ElasticSearch',
+                                       labels=['index', 'cache', 'result'])
+        evictions = CounterMetricFamily('elasticsearch_cache_evictions', 'Вытеснения из кэшей ElasticSearch',
+                                        labels=['index', 'cache'])
+        memory = GaugeMetricFamily('elasticsearch_cache_memory_bytes', 'Память кэшей ElasticSearch',
+                                   labels=['index', 'cache'])
+        for index, caches in elastic_cache_stats.items():
+            for name, stats in caches.items():
+                requests.add_metric([index, name, 'hit'], stats['hit_count'])
+                requests.add_metric([index, name, 'miss'], stats['miss_count'])
+                evictions.add_metric([index, name], stats['evictions'])
+                memory.add_metric([index, name], stats['memory_size_in_bytes'])
+        return [requests, evictions, memory]
+
+
+class MetricsMiddleware:
+    """
+    Измеряет время обработки запросов. Написан как ASGI-приложение,
+    а не BaseHTTPMiddleware, чтобы не пропускать тело ответа через лишнюю очередь
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUEST_LATENCY.labels(scope['method'], route_path(scope), status).observe(time.perf_counter() - started)
+
+
+def route_path(scope) -> str:
+    """
+    Шаблон пути обработчика вместо самого пути,
+    чтобы идентификаторы в адресе не порождали новых рядов метрик
+    """
+    for route in scope['app'].routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return 'unmatched'
+
+
+def exposed_registry() -> CollectorRegistry:
+    """
+    Реестр, который отдается по адресу /metrics. Если процессов API несколько,
+    счетчики и гистограммы складываются по файлам всех процессов в PROMETHEUS_MULTIPROC_DIR,
+    а состояние пулов, кэшей и предохранителей отдает процесс, ответивший на запрос
+    """
+    if not config.PROMETHEUS_MULTIPROC_DIR:
+        return registry
+    exposed = CollectorRegistry()
+    multiprocess.MultiProcessCollector(exposed, config.PROMETHEUS_MULTIPROC_DIR)
+    for collector in PROCESS_COLLECTORS:
+        exposed.register(collector)
+    return exposed
+
+
+def clear_multiprocess_dir():
+    """
+    Удалить файлы метрик прошлого запуска, иначе счетчики продолжатся с их значений.
+    Вызывается до запуска процессов API
+    """
+    for name in os.listdir(config.PROMETHEUS_MULTIPROC_DIR):
+        if name.endswith('.db'):
+            os.remove(os.path.join(config.PROMETHEUS_MULTIPROC_DIR, name))
+
+
+def process_stopped():
+    """Убрать из суммы показатели завершившегося процесса API, например число выполняющихся запросов"""
+    if config.PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid(), config.PROMETHEUS_MULTIPROC_DIR)
+
+
+# Показатели, которые процесс API читает из своего состояния в момент сбора метрик
+PROCESS_COLLECTORS = [PoolCollector(), CompressionCollector(), ElasticCacheCollector(), BreakerCollector()]
+for process_collector in PROCESS_COLLECTORS:
+    registry.register(process_collector)
@@ -0,0 +1,124 @@
+"""
+Разбивка времени обработки запроса по этапам: Redis, ElasticSearch,
+разбор и построение моделей, сериализация ответа.
+
+Этапы копятся в контексте текущего запроса. По заголовку отладки они
+возвращаются клиенту в заголовке Server-Timing, а медленные запросы
+выборочно пишутся в журнал
+"""
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Dict, List, Optional
+
+import orjson
+from core import config
+
+logger = logging.getLogger('timing')
+
+
+class RequestTimings:
+    """Суммарное время и число вызовов каждого этапа запроса"""
+
+    __slots__ = ('spans',)
+
+    def __init__(self):
+        self.spans: Dict[str, List[float]] = {}
+
+    def add(self, name: str, seconds: float):
+        span = self.spans.get(name)
+        if span is None:
+            self.spans[name] = [seconds, 1]
+        else:
+            span[0] += seconds
+            span[1] += 1
+
+    def header(self, total: float) -> bytes:
+        """Значение заголовка Server-Timing, длительности в миллисекундах"""
+        parts = [f'{name};desc="{count} calls";dur={seconds * 1000:.2f}'
+                 for name, (seconds, count) in self.spans.items()]
+        parts.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(parts).encode()
+
+    def as_dict(self) -> dict:
+        return {name: {'ms': round(seconds * 1000, 2), 'calls': count}
+                for name, (seconds, count) in self.spans.items()}
+
+
+_timings: ContextVar[Optional[RequestTimings]] = ContextVar('timings', default=None)
+
+
+@contextmanager
+def span(name: str):
+    """
+    Учесть время выполнения блока как этап текущего запроса.
+    Вне запроса (фоновые задачи, прогрев) ничего не измеряет
+    """
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - started)
+
+
+def measured(name: str, func: Callable) -> Callable:
+    """Обернуть синхронную функцию так, чтобы ее вызовы учитывались как этап name"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class TimingMiddleware:
+    """
+    Собирает этапы запроса. Если в запросе есть заголовок отладки,
+    добавляет к ответу заголовок Server-Timing. Запросы дольше порога
+    с заданной вероятностью пишутся в журнал timing одной строкой JSON
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.debug_header = config.SERVER_TIMING_HEADER.lower().encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        timings = RequestTimings()
+        token = _timings.set(timings)
+        started = time.perf_counter()
+        debug = any(name == self.debug_header for name, _ in scope['headers'])
+        status = 500
+
+        async def send_with_timings(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if debug:
+                    header = timings.header(time.perf_counter() - started)
+                    message['headers'] = list(message.get('headers', [])) + [(b'server-timing', header)]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            _timings.reset(token)
+            total = time.perf_counter() - started
+            if total >= config.SLOW_REQUEST_THRESHOLD_IN_SECONDS \
+                    and random.random() < config.SLOW_REQUEST_LOG_SAMPLE_RATE:
+                logger.warning(orjson.dumps({
+                    'method': scope['method'],
+                    'path': scope['path'],
+                    'query': scope['query_string'].decode(errors='replace'),
+                    'status': status,
+                    'ms': round(total * 1000, 2),
+                    'spans': timings.as_dict(),
+                }).decode())
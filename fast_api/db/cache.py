@@ -1,15 +1,100 @@
+import asyncio
+import logging
+import time
+import uuid
 from abc import ABC, abstractmethod
-from aioredis import Redis
+from aioredis import ConnectionClosedError, PoolClosedError, Redis
+from contextlib import contextmanager
+from core import config, deadline, metrics, timing
+from core.breaker import CircuitBreaker, CircuitOpenError
+from db import codec
+from db.local_cache import LocalCache
 from fastapi import Depends
-from typing import Optional
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+# Удаляет ключ блокировки только если в нем записан токен владельца
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+T = TypeVar('T')
 
 redis: Optional[Redis] = None
+local: Optional[LocalCache] = None
+
+
+def tag_key(tag: str) -> str:
+    # Упорядоченный набор ключей с временем их истечения. Префикс отличается от прежних
+    # неупорядоченных наборов tag:*, чтобы не получить WRONGTYPE от еще не истекших
+    return f'tags:{tag}'
+
+
+def generation_key(namespace: str) -> str:
+    return f'gen:{namespace}'
+
+
+def popularity_key(namespace: str) -> str:
+    return f'popular:{namespace}'
+
+
+def shadow_key(key: str) -> str:
+    return f'shadow:{key}'
+
+
+def is_unavailable(error: BaseException) -> bool:
+    """Ошибка связи с Redis, а не ошибка в самой команде"""
+    return isinstance(error, (CircuitOpenError, ConnectionClosedError, PoolClosedError, OSError,
+                              asyncio.TimeoutError))
+
+
+def _bounded(awaitable: Awaitable[T]) -> Awaitable[T]:
+    """Обращение к Redis не дольше REDIS_CALL_TIMEOUT_IN_SECONDS и не дольше срока запроса"""
+    return deadline.bounded(awaitable, config.REDIS_CALL_TIMEOUT_IN_SECONDS)
+
+
+breaker = CircuitBreaker('redis', config.BREAKER_FAILURE_THRESHOLD,
+                         config.BREAKER_RESET_TIMEOUT_IN_SECONDS, is_unavailable)
 
 
 async def get_redis() -> Redis:
     return redis
 
 
+async def get_local() -> LocalCache:
+    return local
+
+
+class CacheWrites:
+    """
+    Записи в кэш, накопленные за одну загрузку: значения, их теневые копии и теги.
+    Выполняются одним обращением к кэшу (write)
+    """
+
+    __slots__ = ('values', 'shadows', 'tags')
+
+    def __init__(self):
+        self.values: Dict[str, Tuple[Any, int]] = {}
+        self.shadows: Dict[str, Tuple[Any, int]] = {}
+        self.tags: Dict[str, Tuple[Iterable[str], int]] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.values or self.shadows or self.tags)
+
+    def set(self, key, data, expire):
+        self.values[key] = (data, expire)
+
+    def set_shadow(self, key, data, expire):
+        self.shadows[key] = (data, expire)
+
+    def tag(self, key, tags: Iterable[str], expire):
+        self.tags[key] = (tags, expire)
+
+
 class MemoryCache(ABC):
     @abstractmethod
     def set(self, key, data, expire):
@@ -19,21 +104,449 @@ class MemoryCache(ABC):
     def get(self, key):
         pass
 
+    @abstractmethod
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        """Прочитать несколько ключей за одно обращение, порядок значений совпадает с порядком ключей"""
+        pass
+
+    @abstractmethod
+    def set_many(self, items: Dict[str, Any], expire):
+        """Записать несколько значений с одним временем жизни за одно обращение"""
+        pass
+
+    @abstractmethod
+    def delete_many(self, keys: Iterable[str]):
+        pass
+
+    @abstractmethod
+    def incr(self, key) -> int:
+        pass
+
+    @abstractmethod
+    def tag_many(self, items: Dict[str, Iterable[str]], expire):
+        """Запомнить, что каждый из ключей зависит от перечисленных для него тегов"""
+        pass
+
+    async def tag(self, key, tags: Iterable[str], expire):
+        await self.tag_many({key: tags}, expire)
+
+    async def write(self, writes: CacheWrites):
+        """Выполнить накопленные записи. Реализации с конвейером выполняют их за одно обращение"""
+        for key, (data, expire) in writes.values.items():
+            await self.set(key, data, expire)
+        for key, (data, expire) in writes.shadows.items():
+            await self.set_shadows({key: data}, expire)
+        for key, (tags, expire) in writes.tags.items():
+            await self.tag(key, tags, expire)
+
+    @abstractmethod
+    def invalidate_tags(self, tags: Iterable[str]) -> List[str]:
+        """Удалить все ключи, зависящие от тегов. Возвращает удаленные ключи"""
+        pass
+
+    @abstractmethod
+    def acquire_lock(self, key, expire_ms) -> Optional[str]:
+        """
+        Захватить блокировку на expire_ms миллисекунд.
+        Возвращает токен владельца или None, если блокировка уже занята
+        """
+        pass
+
+    @abstractmethod
+    def release_lock(self, key, token):
+        """Снять блокировку, если она все еще принадлежит владельцу токена"""
+        pass
+
+    @abstractmethod
+    def incr_scores(self, key, scores: Dict[str, float], max_size: int):
+        """
+        Увеличить счетчики элементов рейтинга. В рейтинге остается
+        не больше max_size элементов с наибольшими счетчиками
+        """
+        pass
+
+    @abstractmethod
+    def top(self, key, count: int) -> List[str]:
+        """Элементы рейтинга с наибольшими счетчиками, по убыванию"""
+        pass
+
+    async def set_shadows(self, items: Dict[str, Any], expire):
+        """
+        Записать теневые копии значений. Копии не сбрасываются по тегам
+        и читаются, только когда значение нельзя загрузить из хранилища
+        """
+        await self.set_many({shadow_key(key): data for key, data in items.items()}, expire)
+
+    async def get_shadows(self, keys: List[str]) -> List[Optional[bytes]]:
+        return await self.get_many([shadow_key(key) for key in keys])
+
+    async def get_model(self, key, loads: Callable[[bytes], Any]) -> Optional[Any]:
+        """
+        Прочитать значение по ключу и разобрать его функцией loads.
+        Реализации с локальным кэшем могут вернуть уже разобранный объект
+        """
+        data = await self.get(key)
+        if not data:
+            return None
+        return loads(data)
+
+    async def get_models_many(self, keys: List[str], loads: Callable[[bytes], Any]) -> List[Optional[Any]]:
+        """Пакетный вариант get_model"""
+        return [loads(data) if data else None for data in await self.get_many(keys)]
+
+    async def get_generation(self, namespace: str) -> int:
+        """Текущее поколение ключей списков пространства имен"""
+        data = await self.get(generation_key(namespace))
+        return int(data) if data else 0
+
+    async def bump_generation(self, namespace: str) -> int:
+        """
+        Сменить поколение ключей списков пространства имен.
+        Все страницы списков прежнего поколения перестают читаться и истекают сами
+        """
+        return await self.incr(generation_key(namespace))
+
 
 class RedisCache(MemoryCache):
     __con = None
 
-    def __init__(self, redis_instance: Depends(get_redis)):
+    def __init__(self, redis_instance: Depends(get_redis), compressor: Optional[codec.Codec] = None):
         self.__con = redis_instance
+        self.__codec = compressor
+
+    async def set(self, key, data, expire):
+        data = self.__encode(data)
+        with self.__measure('set'):
+            await _bounded(self.__con.set(key, data, expire=expire))
+
+    async def get(self, key):
+        with self.__measure('get'):
+            data = await _bounded(self.__con.get(key))
+        return codec.decompress(data)
+
+    async def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        if not keys:
+            return []
+        with self.__measure('mget'):
+            values = await _bounded(self.__con.mget(*keys))
+        return [codec.decompress(data) for data in values]
+
+    async def set_many(self, items: Dict[str, Any], expire):
+        if not items:
+            return
+        pipe = self.__con.pipeline()
+        for key, data in items.items():
+            pipe.set(key, self.__encode(data), expire=expire)
+        with self.__measure('set_many'):
+            await _bounded(pipe.execute())
+
+    async def delete_many(self, keys: Iterable[str]):
+        keys = list(keys)
+        if keys:
+            with self.__measure('delete'):
+                await _bounded(self.__con.delete(*keys))
+
+    async def write(self, writes: CacheWrites):
+        if not writes:
+            return
+        pipe = self.__con.pipeline()
+        for key, (data, expire) in writes.values.items():
+            pipe.set(key, self.__encode(data), expire=expire)
+        for key, (data, expire) in writes.shadows.items():
+            pipe.set(shadow_key(key), self.__encode(data), expire=expire)
+        for key, (tags, expire) in writes.tags.items():
+            self.__add_tags(pipe, key, tags, expire)
+        with self.__measure('write'):
+            await _bounded(pipe.execute())
+
+    @staticmethod
+    @contextmanager
+    def __measure(command):
+        with breaker.guard(), metrics.REDIS_LATENCY.labels(command).time(), timing.span('redis'):
+            yield
+
+    def __encode(self, data):
+        if not self.__codec:
+            return data
+        if isinstance(data, str):
+            data = data.encode()
+        return codec.compress(data, self.__codec, config.CACHE_COMPRESS_MIN_SIZE)
+
+    async def incr(self, key) -> int:
+        with self.__measure('incr'):
+            return await _bounded(self.__con.incr(key))
+
+    async def tag_many(self, items: Dict[str, Iterable[str]], expire):
+        pipe = self.__con.pipeline()
+        for key, tags in items.items():
+            self.__add_tags(pipe, key, tags, expire)
+        with self.__measure('tag_many'):
+            await _bounded(pipe.execute())
+
+    @staticmethod
+    def __add_tags(pipe, key, tags: Iterable[str], expire):
+        """
+        Ключ добавляется в набор тега со временем своего истечения, а истекшие ключи
+        из набора удаляются. Срок жизни набора продлевается каждой записью,
+        но сам набор не растет между сбросами: в нем только живые ключи
+        """
+        now = time.time()
+        for tag in tags:
+            pipe.zadd(tag_key(tag), now + expire, key)
+            pipe.zremrangebyscore(tag_key(tag), max=now)
+            pipe.expire(tag_key(tag), expire)
+
+    async def invalidate_tags(self, tags: Iterable[str]) -> List[str]:
+        tag_keys = [tag_key(tag) for tag in tags]
+        pipe = self.__con.pipeline()
+        now = time.time()
+        for key in tag_keys:
+            pipe.zrangebyscore(key, min=now, encoding='utf-8')
+        with self.__measure('zrangebyscore'):
+            members = await _bounded(pipe.execute())
+        keys = list(set().union(*members))
+        # Пустые наборы Redis удаляет сам: ключей нет, если их уже сбросил другой процесс
+        if keys:
+            await self.delete_many(keys + tag_keys)
+        return keys
+
+    async def acquire_lock(self, key, expire_ms) -> Optional[str]:
+        token = uuid.uuid4().hex
+        with self.__measure('acquire_lock'):
+            ok = await _bounded(
+                self.__con.set(key, token, pexpire=expire_ms, exist=self.__con.SET_IF_NOT_EXIST)
+            )
+        return token if ok else None
+
+    async def release_lock(self, key, token):
+        # Блокировку снимаем и после истечения срока запроса, иначе ключ простаивал бы до конца ее жизни
+        with self.__measure('release_lock'):
+            await self.__con.eval(RELEASE_LOCK_SCRIPT, keys=[key], args=[token])
+
+    async def incr_scores(self, key, scores: Dict[str, float], max_size: int):
+        if not scores:
+            return
+        pipe = self.__con.pipeline()
+        for member, score in scores.items():
+            pipe.zincrby(key, score, member)
+        pipe.zremrangebyrank(key, 0, -max_size - 1)
+        with self.__measure('incr_scores'):
+            await _bounded(pipe.execute())
+
+    async def top(self, key, count: int) -> List[str]:
+        with self.__measure('top'):
+            return await _bounded(self.__con.zrevrange(key, 0, count - 1, encoding='utf-8'))
+
+
+class LayeredCache(MemoryCache):
+    """
+    Двухуровневый кэш: локальный кэш процесса с разобранными объектами
+    поверх общего кэша. При записи ключ рассылается через канал Redis,
+    чтобы остальные экземпляры API убрали его из своего локального кэша
+    """
+
+    def __init__(self, remote: MemoryCache, local_cache: LocalCache, publisher: Redis):
+        self.remote = remote
+        self.local = local_cache
+        self.__publisher = publisher
 
     async def set(self, key, data, expire):
-        await self.__con.set(key, data, expire=expire)
+        await self.remote.set(key, data, expire)
+        await self.__forget([key])
 
     async def get(self, key):
-        data = await self.__con.get(key)
-        return data
+        return await self.remote.get(key)
+
+    async def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        return await self.remote.get_many(keys)
+
+    async def set_many(self, items: Dict[str, Any], expire):
+        await self.remote.set_many(items, expire)
+        await self.__forget(items.keys())
+
+    async def delete_many(self, keys: Iterable[str]):
+        keys = list(keys)
+        await self.remote.delete_many(keys)
+        await self.__forget(keys)
+
+    async def incr(self, key) -> int:
+        value = await self.remote.incr(key)
+        await self.__forget([key])
+        return value
+
+    async def tag_many(self, items: Dict[str, Iterable[str]], expire):
+        await self.remote.tag_many(items, expire)
+
+    async def write(self, writes: CacheWrites):
+        await self.remote.write(writes)
+        await self.__forget(writes.values.keys())
+
+    async def invalidate_tags(self, tags: Iterable[str]) -> List[str]:
+        keys = await self.remote.invalidate_tags(tags)
+        await self.__forget(keys)
+        return keys
+
+    async def __forget(self, keys: Iterable[str]):
+        """Убрать ключи из локального кэша этого и остальных экземпляров API"""
+        keys = list(keys)
+        if not keys:
+            return
+        pipe = self.__publisher.pipeline()
+        for key in keys:
+            self.local.delete(key)
+            pipe.publish(config.CACHE_INVALIDATION_CHANNEL, key)
+        await _bounded(pipe.execute())
+
+    async def acquire_lock(self, key, expire_ms) -> Optional[str]:
+        return await self.remote.acquire_lock(key, expire_ms)
+
+    async def release_lock(self, key, token):
+        await self.remote.release_lock(key, token)
+
+    async def incr_scores(self, key, scores: Dict[str, float], max_size: int):
+        await self.remote.incr_scores(key, scores, max_size)
+
+    async def set_shadows(self, items: Dict[str, Any], expire):
+        # Теневых копий нет в локальных кэшах, рассылать их ключи не нужно
+        await self.remote.set_shadows(items, expire)
+
+    async def top(self, key, count: int) -> List[str]:
+        return await self.remote.top(key, count)
+
+    async def get_model(self, key, loads: Callable[[bytes], Any]) -> Optional[Any]:
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        value = await self.remote.get_model(key, loads)
+        if value is not None:
+            self.local.set(key, value)
+        return value
+
+    async def get_models_many(self, keys: List[str], loads: Callable[[bytes], Any]) -> List[Optional[Any]]:
+        values = [self.local.get(key) for key in keys]
+        missing = [key for key, value in zip(keys, values) if value is None]
+        if not missing:
+            return values
+        loaded = dict(zip(missing, await self.remote.get_models_many(missing, loads)))
+        for key, value in loaded.items():
+            if value is not None:
+                self.local.set(key, value)
+        return [loaded.get(key) if value is None else value for key, value in zip(keys, values)]
+
+    async def get_generation(self, namespace: str) -> int:
+        # Поколение меняется редко, а нужно каждому запросу списка, поэтому держим его в памяти.
+        # О смене поколения другие экземпляры узнают через канал инвалидации
+        key = generation_key(namespace)
+        generation = self.local.get(key)
+        if generation is None:
+            generation = await self.remote.get_generation(namespace)
+            self.local.set(key, generation, config.GENERATION_LOCAL_TTL)
+        return generation
+
+
+async def _subscribe(redis_instance: Redis, name: str, consume: Callable[[Any], Awaitable],
+                     reconnected: Callable[[], Awaitable]):
+    """
+    Подписаться на канал и передать его consume. Если соединение с Redis разорвано,
+    подписка повторяется с паузой, которая растет до RESUBSCRIBE_MAX_DELAY_IN_SECONDS.
+    Сообщения, опубликованные без подписки, потеряны, поэтому после повторной
+    подписки вызывается reconnected
+    """
+    delay = config.RESUBSCRIBE_MIN_DELAY_IN_SECONDS
+    subscribed = False
+    while True:
+        try:
+            channel, = await redis_instance.subscribe(name)
+            if subscribed:
+                logger.info('Подписка на канал %s восстановлена', name)
+                await reconnected()
+            subscribed = True
+            delay = config.RESUBSCRIBE_MIN_DELAY_IN_SECONDS
+            await consume(channel)
+            logger.warning('Подписка на канал %s прервана', name)
+        except Exception as e:
+            logger.warning('Не удалось подписаться на канал %s: %r', name, e)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, config.RESUBSCRIBE_MAX_DELAY_IN_SECONDS)
+
+
+async def listen_invalidation(redis_instance: Redis, local_cache: LocalCache):
+    """
+    Слушать канал инвалидации и удалять из локального кэша
+    ключи, измененные другими экземплярами API
+    """
+    async def consume(channel):
+        while await channel.wait_message():
+            key = await channel.get(encoding='utf-8')
+            local_cache.delete(key)
+
+    async def reconnected():
+        # Какие ключи изменились без подписки, неизвестно
+        local_cache.clear()
+
+    await _subscribe(redis_instance, config.CACHE_INVALIDATION_CHANNEL, consume, reconnected)
+
+
+async def listen_etl(redis_instance: Redis, cache: MemoryCache,
+                     listeners: Iterable[Callable[[dict], Awaitable]] = ()):
+    """
+    Слушать уведомления ETL о записанных в ElasticSearch документах
+    и удалять ключи кэша, зависящие от этих документов.
+    Затем уведомление передается слушателям, которые держат копии данных в памяти
+    """
+    listeners = list(listeners)
+
+    async def consume(channel):
+        await _consume_etl(channel, cache, listeners)
+
+    async def reconnected():
+        # Какие документы ETL записал без подписки, неизвестно: слушатели перечитывают индексы целиком.
+        # Ключи Redis не сбрасываются, их время жизни ограничено
+        for index in config.INDEX_NAMESPACES:
+            await _notify(listeners, {'index': index, 'reindex': True})
+
+    await _subscribe(redis_instance, config.ETL_CHANNEL, consume, reconnected)
+
+
+async def _consume_etl(channel, cache: MemoryCache, listeners: List[Callable[[dict], Awaitable]]):
+    while await channel.wait_message():
+        # Одно некорректное уведомление не должно останавливать обработку остальных
+        try:
+            message = await channel.get_json()
+            namespace = config.INDEX_NAMESPACES.get(message['index'])
+        except Exception:
+            logger.exception('Не удалось разобрать уведомление ETL')
+            continue
+        if not namespace:
+            continue
+        await _invalidate_etl(cache, namespace, message)
+        await _notify(listeners, message)
+
+
+async def _notify(listeners: List[Callable[[dict], Awaitable]], message: dict):
+    for listener in listeners:
+        try:
+            await listener(message)
+        except Exception:
+            logger.exception('Не удалось обработать уведомление ETL')
+
+
+async def _invalidate_etl(cache: MemoryCache, namespace: str, message: dict):
+    try:
+        if message.get('reindex'):
+            # После полной переиндексации сбрасываем сразу все списки
+            generation = await cache.bump_generation(namespace)
+            logger.info('Индекс %s пересоздан, поколение ключей: %d', message['index'], generation)
+            return
+        tags = [namespace, *(f'{namespace}:{doc_id}' for doc_id in message['ids'])]
+        keys = await cache.invalidate_tags(tags)
+    except Exception:
+        logger.exception('Не удалось сбросить кэш по уведомлению ETL')
+        return
+    logger.debug('По уведомлению ETL для %s удалено ключей: %d', message['index'], len(keys))
 
 
 async def get_cache() -> MemoryCache:
     redis_instance = await get_redis()
-    return RedisCache(redis_instance)
+    compressor = codec.ZlibCodec(config.CACHE_COMPRESS_LEVEL) if config.CACHE_COMPRESS_MIN_SIZE else None
+    return LayeredCache(RedisCache(redis_instance, compressor), await get_local(), redis_instance)
@@ -0,0 +1,92 @@
+import time
+import zlib
+from abc import ABC, abstractmethod
+from typing import Dict, Optional
+
+
+class Codec(ABC):
+    """
+    Алгоритм сжатия значений кэша. Сжатое значение начинается с байта marker,
+    по которому при чтении выбирается алгоритм распаковки
+    """
+
+    marker: bytes = None
+
+    @abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        pass
+
+    @abstractmethod
+    def decompress(self, data: bytes) -> bytes:
+        pass
+
+
+class ZlibCodec(Codec):
+    marker = b'\x01'
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class CompressionStats:
+    """
+    Счетчики сжатия: сколько значений сжато и распаковано,
+    их размер до и после сжатия и затраченное на это время
+    """
+
+    def __init__(self):
+        self.compressed = 0
+        self.skipped = 0
+        self.decompressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_seconds = 0.0
+        self.decompress_seconds = 0.0
+
+    @property
+    def ratio(self) -> float:
+        return self.bytes_in / self.bytes_out if self.bytes_out else 1.0
+
+
+# Алгоритмы, которые умеем распаковывать, по байту-маркеру
+CODECS: Dict[bytes, Codec] = {codec.marker: codec for codec in (ZlibCodec(),)}
+
+stats = CompressionStats()
+
+
+def compress(data: bytes, codec: Codec, min_size: int) -> bytes:
+    """
+    Сжать значение, если оно не меньше min_size и сжатие дает выигрыш.
+    Несжатые значения хранятся как есть, поэтому старые записи читаются без изменений
+    """
+    if len(data) < min_size:
+        return data
+    started = time.perf_counter()
+    packed = codec.marker + codec.compress(data)
+    stats.compress_seconds += time.perf_counter() - started
+    if len(packed) >= len(data):
+        stats.skipped += 1
+        return data
+    stats.compressed += 1
+    stats.bytes_in += len(data)
+    stats.bytes_out += len(packed)
+    return packed
+
+
+def decompress(data: Optional[bytes]) -> Optional[bytes]:
+    if not data:
+        return data
+    codec = CODECS.get(data[:1])
+    if codec is None:
+        return data
+    started = time.perf_counter()
+    data = codec.decompress(data[1:])
+    stats.decompress_seconds += time.perf_counter() - started
+    stats.decompressed += 1
+    return data
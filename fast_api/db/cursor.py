@@ -0,0 +1,37 @@
+import base64
+from typing import Any, List, Optional
+
+import orjson
+
+
+class Cursor:
+    """
+    Положение в выдаче ElasticSearch для обхода через search_after:
+    значения сортировки последнего документа предыдущей страницы.
+    При согласованном обходе хранит еще идентификатор point-in-time,
+    чтобы записи ETL не сдвигали выдачу между страницами
+    """
+
+    __slots__ = ('search_after', 'pit_id', 'consistent')
+
+    def __init__(self, search_after: Optional[List[Any]] = None, pit_id: Optional[str] = None,
+                 consistent: bool = False):
+        self.search_after = search_after
+        self.pit_id = pit_id
+        self.consistent = consistent or pit_id is not None
+
+    def encode(self) -> str:
+        """Непрозрачная для клиента строка курсора"""
+        data = orjson.dumps({'a': self.search_after, 'p': self.pit_id})
+        return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+    @classmethod
+    def decode(cls, value: str) -> 'Cursor':
+        try:
+            data = orjson.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+            search_after, pit_id = data['a'], data['p']
+        except (ValueError, TypeError, KeyError) as e:
+            raise ValueError(f'Некорректный курсор {value!r}') from e
+        if not isinstance(search_after, list) or not isinstance(pit_id, (str, type(None))):
+            raise ValueError(f'Некорректный курсор {value!r}')
+        return cls(search_after, pit_id)
@@ -0,0 +1,61 @@
+import math
+import random
+import time
+from typing import Any, Callable, Union
+
+# Значения в кэше хранятся с заголовком вида ~<мягкое истечение>:<время вычисления>~
+ENTRY_MARK = b'~'
+# Пустой результат хранится компактной меткой вида !<мягкое истечение>
+NEGATIVE_MARK = b'!'
+
+
+class CacheEntry:
+    """
+    Значение из кэша вместе с метаданными для обновления:
+    время мягкого истечения (после него значение считается устаревшим,
+    но еще отдается клиентам) и время, которое ушло на его вычисление.
+    Жесткое истечение задается временем жизни ключа в самом кэше
+    """
+
+    __slots__ = ('value', 'soft_expire_at', 'delta')
+
+    def __init__(self, value: Any, soft_expire_at: float, delta: float):
+        self.value = value
+        self.soft_expire_at = soft_expire_at
+        self.delta = delta
+
+    def is_stale(self) -> bool:
+        return time.time() >= self.soft_expire_at
+
+    def should_refresh(self, beta: float = 1.0) -> bool:
+        """
+        Вероятностное досрочное обновление (XFetch): чем ближе мягкое
+        истечение и чем дольше вычисляется значение, тем выше шанс обновить его заранее
+        """
+        gap = -self.delta * beta * math.log(1.0 - random.random())
+        return time.time() + gap >= self.soft_expire_at
+
+
+def pack_entry(data: Union[str, bytes], soft_expire_at: float, delta: float) -> bytes:
+    if isinstance(data, str):
+        data = data.encode()
+    header = f'{soft_expire_at:.3f}:{delta:.4f}'.encode()
+    return ENTRY_MARK + header + ENTRY_MARK + data
+
+
+def pack_negative(soft_expire_at: float) -> bytes:
+    return NEGATIVE_MARK + str(int(soft_expire_at)).encode()
+
+
+def unpack_entry(raw: bytes, loads: Callable[[bytes], Any]) -> CacheEntry:
+    """
+    Разобрать значение из кэша. Значения, записанные без заголовка,
+    считаются устаревшими и будут обновлены в фоне
+    """
+    if raw.startswith(NEGATIVE_MARK):
+        return CacheEntry([], float(raw[1:]), 0.0)
+    if not raw.startswith(ENTRY_MARK):
+        return CacheEntry(loads(raw), 0.0, 0.0)
+    end = raw.index(ENTRY_MARK, 1)
+    soft_expire_at, delta = raw[1:end].split(b':')
+    return CacheEntry(loads(raw[end + 1:]), float(soft_expire_at), float(delta))
@@ -0,0 +1,44 @@
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+class LocalCache:
+    """
+    Кэш первого уровня в памяти процесса.
+    Хранит уже разобранные объекты моделей, ограничен по количеству
+    элементов (вытесняются давно не использовавшиеся) и по времени жизни.
+    Объекты отдаются по ссылке, поэтому изменять их после чтения нельзя.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.__data = OrderedDict()
+
+    def get(self, key) -> Optional[Any]:
+        item = self.__data.get(key)
+        if item is None:
+            return None
+        expire_at, value = item
+        if expire_at < time.monotonic():
+            self.__data.pop(key, None)
+            return None
+        self.__data.move_to_end(key)
+        return value
+
+    def set(self, key, value, expire: Optional[float] = None):
+        ttl = min(expire, self.ttl) if expire else self.ttl
+        self.__data[key] = (time.monotonic() + ttl, value)
+        self.__data.move_to_end(key)
+        while len(self.__data) > self.maxsize:
+            self.__data.popitem(last=False)
+
+    def delete(self, key):
+        self.__data.pop(key, None)
+
+    def clear(self):
+        self.__data.clear()
+
+    def __len__(self):
+        return len(self.__data)
@@ -0,0 +1,101 @@
+import heapq
+import re
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, Optional, Tuple
+
+_WORD = re.compile(r'\w+')
+# Больше любого символа, который может продолжать префикс
+_LAST_CHAR = '\U0010ffff'
+
+
+def normalize(text: str) -> List[str]:
+    """Слова текста в нижнем регистре, ё заменена на е"""
+    return _WORD.findall(text.casefold().replace('ё', 'е'))
+
+
+class PrefixIndex:
+    """
+    Индекс для поиска по началу слов в памяти процесса.
+    Отсортированный массив ключей: для каждого слова названия хранится
+    название начиная с этого слова, поэтому "wars" находит "Star Wars".
+    Двоичным поиском находится диапазон ключей с нужным префиксом.
+    Узкий диапазон просматривается целиком, а для широкого (короткий префикс)
+    документы перебираются по убыванию ранга, пока не наберется нужное число
+    """
+
+    def __init__(self, max_words: int, scan_limit: int = 1000):
+        self.max_words = max_words
+        self.scan_limit = scan_limit
+        self.__keys: List[Tuple[str, str]] = []
+        self.__ranked: List[Tuple[float, str]] = []
+        self.__docs: Dict[str, Tuple[str, float, List[str]]] = {}
+
+    def _keys(self, text: str) -> List[str]:
+        words = normalize(text)[:self.max_words]
+        return [' '.join(words[start:]) for start in range(len(words))]
+
+    def add(self, doc_id: str, text: str, rank: float):
+        """Добавить документ или заменить его текст и ранг"""
+        self.remove(doc_id)
+        keys = self._keys(text)
+        for key in keys:
+            insort(self.__keys, (key, doc_id))
+        insort(self.__ranked, (-rank, doc_id))
+        self.__docs[doc_id] = (text, rank, keys)
+
+    def remove(self, doc_id: str):
+        doc = self.__docs.pop(doc_id, None)
+        if doc is None:
+            return
+        for key in doc[2]:
+            _delete(self.__keys, (key, doc_id))
+        _delete(self.__ranked, (-doc[1], doc_id))
+
+    def replace(self, docs: Iterable[Tuple[str, str, float]]):
+        """Заменить все содержимое индекса документами (id, текст, ранг)"""
+        keys, ranked, data = [], [], {}
+        for doc_id, text, rank in docs:
+            doc_keys = self._keys(text)
+            keys.extend((key, doc_id) for key in doc_keys)
+            ranked.append((-rank, doc_id))
+            data[doc_id] = (text, rank, doc_keys)
+        keys.sort()
+        ranked.sort()
+        self.__keys, self.__ranked, self.__docs = keys, ranked, data
+
+    def find(self, prefix: str, limit: int) -> List[str]:
+        """Идентификаторы документов с префиксом в начале одного из слов, по убыванию ранга"""
+        prefix = ' '.join(normalize(prefix))
+        if not prefix:
+            return []
+        keys = self.__keys
+        start = bisect_left(keys, (prefix,))
+        end = bisect_left(keys, (prefix + _LAST_CHAR,), start)
+        docs = self.__docs
+        if end - start > self.scan_limit:
+            result = []
+            for _, doc_id in self.__ranked:
+                if any(key.startswith(prefix) for key in docs[doc_id][2]):
+                    result.append(doc_id)
+                    if len(result) == limit:
+                        break
+            return result
+        found = {doc_id for _, doc_id in keys[start:end]}
+        return heapq.nsmallest(limit, found, key=lambda doc_id: (-docs[doc_id][1], doc_id))
+
+    def get(self, doc_id: str) -> Optional[Tuple[str, float]]:
+        doc = self.__docs.get(doc_id)
+        return doc and doc[:2]
+
+    def items(self) -> List[Tuple[str, str, float]]:
+        """Все документы (id, текст, ранг) в том виде, в котором их принимает replace"""
+        return [(doc_id, text, rank) for doc_id, (text, rank, _) in self.__docs.items()]
+
+    def __len__(self):
+        return len(self.__docs)
+
+
+def _delete(items: list, item):
+    position = bisect_left(items, item)
+    if position < len(items) and items[position] == item:
+        del items[position]
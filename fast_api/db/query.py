@@ -0,0 +1,220 @@
+"""
+Построитель запросов поиска ElasticSearch.
+
+Запросы одной формы (одинаковые условия, поля и сортировка) отличаются
+только значениями параметров. Для каждой формы один раз готовится шаблон
+тела запроса в JSON, при следующих запросах в него подставляются только
+значения. Готовые байты передаются клиенту ElasticSearch без повторной сериализации.
+
+Отбор по идентификаторам выполняется в контексте filter: такие условия
+не считают релевантность и кэшируются ElasticSearch на уровне узла
+"""
+import re
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import orjson
+
+# Условие запроса: вид, поле и путь вложенного документа
+Clause = Tuple[str, str, Optional[str]]
+
+MATCH = 'match'
+TERM = 'term'
+NESTED_TERM = 'nested_term'
+
+# Ответы на запросы больших страниц (выгрузка индекса целиком) не кладутся в кэш запросов шарда
+REQUEST_CACHE_MAX_SIZE = 100
+
+_PARAM = re.compile(rb'"__param_(\d+)__"')
+
+
+class DocValue(NamedTuple):
+    """
+    Поле, читаемое из doc values вместо _source: поле индекса, поле документа
+    в ответе хранилища, формат значения ElasticSearch и приведение значения
+    к типу поля (с форматом ElasticSearch отдает числа строками)
+    """
+    field: str
+    name: str
+    format: Optional[str] = None
+    convert: Optional[Callable[[Any], Any]] = None
+
+
+class _Param:
+    """Место параметра в шаблоне"""
+
+    __slots__ = ('index',)
+
+    def __init__(self, index: int):
+        self.index = index
+
+
+class SearchQuery:
+    """
+    Запрос поиска: условия отбора, сортировка и положение страницы
+    """
+
+    def __init__(self):
+        self._clauses: List[Clause] = []
+        self._values: List[Any] = []
+        self._sort: List[Tuple[str, str]] = []
+        self._size: int = 10
+        self._from: Optional[int] = None
+        self._search_after: Optional[list] = None
+        self._pit: Optional[Tuple[str, str]] = None
+        self._docvalues: Tuple[DocValue, ...] = ()
+
+    def match(self, field: str, value: Any) -> 'SearchQuery':
+        """Полнотекстовое совпадение поля, влияет на релевантность"""
+        self._clauses.append((MATCH, field, None))
+        self._values.append(str(value))
+        return self
+
+    def term(self, field: str, value: Any) -> 'SearchQuery':
+        """Точное совпадение поля keyword, без влияния на релевантность"""
+        self._clauses.append((TERM, field, None))
+        self._values.append(str(value))
+        return self
+
+    def nested_term(self, path: str, field: str, value: Any) -> 'SearchQuery':
+        """Точное совпадение поля вложенного документа path, без влияния на релевантность"""
+        self._clauses.append((NESTED_TERM, field, path))
+        self._values.append(str(value))
+        return self
+
+    def sort(self, field: str, order: str = 'asc') -> 'SearchQuery':
+        self._sort.append((field, order))
+        return self
+
+    @property
+    def sorted(self) -> bool:
+        return bool(self._sort)
+
+    @property
+    def request_cacheable(self) -> bool:
+        """
+        Стоит ли хранить ответ в кэше запросов шарда. Полнотекстовый поиск
+        по вводу пользователя почти не повторяется и только вытеснял бы
+        из кэша списки, а запросы к point-in-time не повторяются вовсе
+        """
+        return self._pit is None and self._size <= REQUEST_CACHE_MAX_SIZE \
+            and all(kind != MATCH for kind, _, _ in self._clauses)
+
+    def page(self, size: int, number: int = 1) -> 'SearchQuery':
+        """Страница по номеру, начиная с первой"""
+        return self.window(size, (number - 1) * size)
+
+    def window(self, size: int, offset: int) -> 'SearchQuery':
+        """size документов, пропустив первые offset"""
+        self._size = size
+        self._from = offset
+        self._search_after = None
+        return self
+
+    def after(self, size: int, search_after: list) -> 'SearchQuery':
+        """Страница после документа со значениями сортировки search_after"""
+        self._size = size
+        self._from = None
+        self._search_after = search_after
+        return self
+
+    def pit(self, pit_id: str, keep_alive: str) -> 'SearchQuery':
+        """Искать в point-in-time вместо текущего состояния индекса"""
+        self._pit = (pit_id, keep_alive)
+        return self
+
+    def docvalues(self, fields: Sequence[DocValue]) -> 'SearchQuery':
+        """Читать поля из doc values, не загружая _source документов"""
+        self._docvalues = tuple(fields)
+        return self
+
+    def shape(self) -> tuple:
+        """Форма запроса: все, кроме значений параметров"""
+        return (
+            tuple(self._clauses),
+            tuple(self._sort),
+            self._from is not None,
+            self._search_after is not None,
+            self._pit is not None,
+            tuple((field.field, field.format) for field in self._docvalues),
+        )
+
+    def params(self) -> List[Any]:
+        """Значения параметров в порядке их мест в шаблоне"""
+        params = self._values + [self._size]
+        if self._from is not None:
+            params.append(self._from)
+        if self._search_after is not None:
+            params.append(self._search_after)
+        if self._pit is not None:
+            params.extend(self._pit)
+        return params
+
+    def build(self) -> dict:
+        """Тело запроса в виде словаря"""
+        return _build(self.shape(), self.params())
+
+    def render(self) -> bytes:
+        """Тело запроса в JSON по шаблону его формы"""
+        return compile_template(self.shape()).render(self.params())
+
+
+class Template:
+    """
+    Тело запроса в JSON, разрезанное по местам параметров
+    """
+
+    __slots__ = ('parts', 'indexes')
+
+    def __init__(self, parts: Sequence[bytes], indexes: Sequence[int]):
+        self.parts = parts
+        self.indexes = indexes
+
+    def render(self, params: List[Any]) -> bytes:
+        chunks = [self.parts[0]]
+        for index, part in zip(self.indexes, self.parts[1:]):
+            # Значения сериализуются как JSON, поэтому кавычки в них не ломают запрос
+            chunks.append(orjson.dumps(params[index]))
+            chunks.append(part)
+        return b''.join(chunks)
+
+
+@lru_cache(maxsize=256)
+def compile_template(shape: tuple) -> Template:
+    clauses = shape[0]
+    count = len(clauses) + 1 + sum(shape[2:4]) + 2 * shape[4]
+    body = _build(shape, [_Param(index) for index in range(count)])
+    text = orjson.dumps(body, default=lambda param: f'__param_{param.index}__')
+    pieces = _PARAM.split(text)
+    return Template(pieces[::2], [int(index) for index in pieces[1::2]])
+
+
+def _build(shape: tuple, params: List[Any]) -> Dict[str, Any]:
+    clauses, sort, has_from, has_search_after, has_pit, docvalues = shape
+    params = iter(params)
+    must, filters = [], []
+    for kind, field, path in clauses:
+        if kind == MATCH:
+            must.append({'match': {field: next(params)}})
+        elif kind == TERM:
+            filters.append({'term': {field: next(params)}})
+        elif kind == NESTED_TERM:
+            filters.append({'nested': {'path': path, 'query': {'term': {field: next(params)}}}})
+    query = {}
+    if must:
+        query['must'] = must
+    if filters:
+        query['filter'] = filters
+    body = {'query': {'bool': query} if query else {'match_all': {}}, 'size': next(params)}
+    if has_from:
+        body['from'] = next(params)
+    if sort:
+        body['sort'] = [{field: {'order': order}} for field, order in sort]
+    if has_search_after:
+        body['search_after'] = next(params)
+    if has_pit:
+        body['pit'] = {'id': next(params), 'keep_alive': next(params)}
+    if docvalues:
+        body['_source'] = False
+        body['docvalue_fields'] = [{'field': field, 'format': fmt} if fmt else field for field, fmt in docvalues]
+    return body
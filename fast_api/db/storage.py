@@ -1,16 +1,46 @@
+import asyncio
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from core import config, deadline, metrics, timing
+from core.breaker import CircuitBreaker, CircuitOpenError
+from db.cursor import Cursor
+from db.query import DocValue, SearchQuery
 from fastapi import Depends
-from typing import Optional
 from elasticsearch import AsyncElasticsearch
-from typing import Any, Optional
+from elasticsearch import ConnectionError as ElasticConnectionError, TransportError
+from typing import Any, AsyncIterator, Awaitable, List, Optional, Sequence, Tuple, TypeVar
 
 es: Optional[AsyncElasticsearch] = None
 
+T = TypeVar('T')
+
+# Части ответов ElasticSearch, которые читает API. Остальное (_shards, took, _index, _score...)
+# ElasticSearch не передает, а клиент не разбирает
+GET_FILTER_PATH = "_source"
+MGET_FILTER_PATH = "docs._id,docs.found,docs._source"
+SEARCH_FILTER_PATH = "hits.hits._source,hits.hits.fields,hits.hits.sort,pit_id"
+
 
 async def get_elastic() -> AsyncElasticsearch:
     return es
 
 
+def is_unavailable(error: BaseException) -> bool:
+    """Ошибка связи с ElasticSearch или его сбой, а не ошибка в самом запросе"""
+    if isinstance(error, (CircuitOpenError, ElasticConnectionError, asyncio.TimeoutError)):
+        return True
+    return isinstance(error, TransportError) and isinstance(error.status_code, int) and error.status_code >= 500
+
+
+def _bounded(awaitable: Awaitable[T]) -> Awaitable[T]:
+    """Обращение к ElasticSearch не дольше ELASTIC_CALL_TIMEOUT_IN_SECONDS и не дольше срока запроса"""
+    return deadline.bounded(awaitable, config.ELASTIC_CALL_TIMEOUT_IN_SECONDS)
+
+
+breaker = CircuitBreaker('elasticsearch', config.BREAKER_FAILURE_THRESHOLD,
+                         config.BREAKER_RESET_TIMEOUT_IN_SECONDS, is_unavailable)
+
+
 class AbstractStorage(ABC):
 
     @abstractmethod
@@ -18,13 +48,32 @@ class AbstractStorage(ABC):
         pass
 
     @abstractmethod
-    def search(self, some_index, some_body, es_fields):
+    def get_many(self, some_index, some_ids, es_fields):
         pass
 
     @abstractmethod
-    def make_search_query(self, some_index, filter_path, filter_col, filter_param,
-                          sort_column, sort_order,
-                          page_size, page_number, query, query_col):
+    def search(self, some_index, some_body, es_fields, request_cache=None):
+        pass
+
+    @abstractmethod
+    def search_page(self, some_index, query: SearchQuery, es_fields, page_size, page_number,
+                    cursor: Optional[Cursor] = None,
+                    docvalues: Optional[Sequence[DocValue]] = None) -> Tuple[List[dict], Optional[Cursor]]:
+        """
+        Найти одну страницу документов.
+        Возвращает документы и курсор следующей страницы, если она может быть.
+        С docvalues поля документов читаются из doc values, но возвращаются так же в _source
+        """
+        pass
+
+    @abstractmethod
+    def scan(self, some_index, query: SearchQuery, es_fields, size, offset=0,
+             cursor: Optional[Cursor] = None,
+             docvalues: Optional[Sequence[DocValue]] = None) -> AsyncIterator[List[dict]]:
+        """
+        Перебрать size документов, пропустив первые offset или начиная с курсора,
+        частями по config.STREAM_CHUNK_SIZE. Части выдаются по мере получения
+        """
         pass
 
 
@@ -35,42 +84,141 @@ class ElasticStorage(AbstractStorage):
         self.__conn = elastic
 
     async def get(self, some_index, some_id, _source_includes):
-        data = await self.__conn.get(index=some_index, id=some_id, _source_includes=_source_includes)
+        with self.__measure('get', some_index):
+            data = await _bounded(self.__conn.get(
+                index=some_index, id=some_id, _source_includes=_source_includes, filter_path=GET_FILTER_PATH
+            ))
         return data
 
-    async def search(self, some_index, some_body, es_fields):
-        data = await self.__conn.search(index=some_index, body=some_body, _source_includes=es_fields)
+    async def get_many(self, some_index, some_ids, es_fields):
+        with self.__measure('mget', some_index):
+            data = await _bounded(self.__conn.mget(
+                body={"ids": some_ids}, index=some_index, _source_includes=es_fields, filter_path=MGET_FILTER_PATH
+            ))
         return data
 
-    async def make_search_query(self, some_index, filter_path, filter_col,
-                                filter_param, sort_column, sort_order,
-                                page_size, page_number, query, query_col):
-
-        if query or filter_param:
-            match_filter = []
-            if query:
-                match_filter.append({"match": {f"{query_col}": str(query)}})
-            if filter_param:
-                match_filter.append({"match": {f"{filter_path}.{filter_col}": str(filter_param)}})
-            sub_query = {
-                        "bool": {
-                            "must": match_filter
-                        }}
-        else:
-            sub_query = {"match_all": {}}
+    async def search(self, some_index, some_body, es_fields, request_cache=None):
+        with self.__measure('search', some_index or 'pit'):
+            data = await _bounded(self.__conn.search(
+                index=some_index, body=some_body, _source_includes=es_fields,
+                request_cache=request_cache, filter_path=SEARCH_FILTER_PATH,
+            ))
+        return data
 
-        if sort_order:
-            sorting = {"sort": [{
-                sort_column: {"order": sort_order}
-            }]}
+    async def search_page(self, some_index, query: SearchQuery, es_fields, page_size, page_number,
+                          cursor: Optional[Cursor] = None,
+                          docvalues: Optional[Sequence[DocValue]] = None) -> Tuple[List[dict], Optional[Cursor]]:
+        """
+        Без курсора страница выбирается по номеру через from, с курсором - через
+        search_after, поэтому дальние страницы не медленнее первых и не упираются
+        в max_result_window. Сортировка дополняется полем id, чтобы положение
+        документа в выдаче было однозначным
+        """
+        if not query.sorted:
+            query.sort("_score", "desc")
+        query.sort("id", "asc")
+        if cursor and cursor.search_after:
+            query.after(page_size, cursor.search_after)
         else:
-            sorting = {}
-        main_query = dict(({
-            "from": (page_number - 1) * page_size,
-            "size": page_size,
-            "query": sub_query}), **sorting)
-        main_query = str(main_query).replace("'", '"')
-        return main_query
+            query.page(page_size, page_number)
+        index = some_index
+        if cursor and cursor.consistent:
+            # Запрос к point-in-time выполняется без указания индекса
+            pit_id = cursor.pit_id or await self.open_point_in_time(some_index)
+            query.pit(pit_id, config.ELASTIC_PIT_KEEP_ALIVE)
+            index = None
+        if docvalues:
+            query.docvalues(docvalues)
+            es_fields = None
+        # Без явного request_cache ElasticSearch кэширует только запросы с size=0
+        doc = await self.search(index, query.render(), es_fields, request_cache=query.request_cacheable or None)
+        # Пустой список hits filter_path убирает из ответа вместе с родителем
+        hits = doc.get("hits", {}).get("hits", [])
+        if docvalues:
+            for hit in hits:
+                hit["_source"] = _docvalue_source(hit.pop("fields", {}), docvalues)
+        pit_id = doc.get("pit_id") if cursor and cursor.consistent else None
+        if hits and len(hits) == page_size:
+            return hits, Cursor(hits[-1]["sort"], pit_id)
+        if pit_id:
+            await self.close_point_in_time(pit_id)
+        return hits, None
+
+    async def scan(self, some_index, query: SearchQuery, es_fields, size, offset=0,
+                   cursor: Optional[Cursor] = None,
+                   docvalues: Optional[Sequence[DocValue]] = None) -> AsyncIterator[List[dict]]:
+        """
+        Каждая часть запрашивается через search_after после последнего документа
+        предыдущей, поэтому в памяти держится только одна часть, а from
+        используется только для первой. Сортировка дополняется полем id,
+        поэтому документы не повторяются и не пропадают между частями
+        """
+        if not query.sorted:
+            query.sort("_score", "desc")
+        query.sort("id", "asc")
+        if docvalues:
+            query.docvalues(docvalues)
+            es_fields = None
+        search_after = cursor.search_after if cursor else None
+        while size > 0:
+            chunk_size = min(size, config.STREAM_CHUNK_SIZE)
+            if search_after:
+                query.after(chunk_size, search_after)
+            else:
+                query.window(chunk_size, offset)
+            doc = await self.search(some_index, query.render(), es_fields,
+                                    request_cache=query.request_cacheable or None)
+            hits = doc.get("hits", {}).get("hits", [])
+            if docvalues:
+                for hit in hits:
+                    hit["_source"] = _docvalue_source(hit.pop("fields", {}), docvalues)
+            if hits:
+                yield hits
+            if len(hits) < chunk_size:
+                return
+            size -= chunk_size
+            search_after = hits[-1]["sort"]
+
+    async def cache_stats(self, some_indexes) -> dict:
+        """
+        Счетчики кэша запросов шардов и кэша фильтров узлов по индексам
+        """
+        with self.__measure('stats', 'all'):
+            data = await _bounded(self.__conn.indices.stats(
+                index=",".join(some_indexes), metric="request_cache,query_cache", filter_path="indices.*.total"
+            ))
+        return {index: {"request_cache": stats["total"]["request_cache"],
+                        "query_cache": stats["total"]["query_cache"]}
+                for index, stats in data["indices"].items()}
+
+    async def open_point_in_time(self, some_index) -> str:
+        # Клиент elasticsearch 7.9 еще не знает об API point-in-time
+        with self.__measure('open_pit', some_index):
+            data = await _bounded(self.__conn.transport.perform_request(
+                "POST", f"/{some_index}/_pit", params={"keep_alive": config.ELASTIC_PIT_KEEP_ALIVE}
+            ))
+        return data["id"]
+
+    async def close_point_in_time(self, pit_id):
+        with self.__measure('close_pit', 'pit'):
+            await _bounded(self.__conn.transport.perform_request("DELETE", "/_pit", body={"id": pit_id}))
+
+    @staticmethod
+    @contextmanager
+    def __measure(operation, some_index):
+        with breaker.guard(), metrics.ELASTIC_IN_PROGRESS.track_inprogress(), \
+                metrics.ELASTIC_LATENCY.labels(operation, some_index).time(), timing.span('elastic'):
+            yield
+
+
+def _docvalue_source(fields: dict, docvalues: Sequence[DocValue]) -> dict:
+    """Поля документа из doc values в том же виде, что и в _source"""
+    source = {}
+    for field in docvalues:
+        if field.field in fields:
+            value = fields[field.field][0]
+            source[field.name] = field.convert(value) if field.convert else value
+    return source
 
 
 async def get_storage() -> AbstractStorage:
@@ -1,14 +1,25 @@
+import asyncio
 import logging
+import os
 
 import aioredis
 import uvicorn
-from api.v1 import film, genre, person
-from core import config
+from api.v1 import film, genre, person, suggest
+from core import breaker, config, deadline, metrics, timing
 from core.logger import LOGGING
 from db import storage, cache
+from db.local_cache import LocalCache
 from elasticsearch import AsyncElasticsearch
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from fastapi.responses import ORJSONResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from services import popularity
+from services import suggest as suggest_service
+from services.film import FilmService
+from services.genre import GenreService
+from services.person import PersonService
+from utils.response import ConditionalGetMiddleware
+from warmup import Warmup
 
 app = FastAPI(
     title=config.PROJECT_NAME,
@@ -20,25 +31,122 @@ app = FastAPI(
 
 @app.on_event('startup')
 async def startup():
-    cache.redis = await aioredis.create_redis_pool((config.REDIS_HOST, config.REDIS_PORT), minsize=10,
-                                                   maxsize=20, password=config.REDIS_AUTH)
+    cache.redis = await aioredis.create_redis_pool(
+        (config.REDIS_HOST, config.REDIS_PORT), minsize=config.REDIS_POOL_MINSIZE,
+        maxsize=config.REDIS_POOL_MAXSIZE, password=config.REDIS_AUTH,
+    )
+    cache.local = LocalCache(config.LOCAL_CACHE_MAXSIZE, config.LOCAL_CACHE_TTL)
+    app.state.invalidation_listener = asyncio.create_task(cache.listen_invalidation(cache.redis, cache.local))
     storage.es = AsyncElasticsearch(hosts=[f'{config.ELASTIC_HOST}:{config.ELASTIC_PORT}'])
+    etl_listeners = []
+    app.state.suggest_builder = None
+    if config.SUGGEST_ENABLED:
+        suggest_service.service = suggest_service.SuggestService(await storage.get_storage(), await cache.get_cache())
+        etl_listeners.append(suggest_service.service.refresh)
+        app.state.suggest_builder = asyncio.create_task(build_suggest_index())
+    # Уведомления ETL слушает каждый процесс API: его индекс подсказок обновляется только им самим,
+    # а Redis не хранит сообщений каналов, поэтому сброс кэша не поручается одному процессу.
+    # Сброс повторяется, но повторный не находит ключей и обходится одним обращением к Redis
+    app.state.etl_listener = asyncio.create_task(
+        cache.listen_etl(cache.redis, await cache.get_cache(), etl_listeners)
+    )
+    app.state.popularity_flusher = asyncio.create_task(
+        popularity.keep_flushing(await cache.get_cache(), config.POPULARITY_FLUSH_INTERVAL)
+    )
+    app.state.warmup = None
+    if config.WARMUP_ENABLED:
+        # Прогрев идет в фоне и не задерживает готовность API принимать запросы
+        app.state.warmup = asyncio.create_task(warm_up())
+
+
+async def build_suggest_index():
+    try:
+        await suggest_service.service.build()
+    except Exception as e:
+        # Подсказки будут пустыми, пока индекс не перестроится по уведомлению ETL о переиндексации
+        logging.warning('Не удалось построить индекс подсказок: %r', e)
+
+
+async def warm_up() -> int:
+    memory_cache = await cache.get_cache()
+    es_storage = await storage.get_storage()
+    return await Warmup(
+        FilmService(memory_cache, es_storage),
+        GenreService(memory_cache, es_storage),
+        PersonService(memory_cache, es_storage),
+        config.WARMUP_TIMEOUT_IN_SECONDS,
+        config.WARMUP_CONCURRENCY,
+    ).run_once()
 
 
 @app.on_event('shutdown')
 async def shutdown():
-    await cache.redis.close()
+    app.state.invalidation_listener.cancel()
+    app.state.etl_listener.cancel()
+    app.state.popularity_flusher.cancel()
+    if app.state.warmup:
+        app.state.warmup.cancel()
+    if app.state.suggest_builder:
+        app.state.suggest_builder.cancel()
+    try:
+        await popularity.flush(await cache.get_cache())
+    except Exception as e:
+        logging.warning('Не удалось записать рейтинг обращений: %r', e)
+    cache.redis.close()
+    await cache.redis.wait_closed()
     await storage.es.close()
+    metrics.process_stopped()
+
+
+app.add_middleware(ConditionalGetMiddleware)
+app.add_middleware(deadline.DeadlineMiddleware)
+app.add_middleware(timing.TimingMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+
+
+@app.get('/metrics', include_in_schema=False)
+async def prometheus_metrics() -> Response:
+    try:
+        es_storage = await storage.get_storage()
+        metrics.elastic_cache_stats = await es_storage.cache_stats(config.INDEX_NAMESPACES)
+    except Exception as e:
+        # Остальные метрики отдаем и без ElasticSearch, счетчики кэшей остаются прежними
+        logging.warning('Не удалось прочитать статистику кэшей ElasticSearch: %r', e)
+    return Response(content=generate_latest(metrics.exposed_registry()), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get('/health', include_in_schema=False)
+async def health() -> ORJSONResponse:
+    """
+    Состояние предохранителей ElasticSearch и Redis. При разомкнутом
+    предохранителе API работает, но отвечает теневыми копиями из кэша
+    """
+    backends = {name: item.as_dict() for name, item in breaker.breakers.items()}
+    degraded = any(backend['state'] != breaker.CLOSED for backend in backends.values())
+    return ORJSONResponse({'status': 'degraded' if degraded else 'ok', 'backends': backends})
 
 app.include_router(film.router, prefix='/api/v1/film', tags=['film'])
 app.include_router(genre.router, prefix='/api/v1/genre', tags=['genre'])
 app.include_router(person.router, prefix='/api/v1/person', tags=['person'])
+if config.SUGGEST_ENABLED:
+    app.include_router(suggest.router, prefix='/api/v1/suggest', tags=['suggest'])
 
 if __name__ == '__main__':
+    # Процессы API запускаются заново (spawn), а не копируются из этого процесса,
+    # поэтому каждый сам открывает свои пулы соединений в startup. При остановке
+    # процесс перестает принимать соединения, дожидается начатых запросов и только потом
+    # закрывает пулы в shutdown
+    workers = config.API_WORKERS or os.cpu_count()
+    if workers > 1:
+        if config.PROMETHEUS_MULTIPROC_DIR:
+            metrics.clear_multiprocess_dir()
+        else:
+            logging.warning('PROMETHEUS_MULTIPROC_DIR не задан, /metrics отдаст метрики только одного процесса API')
     uvicorn.run(
         'main:app',
         host='0.0.0.0',
         port=8000,
+        workers=workers,
         log_config=LOGGING,  # Этот параметр присутствовал в первоначальной версии файла но потом исчез
         log_level=logging.DEBUG,  # Этот параметр присутствовал в первоначальной версии файла но потом исчез
     )
@@ -1,6 +1,21 @@
+from typing import Type, TypeVar, Union
+
 import orjson
 from pydantic import BaseModel
 
+Model = TypeVar('Model', bound='OrjsonModel')
+
+
+def model_fields(obj):
+    """
+    default для orjson: модель сериализуется словарем своих полей.
+    Вложенные модели orjson передает сюда же, поэтому не нужен
+    dict() pydantic, который заново обходит и копирует все значения
+    """
+    if isinstance(obj, BaseModel):
+        return obj.__dict__
+    raise TypeError
+
 
 def orjson_dumps(v, *, default):
     """
@@ -15,3 +30,23 @@ class OrjsonModel(BaseModel):
     class Config:
         json_loads = orjson.loads
         json_dumps = orjson_dumps
+
+    def dumps(self) -> bytes:
+        """JSON модели для кэша и ответов API"""
+        return orjson.dumps(self, default=model_fields)
+
+    @classmethod
+    def trusted(cls: Type[Model], **values) -> Model:
+        """
+        Модель из уже проверенных данных: из своего индекса ElasticSearch,
+        кэша или других моделей. Создается без валидации pydantic, значения
+        не приводятся к типам полей, а лишние поля отбрасываются.
+        Данные от клиентов API по-прежнему проверяются валидацией
+        """
+        fields = cls.__fields__
+        return cls.construct(**{name: value for name, value in values.items() if name in fields})
+
+    @classmethod
+    def parse_trusted(cls: Type[Model], data: Union[str, bytes]) -> Model:
+        """Модель из JSON, записанного в кэш методом dumps()"""
+        return cls.trusted(**orjson.loads(data))
@@ -0,0 +1,12 @@
+from uuid import UUID
+
+from core.config import BATCH_MAX_SIZE
+from models._base import OrjsonModel
+from pydantic import conlist
+
+
+class BatchRequest(OrjsonModel):
+    """
+    Тело пакетного запроса - список идентификаторов сущностей
+    """
+    ids: conlist(UUID, min_items=1, max_items=BATCH_MAX_SIZE)
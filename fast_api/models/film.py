@@ -64,3 +64,12 @@ class FilmBrief(OrjsonModel):
     id: UUID
     title: str
     imdb_rating: Optional[float]
+
+
+class FilmBatchApi(OrjsonModel):
+    """
+        Ответ на пакетный запрос фильмов - найденные фильмы в порядке запроса
+        и идентификаторы, которых нет в базе.
+    """
+    items: List[FilmApi]
+    missing: List[UUID]
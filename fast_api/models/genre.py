@@ -11,6 +11,11 @@ class Genre_API(OrjsonModel):
     film_ids: List[str]
 
 
+class GenreBatch_API(OrjsonModel):
+    items: List[Genre_API]
+    missing: List[UUID]
+
+
 class GenreBrief_API(OrjsonModel):
     uuid: UUID
     name: str
@@ -0,0 +1,36 @@
+from typing import Iterator, List, Optional, Type
+
+import orjson
+from models._base import OrjsonModel, model_fields
+
+
+class Page:
+    """
+    Страница списка и курсор следующей страницы, если она есть.
+    Перебирается как список своих элементов
+    """
+
+    __slots__ = ('items', 'next_cursor')
+
+    def __init__(self, items: List, next_cursor: Optional[str] = None):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    def __iter__(self) -> Iterator:
+        return iter(self.items)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __bool__(self) -> bool:
+        return bool(self.items)
+
+    def dumps(self) -> bytes:
+        """Сериализация страницы для записи в кэш"""
+        return orjson.dumps({"items": self.items, "next": self.next_cursor}, default=model_fields)
+
+    @classmethod
+    def parse_raw(cls, data: bytes, model: Type[OrjsonModel]) -> 'Page':
+        """Разбор страницы, прочитанной из кэша, элементы - модели model"""
+        data = orjson.loads(data)
+        return cls([model.trusted(**item) for item in data["items"]], data["next"])
@@ -17,6 +17,16 @@ class PersonAPI(OrjsonModel):
     film_ids: List[str]
 
 
+class PersonBatchAPI(OrjsonModel):
+    """
+    Ответ на пакетный запрос - найденные люди в порядке запроса
+    и идентификаторы, которых нет в базе
+    """
+
+    items: List[PersonAPI]
+    missing: List[UUID]
+
+
 class PersonBriefAPI(OrjsonModel):
     """
     Сокращенная информация о человеке - возвращается при запросе
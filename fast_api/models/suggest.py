@@ -0,0 +1,14 @@
+from typing import List
+
+from models._base import OrjsonModel
+from models.film import FilmBriefApi, FilmPeopleApi
+
+
+class SuggestApi(OrjsonModel):
+    """
+        Подсказки для строки поиска - фильмы, в названии которых есть слово
+        с введенным началом, по убыванию рейтинга, и люди с таким словом
+        в имени, по убыванию числа фильмов.
+    """
+    films: List[FilmBriefApi]
+    persons: List[FilmPeopleApi]
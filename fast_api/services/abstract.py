@@ -1,14 +1,89 @@
+import asyncio
+import hashlib
+import logging
+import time
 from abc import ABC, abstractmethod
-from db.cache import MemoryCache
-from db.storage import AbstractStorage
+from contextvars import ContextVar
+from core import config, deadline, metrics, timing
+from db.cache import CacheWrites, MemoryCache, is_unavailable as cache_unavailable
+from db.entry import CacheEntry, pack_entry, pack_negative, unpack_entry
+from db.storage import AbstractStorage, is_unavailable as storage_unavailable
+from functools import partial
+from services import popularity
+from utils.response import CachedBody
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+
+class _Fallback:
+    """
+    Отметка загрузки значения. Если при загрузке пришлось отдать теневую копию,
+    отмечаются и все загрузки, внутри которых она выполнялась: их результат
+    собран из устаревших данных и не записывается в кэш как свежий
+    """
+
+    __slots__ = ('parent', 'used')
+
+    def __init__(self, parent: Optional['_Fallback']):
+        self.parent = parent
+        self.used = False
+
+    def mark(self):
+        fallback = self
+        while fallback is not None:
+            fallback.used = True
+            fallback = fallback.parent
+
+
+class _Freshness:
+    """
+    Самое раннее время мягкого истечения значений из кэша, из которых собран ответ.
+    После него ответ устарел, и клиенты не должны хранить его дольше
+    """
+
+    __slots__ = ('expire_at',)
+
+    def __init__(self):
+        self.expire_at = float('inf')
+
+    def saw(self, entry: CacheEntry):
+        self.expire_at = min(self.expire_at, entry.soft_expire_at)
+
+
+_fallback: ContextVar[Optional[_Fallback]] = ContextVar('fallback', default=None)
+_freshness: ContextVar[Optional[_Freshness]] = ContextVar('freshness', default=None)
+# Записи в кэш текущей загрузки. Загрузки внутри нее (данные для готового ответа)
+# дописывают к ним свои, и все они выполняются одним обращением к кэшу
+_writes: ContextVar[Optional[CacheWrites]] = ContextVar('writes', default=None)
+# Загрузка идет под блокировкой своего ключа, вложенным загрузкам своя блокировка не нужна
+_leased: ContextVar[bool] = ContextVar('leased', default=False)
 
 
 class AbstractService(ABC):
 
-    CACHE_EXPIRE_IN_SECONDS = 60 * 5  # 5 минут
+    CACHE_EXPIRE_IN_SECONDS = config.CACHE_EXPIRE_IN_SECONDS
+    # Версия формата закэшированных данных. Увеличивается при изменении моделей
+    CACHE_SCHEMA_VERSION = 2
+    # Сколько еще после мягкого истечения значение отдается, пока обновляется в фоне
+    CACHE_STALE_IN_SECONDS = 60 * 60  # 1 час
+    # Пустые результаты кэшируются ненадолго, чтобы повторные запросы без совпадений не доходили до ES
+    NEGATIVE_CACHE_EXPIRE_IN_SECONDS = config.NEGATIVE_CACHE_EXPIRE_IN_SECONDS
+    # Коэффициент вероятностного досрочного обновления, 0 - отключает его
+    XFETCH_BETA = 1.0
+    # Время жизни блокировки, под которой один экземпляр API обновляет ключ
+    LEASE_EXPIRE_IN_MILLISECONDS = 3000
+    # Сколько остальные экземпляры ждут появления значения в кэше и как часто проверяют
+    LEASE_WAIT_IN_SECONDS = 0.5
+    LEASE_POLL_IN_SECONDS = 0.05
 
     name = None
 
+    # Загрузки, выполняющиеся в этом процессе, общие для всех экземпляров сервисов
+    _in_flight: Dict[Tuple[str, str], asyncio.Future] = {}
+    # Фоновые обновления, на которые нужно держать ссылки до их завершения
+    _refreshing: Set[asyncio.Future] = set()
+
     def __init__(self, cache: MemoryCache, storage: AbstractStorage):
         self.cache = cache
         self.storage = storage
@@ -21,7 +96,446 @@ class AbstractService(ABC):
     def get_list(self):
         pass
 
-    def _get_key(self, *args):
-        key = (self.name, args)
-        return str(key)
+    def _get_entity_key(self, entity_id) -> str:
+        return f'{self.name}:v{self.CACHE_SCHEMA_VERSION}:{entity_id}'
+
+    async def _get_list_key(self, *args) -> Optional[str]:
+        """
+        Ключ страницы списка: пространство имен, версия формата, поколение
+        и короткий хэш параметров запроса. None, если Redis недоступен
+        """
+        try:
+            generation = await self.cache.get_generation(self.name)
+        except Exception as e:
+            if not cache_unavailable(e):
+                raise
+            return None
+        digest = hashlib.blake2b(repr(args).encode(), digest_size=12).hexdigest()
+        return f'{self.name}:v{self.CACHE_SCHEMA_VERSION}:g{generation}:{digest}'
+
+    def _entity_tags(self, entity) -> List[str]:
+        """Ключ сущности зависит только от нее самой"""
+        return [f'{self.name}:{entity.uuid}'] if entity else []
+
+    def _list_tags(self, items: Iterable, depends_on: Optional[str] = None) -> List[str]:
+        """
+        Страница списка зависит от всех вошедших в нее сущностей и от фильтра.
+        Без фильтра она зависит от всей коллекции, так как в нее могут попасть новые записи
+        """
+        return [f'{self.name}:{item.id}' for item in items] + [depends_on or self.name]
+
+    async def get_response(
+            self,
+            endpoint: str,
+            params: tuple,
+            render: Callable[[], Awaitable[Optional[CachedBody]]],
+            entity_id: Optional[str] = None,
+            depends_on: Optional[str] = None,
+            cacheable: bool = True,
+    ) -> CachedBody:
+        """
+        Получить готовое тело ответа эндпоинта вместе с его ETag. При попадании в кэш
+        не строится ни одна модель, байты отдаются как есть.
+        Ответ по сущности зависит от нее, ответ со списком - от всей коллекции и фильтра.
+        В рейтинг обращений попадают только найденные сущности.
+        max_age тела - сколько еще ответ свежий: 0, если он собран из устаревших значений
+        или теневых копий
+        """
+        fallback = _Fallback(_fallback.get())
+        freshness = _Freshness()
+        fallback_token = _fallback.set(fallback)
+        freshness_token = _freshness.set(freshness)
+        try:
+            body = await self._get_response(endpoint, params, render, entity_id, depends_on, cacheable)
+        finally:
+            _freshness.reset(freshness_token)
+            _fallback.reset(fallback_token)
+        if entity_id and body:
+            popularity.record(self.name, entity_id)
+        if not body:
+            return body
+        if fallback.used:
+            max_age = 0
+        elif freshness.expire_at == float('inf'):
+            return body
+        else:
+            max_age = max(0, int(freshness.expire_at - time.time()))
+        return CachedBody(body.etag, body.body, body.next_cursor, max_age)
+
+    async def _get_response(
+            self,
+            endpoint: str,
+            params: tuple,
+            render: Callable[[], Awaitable[Optional[CachedBody]]],
+            entity_id: Optional[str],
+            depends_on: Optional[str],
+            cacheable: bool,
+    ) -> CachedBody:
+        if not config.RESPONSE_CACHE_ENABLED or not cacheable:
+            body = await render() or CachedBody('', b'')
+        else:
+            if entity_id:
+                tags = [f'{self.name}:{entity_id}']
+            else:
+                tags = [self.name] + ([depends_on] if depends_on else [])
+            body = await self._get_or_load(
+                await self._get_list_key(endpoint, *params),
+                render,
+                CachedBody.loads,
+                CachedBody.dumps,
+                lambda _: tags,
+                layer='response',
+                # Ответ при недоступном хранилище собирается из теневых копий данных, своя ему не нужна
+                shadow_expire=None,
+            )
+        return body
+
+    async def _get_or_load(
+            self,
+            key: Optional[str],
+            load: Callable[[], Awaitable[Any]],
+            loads: Callable[[bytes], Any],
+            dumps: Callable[[Any], Union[str, bytes]],
+            tags: Optional[Callable[[Any], Iterable[str]]] = None,
+            layer: str = 'data',
+            shadow_expire: Optional[int] = config.SHADOW_CACHE_EXPIRE_IN_SECONDS,
+    ) -> Any:
+        """
+        Получить значение из кэша, а при промахе загрузить его функцией load
+        и сохранить в кэш. Устаревшие значения отдаются сразу, а обновляются в фоне.
+        Функция tags возвращает теги, по которым ключ будет сброшен при изменении данных.
+        layer - метка уровня кэша в метриках: данные или готовые ответы.
+        shadow_expire - время жизни теневой копии значения, None - копия не нужна.
+        Если Redis недоступен, значение загружается из хранилища и никуда не записывается
+        """
+        if key is None:
+            return await load()
+        try:
+            entry = await self._get_entry(key, loads)
+        except Exception as e:
+            metrics.CACHE_REQUESTS.labels(self.name, layer, 'error').inc()
+            if not cache_unavailable(e):
+                raise
+            return await load()
+        if entry is not None:
+            stale = entry.is_stale()
+            metrics.CACHE_REQUESTS.labels(self.name, layer, 'stale' if stale else 'hit').inc()
+            self._saw(entry)
+            if stale or entry.should_refresh(self.XFETCH_BETA):
+                self._refresh_in_background(key, load, loads, dumps, tags, shadow_expire)
+            return entry.value
+        metrics.CACHE_REQUESTS.labels(self.name, layer, 'miss').inc()
+        return await self._load_once(key, load, loads, dumps, tags, shadow_expire)
+
+    async def _get_many_or_load(
+            self,
+            ids: List[str],
+            load: Callable[[str], Awaitable[Any]],
+            load_many: Callable[[List[str]], Awaitable[Dict[str, Any]]],
+            loads: Callable[[bytes], Any],
+            dumps: Callable[[Any], Union[str, bytes]],
+    ) -> List[Optional[Any]]:
+        """
+        Получить несколько сущностей: найденные в кэше читаются одним запросом,
+        остальные загружаются одним запросом к хранилищу и записываются в кэш.
+        Порядок результата совпадает с ids, для ненайденных сущностей - None
+        """
+        unique_ids = list(dict.fromkeys(ids))
+        keys = [self._get_entity_key(entity_id) for entity_id in unique_ids]
+        try:
+            entries = await self.cache.get_models_many(
+                keys, partial(unpack_entry, loads=timing.measured('parse', loads))
+            )
+        except Exception as e:
+            metrics.CACHE_REQUESTS.labels(self.name, 'data', 'error').inc(len(keys))
+            if not cache_unavailable(e):
+                raise
+            loaded = await load_many(unique_ids)
+            return [loaded.get(entity_id) for entity_id in ids]
+        found = {}
+        missing = []
+        for entity_id, key, entry in zip(unique_ids, keys, entries):
+            if entry is None:
+                missing.append(entity_id)
+                continue
+            stale = entry.is_stale()
+            metrics.CACHE_REQUESTS.labels(self.name, 'data', 'stale' if stale else 'hit').inc()
+            self._saw(entry)
+            if not entry.value:
+                # Сущности нет в хранилище, это уже известно по отрицательной записи
+                continue
+            found[entity_id] = entry.value
+            if stale or entry.should_refresh(self.XFETCH_BETA):
+                self._refresh_in_background(key, partial(load, entity_id), loads, dumps, self._entity_tags,
+                                            config.SHADOW_CACHE_EXPIRE_IN_SECONDS)
+        if missing:
+            metrics.CACHE_REQUESTS.labels(self.name, 'data', 'miss').inc(len(missing))
+            started = time.monotonic()
+            try:
+                loaded = await load_many(missing)
+            except Exception as e:
+                if not storage_unavailable(e):
+                    raise
+                shadows = await self._get_many_shadows([self._get_entity_key(entity_id) for entity_id in missing],
+                                                       loads, e)
+                found.update({entity_id: shadows[self._get_entity_key(entity_id)] for entity_id in missing})
+                return [found.get(entity_id) for entity_id in ids]
+            delta = time.monotonic() - started
+            outer = _writes.get()
+            writes = outer if outer is not None else CacheWrites()
+            for entity_id, entity in loaded.items():
+                key = self._get_entity_key(entity_id)
+                with timing.span('serialize'):
+                    data = dumps(entity)
+                self._put_value(writes, key, data, delta, config.SHADOW_CACHE_EXPIRE_IN_SECONDS)
+                writes.tag(key, self._entity_tags(entity), self.CACHE_EXPIRE_IN_SECONDS + self.CACHE_STALE_IN_SECONDS)
+            # Отсутствующие в хранилище сущности кэшируются ненадолго, как и при одиночном запросе
+            for entity_id in missing:
+                if entity_id not in loaded:
+                    self._put_negative(writes, self._get_entity_key(entity_id))
+            if outer is None:
+                await self._write(writes)
+            found.update(loaded)
+        return [found.get(entity_id) for entity_id in ids]
+
+    @staticmethod
+    def _saw(entry: CacheEntry):
+        freshness = _freshness.get()
+        if freshness is not None:
+            freshness.saw(entry)
+
+    async def _get_entry(self, key: str, loads: Callable[[bytes], Any]) -> Optional[CacheEntry]:
+        return await self.cache.get_model(key, partial(unpack_entry, loads=timing.measured('parse', loads)))
+
+    async def _write(self, writes: CacheWrites):
+        """Записать загруженные значения в кэш. Хранилище уже ответило, поэтому сбой Redis запрос не прерывает"""
+        try:
+            await self.cache.write(writes)
+        except Exception as e:
+            if not cache_unavailable(e):
+                raise
+            logger.debug('Значения не записаны в кэш: %r', e)
+
+    def _put_value(self, writes: CacheWrites, key: str, data: Union[str, bytes], delta: float,
+                   shadow_expire: Optional[int]):
+        soft_expire_at = time.time() + self.CACHE_EXPIRE_IN_SECONDS
+        packed = pack_entry(data, soft_expire_at, delta)
+        writes.set(key, packed, self.CACHE_EXPIRE_IN_SECONDS + self.CACHE_STALE_IN_SECONDS)
+        if shadow_expire:
+            writes.set_shadow(key, packed, shadow_expire)
+
+    async def _get_shadow(self, key: str, loads: Callable[[bytes], Any], error: Exception) -> Any:
+        """
+        Последнее известное значение ключа, когда хранилище недоступно.
+        Если копии нет, поднимается исходная ошибка хранилища
+        """
+        return (await self._get_many_shadows([key], loads, error))[key]
+
+    async def _get_many_shadows(self, keys: List[str], loads: Callable[[bytes], Any],
+                                error: Exception) -> Dict[str, Any]:
+        try:
+            raws = await self.cache.get_shadows(keys)
+        except Exception:
+            raise error
+        if not all(raws):
+            metrics.CACHE_REQUESTS.labels(self.name, 'shadow', 'miss').inc()
+            raise error
+        metrics.CACHE_REQUESTS.labels(self.name, 'shadow', 'hit').inc(len(keys))
+        fallback = _fallback.get()
+        if fallback is not None:
+            fallback.mark()
+        logger.debug('Хранилище недоступно (%r), отдаются теневые копии %d ключей', error, len(keys))
+        with timing.span('parse'):
+            return {key: unpack_entry(raw, loads).value for key, raw in zip(keys, raws)}
+
+    def _put_negative(self, writes: CacheWrites, key: str):
+        soft_expire_at = time.time() + self.NEGATIVE_CACHE_EXPIRE_IN_SECONDS
+        writes.set(key, pack_negative(soft_expire_at), self.NEGATIVE_CACHE_EXPIRE_IN_SECONDS)
+
+    async def _load_and_store(
+            self,
+            key: str,
+            load: Callable[[], Awaitable[Any]],
+            loads: Callable[[bytes], Any],
+            dumps: Callable[[Any], Union[str, bytes]],
+            tags: Optional[Callable[[Any], Iterable[str]]] = None,
+            shadow_expire: Optional[int] = None,
+    ) -> Tuple[Any, bool]:
+        """
+        Загрузить значение и записать его в кэш. Вместе со значением возвращается
+        отметка, что оно собрано из теневых копий: загрузку разделяют запросы
+        с разными контекстами, и каждый должен узнать о ней сам
+        """
+        started = time.monotonic()
+        fallback = _Fallback(_fallback.get())
+        outer = _writes.get()
+        writes = outer if outer is not None else CacheWrites()
+        fallback_token = _fallback.set(fallback)
+        writes_token = _writes.set(writes)
+        try:
+            value = await load()
+        except Exception as e:
+            if not storage_unavailable(e):
+                raise
+            value = await self._get_shadow(key, loads, e)
+        finally:
+            _writes.reset(writes_token)
+            _fallback.reset(fallback_token)
+        if fallback.used:
+            return value, True
+        if value:
+            with timing.span('serialize'):
+                data = dumps(value)
+            self._put_value(writes, key, data, time.monotonic() - started, shadow_expire)
+        else:
+            value = []
+            self._put_negative(writes, key)
+        if tags:
+            # Время жизни набора тегов не сокращаем, в нем могут быть и долгоживущие ключи
+            writes.tag(key, tags(value), self.CACHE_EXPIRE_IN_SECONDS + self.CACHE_STALE_IN_SECONDS)
+        if outer is None:
+            await self._write(writes)
+        return value, False
+
+    def _load_once(
+            self,
+            key: str,
+            load: Callable[[], Awaitable[Any]],
+            loads: Callable[[bytes], Any],
+            dumps: Callable[[Any], Union[str, bytes]],
+            tags: Optional[Callable[[Any], Iterable[str]]] = None,
+            shadow_expire: Optional[int] = None,
+    ) -> Awaitable[Any]:
+        return self._single_flight(
+            key,
+            partial(self._load_and_store, key, load, loads, dumps, tags, shadow_expire),
+            partial(self._get_entry, key, loads),
+        )
+
+    def _refresh_in_background(
+            self,
+            key: str,
+            load: Callable[[], Awaitable[Any]],
+            loads: Callable[[bytes], Any],
+            dumps: Callable[[Any], Union[str, bytes]],
+            tags: Optional[Callable[[Any], Iterable[str]]] = None,
+            shadow_expire: Optional[int] = None,
+    ):
+        if (self.name, key) in self._in_flight:
+            return
+        # Обновление переживает запрос, который его запустил, поэтому у него свой срок
+        task = deadline.detached(self._refresh(key, load, loads, dumps, tags, shadow_expire),
+                                 config.REQUEST_TIMEOUT_IN_SECONDS)
+        self._refreshing.add(task)
+        task.add_done_callback(self._refresh_done)
+
+    async def _refresh(
+            self,
+            key: str,
+            load: Callable[[], Awaitable[Any]],
+            loads: Callable[[bytes], Any],
+            dumps: Callable[[Any], Union[str, bytes]],
+            tags: Optional[Callable[[Any], Iterable[str]]] = None,
+            shadow_expire: Optional[int] = None,
+    ) -> Any:
+        # Обновление может начаться внутри загрузки другого ключа, но пишет в кэш и берет блокировку само:
+        # та загрузка к его окончанию уже завершится. Теневая копия в обновлении не касается ответа запроса
+        _writes.set(None)
+        _leased.set(False)
+        _fallback.set(None)
+        _freshness.set(None)
+        return await self._load_once(key, load, loads, dumps, tags, shadow_expire)
+
+    def _refresh_done(self, task: asyncio.Future):
+        self._refreshing.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning('Фоновое обновление кэша завершилось ошибкой: %r', task.exception())
+
+    def _flight_done(self, flight_key: Tuple[str, str], task: asyncio.Future):
+        self._in_flight.pop(flight_key, None)
+        # Все ожидавшие запросы могли уже завершиться по своему сроку, тогда ошибку загрузки никто не заберет
+        if not task.cancelled():
+            task.exception()
+
+    async def _single_flight(
+            self,
+            key: str,
+            load: Callable[[], Awaitable[Tuple[Any, bool]]],
+            read_cache: Callable[[], Awaitable[Optional[CacheEntry]]],
+    ) -> Any:
+        """
+        Выполнить загрузку значения при промахе кэша так, чтобы одновременные
+        запросы одного ключа в процессе разделили один вызов хранилища.
+        Если загрузка отдала теневую копию, это отмечается у каждого ожидавшего ее запроса
+        """
+        flight_key = (self.name, key)
+        task = self._in_flight.get(flight_key)
+        if task is None:
+            # Загрузку ждут запросы с разными сроками, поэтому у нее свой срок: срок запроса
+            # по умолчанию или оставшееся время запустившего ее запроса, если оно больше
+            timeout = max(config.REQUEST_TIMEOUT_IN_SECONDS, deadline.remaining() or 0)
+            task = deadline.detached(self._load_under_lease(key, load, read_cache), timeout)
+            self._in_flight[flight_key] = task
+            task.add_done_callback(lambda _: self._flight_done(flight_key, task))
+        # Отмена одного из ожидающих запросов или истечение его срока не прерывает общую загрузку
+        value, used_fallback = await deadline.bounded(asyncio.shield(task))
+        fallback = _fallback.get()
+        if used_fallback and fallback is not None:
+            fallback.mark()
+        return value
+
+    async def _load_under_lease(
+            self,
+            key: str,
+            load: Callable[[], Awaitable[Tuple[Any, bool]]],
+            read_cache: Callable[[], Awaitable[Optional[CacheEntry]]],
+    ) -> Tuple[Any, bool]:
+        """
+        Загрузить значение, если удалось захватить блокировку в Redis.
+        Иначе недолго подождать, пока значение запишет другой экземпляр API.
+        Внутри загрузки под блокировкой (данные для готового ответа) блокировка не берется:
+        одновременные запросы ждут внешнюю загрузку.
+        Блокировка нужна только для экономии обращений к хранилищу: если Redis недоступен,
+        значение загружается без нее
+        """
+        if _leased.get():
+            return await load()
+        lease_key = f'lease:{key}'
+        try:
+            token = await self.cache.acquire_lock(lease_key, self.LEASE_EXPIRE_IN_MILLISECONDS)
+        except Exception as e:
+            if not cache_unavailable(e):
+                raise
+            return await self._load_leased(load)
+        if token is None:
+            loop = asyncio.get_event_loop()
+            wait_until = loop.time() + self.LEASE_WAIT_IN_SECONDS
+            try:
+                while loop.time() < wait_until:
+                    await asyncio.sleep(self.LEASE_POLL_IN_SECONDS)
+                    # Отрицательная запись - тоже ответ владельца блокировки: в хранилище ничего нет
+                    entry = await read_cache()
+                    if entry is not None:
+                        return entry.value, False
+            except Exception as e:
+                if not cache_unavailable(e):
+                    raise
+            # Владелец блокировки не успел, загружаем сами
+            return await load()
+        try:
+            return await self._load_leased(load)
+        finally:
+            try:
+                await self.cache.release_lock(lease_key, token)
+            except Exception as e:
+                # Блокировка истечет сама
+                if not cache_unavailable(e):
+                    raise
 
+    @staticmethod
+    async def _load_leased(load: Callable[[], Awaitable[Tuple[Any, bool]]]) -> Tuple[Any, bool]:
+        leased_token = _leased.set(True)
+        try:
+            return await load()
+        finally:
+            _leased.reset(leased_token)
@@ -1,12 +1,15 @@
-from functools import lru_cache
-from typing import List, Optional
+from functools import lru_cache, partial
+from typing import AsyncIterator, Dict, List, Optional
 from uuid import UUID
 
-import orjson
+from core import config, timing
 from db.cache import MemoryCache, get_cache
+from db.cursor import Cursor
+from db.query import DocValue, SearchQuery
 from db.storage import AbstractStorage, get_storage
 from fastapi import Depends
 from models.film import Film, FilmBrief
+from models.page import Page
 from services.abstract import AbstractService
 
 
@@ -15,48 +18,65 @@ class FilmService(AbstractService):
     FilmService содержит бизнес-логику по работе с фильмами.
     """
 
+    ES_FIELDS = [
+        "id",
+        "title",
+        "imdb_rating",
+        "description",
+        "genres",
+        "actors",
+        "writers",
+    ]
+    LIST_FIELDS = ["id", "title", "imdb_rating"]
+    # Поля краткой информации о фильме в doc values. Рейтинг хранится в них
+    # с одинарной точностью, формат убирает появившиеся при этом лишние знаки
+    LIST_DOCVALUES = [
+        DocValue("id", "id"),
+        DocValue("title.raw", "title"),
+        DocValue("imdb_rating", "imdb_rating", "0.0###", float),
+    ]
+
     def __init__(self, *args, **kwargs):
         self.name = "film"
         super().__init__(*args, **kwargs)
 
     async def get_by_id(self, film_id: str) -> Optional[Film]:
+        return await self._get_or_load(
+            self._get_entity_key(film_id),
+            partial(self._get_from_storage, film_id),
+            Film.parse_trusted,
+            Film.dumps,
+            self._entity_tags,
+        )
 
-        film = await self._get_from_cache(film_id)
-        if not film:
-            film = await self._get_from_storage(film_id)
-            if not film:
-                return []
-            # Сохраняем фильм в кеш
-            await self._put_to_cache(film)
-        return film
+    async def get_many(self, film_ids: List[str]) -> List[Optional[Film]]:
+        return await self._get_many_or_load(
+            film_ids,
+            self._get_from_storage,
+            self._get_many_from_storage,
+            Film.parse_trusted,
+            Film.dumps,
+        )
 
     async def _get_from_storage(self, film_id: str) -> Optional[Film]:
-
-        es_fields = [
-            "id",
-            "title",
-            "imdb_rating",
-            "description",
-            "genres",
-            "actors",
-            "writers",
-        ]
-        doc = await self.storage.get("movies", film_id, es_fields)
-        film_info = doc.get("_source")
+        doc = await self.storage.get("movies", film_id, self.ES_FIELDS)
+        with timing.span("model"):
+            return self._make_film(doc.get("_source"))
+
+    async def _get_many_from_storage(self, film_ids: List[str]) -> Dict[str, Film]:
+        doc = await self.storage.get_many("movies", film_ids, self.ES_FIELDS)
+        with timing.span("model"):
+            return {
+                film["_id"]: self._make_film(film["_source"])
+                for film in doc.get("docs")
+                if film.get("found")
+            }
+
+    @staticmethod
+    def _make_film(film_info: dict) -> Film:
         film_info["uuid"] = film_info["id"]
         film_info.pop("id")
-        return Film(**film_info)
-
-    async def _get_from_cache(self, film_id: str) -> Optional[Film]:
-        data = await self.cache.get(film_id)
-        if not data:
-            return []
-        return Film.parse_raw(data)
-
-    async def _put_to_cache(self, film: Film):
-        await self.cache.set(
-            str(film.uuid), film.json(), expire=self.CACHE_EXPIRE_IN_SECONDS
-        )
+        return Film.trusted(**film_info)
 
     async def get_list(
         self,
@@ -65,20 +85,29 @@ class FilmService(AbstractService):
         page_size: int,
         page_number: int,
         query: Optional[str] = "",
-    ) -> List[FilmBrief]:
-        films = await self._get_list_from_cache(
-            filter_genre, sort, page_size, page_number, query
+        cursor: Optional[Cursor] = None,
+    ) -> Page:
+        load = partial(
+            self._get_list_from_storage,
+            filter_genre, sort, page_size, page_number, query, cursor
+        )
+        if cursor and cursor.consistent:
+            # Страницы согласованного обхода нужны только одному клиенту
+            return await load()
+        return await self._get_or_load(
+            await self._get_list_key(
+                filter_genre, sort, page_size, page_number, query,
+                cursor.search_after if cursor else None,
+            ),
+            load,
+            self._parse_list,
+            self._dump_list,
+            partial(
+                self._list_tags,
+                depends_on=f"genre:{filter_genre}" if filter_genre else None,
+            ),
+            shadow_expire=config.SHADOW_LIST_CACHE_EXPIRE_IN_SECONDS,
         )
-        if not films:
-            films = await self._get_list_from_storage(
-                filter_genre, sort, page_size, page_number, query
-            )
-            if not films:
-                return []
-            await self._put_list_to_cache(
-                films, filter_genre, sort, page_size, page_number, query
-            )
-        return films
 
     async def _get_list_from_storage(
         self,
@@ -87,82 +116,88 @@ class FilmService(AbstractService):
         page_size: Optional[int],
         page_number: Optional[int],
         query: Optional[str],
-    ) -> List[FilmBrief]:
-        sort_order, sort_column = None, None
-        if sort:
-            sort_order, sort_column = sort[0], sort[1:]
-            sort_order = "desc" if sort_order == "-" else "asc"
-        es_fields = ["id", "title", "imdb_rating"]
-        search_query = await self.storage.make_search_query(
-            "movies",
-            "genres",
-            "id",
-            filter_genre,
-            sort_column,
-            sort_order,
-            page_size,
-            page_number,
-            query,
-            "title",
+        cursor: Optional[Cursor] = None,
+    ) -> Page:
+        films_info, next_cursor = await self.storage.search_page(
+            "movies", self._list_query(filter_genre, sort, query), self.LIST_FIELDS, page_size, page_number, cursor,
+            self.LIST_DOCVALUES if config.ELASTIC_LIST_DOCVALUES else None,
         )
-        doc = await self.storage.search("movies", search_query, es_fields)
-        films_info = doc.get("hits").get("hits")
-        return [FilmBrief(**film.get("_source")) for film in films_info]
+        with timing.span("model"):
+            films = [FilmBrief.trusted(**film.get("_source")) for film in films_info]
+        return Page(films, next_cursor.encode() if next_cursor else None)
 
-    async def _get_list_from_cache(
+    async def stream_list(
         self,
         filter_genre: Optional[UUID],
-        sort: Optional[str],
-        page_size: int,
-        page_number: int,
-        query: Optional[str],
-    ) -> Optional[FilmBrief]:
-        key = self._get_key(filter_genre, sort, page_size, page_number, query)
-        data = await self.cache.get(key)
-        if not data:
-            return []
-        return [FilmBrief(**film) for film in orjson.loads(data)]
-
-    async def _put_list_to_cache(
-        self,
-        films: List[FilmBrief],
-        filter_genre: Optional[UUID],
-        sort: Optional[str],
+        sort: str,
         page_size: int,
         page_number: int,
-        query: Optional[str],
-    ):
-        key = self._get_key(filter_genre, sort, page_size, page_number, query)
-        json = "[{}]".format(",".join(film.json() for film in films))
-        await self.cache.set(key, json, self.CACHE_EXPIRE_IN_SECONDS)
+        query: Optional[str] = "",
+        cursor: Optional[Cursor] = None,
+    ) -> AsyncIterator[List[FilmBrief]]:
+        """
+        Список фильмов частями по мере чтения из ElasticSearch, для потоковых ответов.
+        Выгрузки почти не повторяются, поэтому кэш не используется
+        """
+        async for films_info in self.storage.scan(
+            "movies", self._list_query(filter_genre, sort, query), self.LIST_FIELDS, page_size,
+            (page_number - 1) * page_size, cursor, self.LIST_DOCVALUES if config.ELASTIC_LIST_DOCVALUES else None,
+        ):
+            with timing.span("model"):
+                films = [FilmBrief.trusted(**film["_source"]) for film in films_info]
+            yield films
+
+    @staticmethod
+    def _list_query(filter_genre: Optional[UUID], sort: Optional[str], query: Optional[str]) -> SearchQuery:
+        search_query = SearchQuery()
+        if query:
+            search_query.match("title", query)
+        if filter_genre:
+            search_query.nested_term("genres", "genres.id", filter_genre)
+        if sort:
+            sort_order, sort_column = sort[0], sort[1:]
+            search_query.sort(sort_column, "desc" if sort_order == "-" else "asc")
+        return search_query
+
+    @staticmethod
+    def _parse_list(data: bytes) -> Page:
+        return Page.parse_raw(data, FilmBrief)
+
+    @staticmethod
+    def _dump_list(films: Page) -> bytes:
+        return films.dumps()
 
     async def search(
         self,
         query: Optional[str],
         page_size: int,
         page_number: int,
-    ) -> Optional[FilmBrief]:
-
-        films = await self._get_list_from_cache(
-            None, None, page_size, page_number, query
+        cursor: Optional[Cursor] = None,
+    ) -> Page:
+        load = partial(self._search_in_storage, query, page_size, page_number, cursor)
+        if cursor and cursor.consistent:
+            return await load()
+        return await self._get_or_load(
+            await self._get_list_key(
+                None, None, page_size, page_number, query,
+                cursor.search_after if cursor else None,
+            ),
+            load,
+            self._parse_list,
+            self._dump_list,
+            self._list_tags,
+            shadow_expire=config.SHADOW_LIST_CACHE_EXPIRE_IN_SECONDS,
         )
-        if not films:
-            films = await self._search_in_storage(query, page_size, page_number)
-            if not films:
-                return []
-            await self._put_list_to_cache(
-                films, None, None, page_size, page_number, query
-            )
-        return films
 
     async def _search_in_storage(
         self,
         query: Optional[str],
         page_size: Optional[int],
         page_number: Optional[int],
-    ) -> Optional[FilmBrief]:
+        cursor: Optional[Cursor] = None,
+    ) -> Page:
         return await self._get_list_from_storage(
-            None, "", page_size, page_number, query
+            None, "", page_size, page_number, query, cursor
         )
 
 
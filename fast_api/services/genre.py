@@ -1,12 +1,14 @@
-import orjson
-
+from core import config, timing
 from db.cache import MemoryCache, get_cache
+from db.cursor import Cursor
+from db.query import SearchQuery
 from db.storage import AbstractStorage, get_storage
 from fastapi import Depends
-from functools import lru_cache
+from functools import lru_cache, partial
 from models.genre import Genre, GenreBrief
+from models.page import Page
 from services.abstract import AbstractService
-from typing import List, Optional
+from typing import AsyncIterator, Dict, List, Optional
 from uuid import UUID
 
 
@@ -15,115 +17,123 @@ class GenreService(AbstractService):
     Сервис для получения жанра по идентификатору, или всех жанров фильма
     """
 
+    ES_FIELDS = ["id", "name", "description", "films"]
+    LIST_FIELDS = ["id", "name", "description"]
+
     def __init__(self, *args, **kwargs):
         self.name = 'genre'
         super(GenreService, self).__init__(*args, **kwargs)
 
     async def get_by_id(self, genre_id: str) -> Optional[Genre]:
-        genre = await self._get_from_cache(genre_id)
-        if not genre:
-            genre = await self._get_from_storage(genre_id)
-            if not genre:
-                return []
-            # Сохраняем фильм в кеш
-            await self._put_to_cache(genre)
-        return genre
+        return await self._get_or_load(
+            self._get_entity_key(genre_id),
+            partial(self._get_from_storage, genre_id),
+            Genre.parse_trusted,
+            Genre.dumps,
+            self._entity_tags
+        )
+
+    async def get_many(self, genre_ids: List[str]) -> List[Optional[Genre]]:
+        return await self._get_many_or_load(
+            genre_ids,
+            self._get_from_storage,
+            self._get_many_from_storage,
+            Genre.parse_trusted,
+            Genre.dumps
+        )
 
     async def _get_from_storage(self, genre_id: str) -> Optional[Genre]:
-        es_fields = ["id", "name", "description", "films"]
-        doc = await self.storage.get('genres', genre_id, es_fields)
-        genre_info = doc.get("_source")
+        doc = await self.storage.get('genres', genre_id, self.ES_FIELDS)
+        with timing.span('model'):
+            return self._make_genre(doc.get("_source"))
+
+    async def _get_many_from_storage(self, genre_ids: List[str]) -> Dict[str, Genre]:
+        doc = await self.storage.get_many('genres', genre_ids, self.ES_FIELDS)
+        with timing.span('model'):
+            return {genre["_id"]: self._make_genre(genre["_source"]) for genre in doc.get("docs") if genre.get("found")}
+
+    @staticmethod
+    def _make_genre(genre_info: dict) -> Genre:
         # Спецификация API требует, чтобы поле идентификатора называлось UUID
         genre_info["uuid"] = genre_info["id"]
         genre_info.pop("id")
-        return Genre(**genre_info)
-
-    async def _get_from_cache(self, genre_id: str) -> Optional[Genre]:
-        data = await self.cache.get(genre_id)
-        if not data:
-            return []
-        return Genre.parse_raw(data)
-
-    async def _put_to_cache(self, genre: Genre):
-        await self.cache.set(str(genre.uuid), genre.json(), self.CACHE_EXPIRE_IN_SECONDS)
+        return Genre.trusted(**genre_info)
 
     async def get_list(
             self, film_uuid: Optional[UUID],
             sort: str,
             page_size: int,
-            page_number: int
-    ) -> List[GenreBrief]:
+            page_number: int,
+            cursor: Optional[Cursor] = None
+    ) -> Page:
         """
             Получить список жанров, относящихся к определенному
             фильму (если фильм задан, иначе всех жанров).
         """
-        genres = await self._get_list_from_cache(film_uuid, sort, page_size, page_number)
-        if not genres:
-            genres = await self._get_list_from_storage(film_uuid, sort, page_size, page_number)
-            if not genres:
-                return []
-            await self._put_list_to_cache(genres, film_uuid, sort, page_size, page_number)
-        return genres
+        load = partial(self._get_list_from_storage, film_uuid, sort, page_size, page_number, cursor)
+        if cursor and cursor.consistent:
+            # Страницы согласованного обхода нужны только одному клиенту
+            return await load()
+        return await self._get_or_load(
+            await self._get_list_key(film_uuid, sort, page_size, page_number, cursor.search_after if cursor else None),
+            load,
+            self._parse_list,
+            self._dump_list,
+            partial(self._list_tags, depends_on=f"film:{film_uuid}" if film_uuid else None),
+            shadow_expire=config.SHADOW_LIST_CACHE_EXPIRE_IN_SECONDS,
+        )
 
     async def _get_list_from_storage(
             self,
             film_uuid: Optional[UUID],
             sort: str,
             page_size: int,
-            page_number: int
-    ) -> List[GenreBrief]:
+            page_number: int,
+            cursor: Optional[Cursor] = None
+    ) -> Page:
         """
             Получить список жанров из ElasticSearch
         """
-        search_query = {
-            "from": (page_number - 1) * page_size,
-            "size": page_size,
-            "query": {
-                "nested": {
-                    "path": "films",
-                    "query": {
-                        "bool": {
-                            "must": [
-                                {"match": {"films.id": str(film_uuid)}}
-                            ]
-                        }
-                    }
-                }
-            } if film_uuid else {"match_all": {}},
-            "sort": [
-                {sort or "name": {"order": "asc"}}
-            ]
-        }
-        es_fields = ["id", "name", "description"]
-        doc = await self.storage.search('genres', search_query, es_fields)
-        genres_info = doc.get("hits").get("hits")
-        return [GenreBrief(**genre.get("_source")) for genre in genres_info]
-
-    async def _get_list_from_cache(
-            self,
-            film_uuid: Optional[UUID],
-            sort: str,
-            page_size: int,
-            page_number: int
-    ) -> List[GenreBrief]:
-        key = self._get_key(film_uuid, sort, page_size, page_number)
-        data = await self.cache.get(key)
-        if not data:
-            return []
-        genres = [GenreBrief(**genre) for genre in orjson.loads(data)]
-        return genres
-
-    async def _put_list_to_cache(
+        genres_info, next_cursor = await self.storage.search_page(
+            'genres', self._list_query(film_uuid, sort), self.LIST_FIELDS, page_size, page_number, cursor
+        )
+        with timing.span('model'):
+            genres = [GenreBrief.trusted(**genre.get("_source")) for genre in genres_info]
+        return Page(genres, next_cursor.encode() if next_cursor else None)
+
+    async def stream_list(
             self,
-            genres: List[GenreBrief],
             film_uuid: Optional[UUID],
             sort: str,
             page_size: int,
-            page_number: int
-    ):
-        key = self._get_key(film_uuid, sort, page_size, page_number)
-        json = "[{}]".format(','.join(genre.json() for genre in genres))
-        await self.cache.set(key, json, self.CACHE_EXPIRE_IN_SECONDS)
+            page_number: int,
+            cursor: Optional[Cursor] = None
+    ) -> AsyncIterator[List[GenreBrief]]:
+        """
+            Список жанров частями по мере чтения из ElasticSearch, для потоковых ответов
+        """
+        async for genres_info in self.storage.scan(
+            'genres', self._list_query(film_uuid, sort), self.LIST_FIELDS, page_size,
+            (page_number - 1) * page_size, cursor
+        ):
+            with timing.span('model'):
+                genres = [GenreBrief.trusted(**genre["_source"]) for genre in genres_info]
+            yield genres
+
+    @staticmethod
+    def _list_query(film_uuid: Optional[UUID], sort: Optional[str]) -> SearchQuery:
+        search_query = SearchQuery().sort(sort or "name")
+        if film_uuid:
+            search_query.nested_term("films", "films.id", film_uuid)
+        return search_query
+
+    @staticmethod
+    def _parse_list(data: bytes) -> Page:
+        return Page.parse_raw(data, GenreBrief)
+
+    @staticmethod
+    def _dump_list(genres: Page) -> bytes:
+        return genres.dumps()
 
 
 @lru_cache()
@@ -1,11 +1,14 @@
-from functools import lru_cache
-from typing import List, Optional
+from functools import lru_cache, partial
+from typing import AsyncIterator, Dict, List, Optional
 from uuid import UUID
 
-import orjson
+from core import config, timing
 from db.cache import MemoryCache, get_cache
+from db.cursor import Cursor
+from db.query import SearchQuery
 from db.storage import AbstractStorage, get_storage
 from fastapi import Depends
+from models.page import Page
 from models.person import Person, PersonBrief
 from services.abstract import AbstractService
 
@@ -15,6 +18,9 @@ class PersonService(AbstractService):
     Сервис для получения информации о человеке по идентификатору
     """
 
+    ES_FIELDS = ["id", "full_name", "birth_date", "films"]
+    LIST_FIELDS = ["id", "full_name", "birth_date"]
+
     def __init__(self, *args, **kwargs):
         self.name = "person"
         super().__init__(*args, **kwargs)
@@ -23,42 +29,53 @@ class PersonService(AbstractService):
         """
         Возвращает информацию о человеке по его строке UUID
         """
-        person = await self._get_from_cache(person_id)
-        if not person:
-            person = await self._get_from_storage(person_id)
-            if not person:
-                return []
-            await self._put_to_cache(person)
-        return person
+        return await self._get_or_load(
+            self._get_entity_key(person_id),
+            partial(self._get_from_storage, person_id),
+            Person.parse_trusted,
+            Person.dumps,
+            self._entity_tags,
+        )
 
-    async def _get_from_storage(self, person_id: str) -> Optional[Person]:
+    async def get_many(self, person_ids: List[str]) -> List[Optional[Person]]:
         """
-        Извлечь информацию о человеке из ElasticSearch по его строке идентификатору
+        Возвращает информацию о нескольких людях в порядке переданных UUID,
+        для ненайденных - None
         """
-        es_fields = ["id", "full_name", "birth_date", "films"]
-        doc = await self.storage.get("persons", person_id, es_fields)
-        person_info = doc.get("_source")
-        # Спецификация API требует, чтобы поле идентификатора называлось UUID
-        person_info["uuid"] = person_info["id"]
-        person_info.pop("id")
-        return Person(**person_info)
+        return await self._get_many_or_load(
+            person_ids,
+            self._get_from_storage,
+            self._get_many_from_storage,
+            Person.parse_trusted,
+            Person.dumps,
+        )
 
-    async def _get_from_cache(self, person_id: str) -> Optional[Person]:
+    async def _get_from_storage(self, person_id: str) -> Optional[Person]:
         """
-        Чтение данных о человеке из кэша
+        Извлечь информацию о человеке из ElasticSearch по его строке идентификатору
         """
-        data = await self.cache.get(person_id)
-        if not data:
-            return []
-        return Person.parse_raw(data)
+        doc = await self.storage.get("persons", person_id, self.ES_FIELDS)
+        with timing.span("model"):
+            return self._make_person(doc.get("_source"))
 
-    async def _put_to_cache(self, person: Person):
+    async def _get_many_from_storage(self, person_ids: List[str]) -> Dict[str, Person]:
         """
-        Запись данных о человеке в кэш
+        Извлечь информацию о нескольких людях из ElasticSearch одним запросом
         """
-        await self.cache.set(
-            str(person.uuid), person.json(), self.CACHE_EXPIRE_IN_SECONDS
-        )
+        doc = await self.storage.get_many("persons", person_ids, self.ES_FIELDS)
+        with timing.span("model"):
+            return {
+                person["_id"]: self._make_person(person["_source"])
+                for person in doc.get("docs")
+                if person.get("found")
+            }
+
+    @staticmethod
+    def _make_person(person_info: dict) -> Person:
+        # Спецификация API требует, чтобы поле идентификатора называлось UUID
+        person_info["uuid"] = person_info["id"]
+        person_info.pop("id")
+        return Person.trusted(**person_info)
 
     async def get_list(
         self,
@@ -67,23 +84,32 @@ class PersonService(AbstractService):
         sort: str,
         page_size: int,
         page_number: int,
-    ) -> List[PersonBrief]:
+        cursor: Optional[Cursor] = None,
+    ) -> Page:
         """
         Получить список персон.
         """
-        persons = await self._get_list_from_cache(
-            film_uuid, filter_name, sort, page_size, page_number
+        load = partial(
+            self._get_list_from_storage,
+            film_uuid, filter_name, sort, page_size, page_number, cursor
+        )
+        if cursor and cursor.consistent:
+            # Страницы согласованного обхода нужны только одному клиенту
+            return await load()
+        return await self._get_or_load(
+            await self._get_list_key(
+                film_uuid, filter_name, sort, page_size, page_number,
+                cursor.search_after if cursor else None,
+            ),
+            load,
+            self._parse_list,
+            self._dump_list,
+            partial(
+                self._list_tags,
+                depends_on=f"film:{film_uuid}" if film_uuid else None,
+            ),
+            shadow_expire=config.SHADOW_LIST_CACHE_EXPIRE_IN_SECONDS,
         )
-        if not persons:
-            persons = await self._get_list_from_storage(
-                film_uuid, filter_name, sort, page_size, page_number
-            )
-            if not persons:
-                return []
-            await self._put_list_to_cache(
-                persons, film_uuid, filter_name, sort, page_size, page_number
-            )
-        return persons
 
     async def _get_list_from_storage(
         self,
@@ -92,53 +118,61 @@ class PersonService(AbstractService):
         sort: Optional[str],
         page_size: int,
         page_number: int,
-    ) -> List[PersonBrief]:
+        cursor: Optional[Cursor] = None,
+    ) -> Page:
         """
         Получить список людей из ElasticSearch
         """
-        search_query = {
-            "from": (page_number - 1) * page_size,
-            "size": page_size,
-            "query": {"match_all": {}},
-            "sort": [{sort or "full_name.raw": {"order": "asc"}}],
-        }
-        if film_uuid:
-            search_query["query"] = {"match": {"films.id": str(film_uuid)}}
-        if filter_name:
-            search_query["query"] = {"match": {"full_name": filter_name}}
-        es_fields = ["id", "full_name", "birth_date"]
-        doc = await self.storage.search("persons", search_query, es_fields)
-        persons_info = doc.get("hits").get("hits")
-        return [PersonBrief(**person.get("_source")) for person in persons_info]
+        persons_info, next_cursor = await self.storage.search_page(
+            "persons", self._list_query(film_uuid, filter_name, sort), self.LIST_FIELDS,
+            page_size, page_number, cursor
+        )
+        with timing.span("model"):
+            persons = [PersonBrief.trusted(**person.get("_source")) for person in persons_info]
+        return Page(persons, next_cursor.encode() if next_cursor else None)
 
-    async def _get_list_from_cache(
+    async def stream_list(
         self,
         film_uuid: Optional[UUID],
         filter_name: Optional[str],
-        sort: Optional[str],
+        sort: str,
         page_size: int,
         page_number: int,
-    ) -> List[PersonBrief]:
+        cursor: Optional[Cursor] = None,
+    ) -> AsyncIterator[List[PersonBrief]]:
+        """
+        Список людей частями по мере чтения из ElasticSearch, для потоковых ответов
+        """
+        async for persons_info in self.storage.scan(
+            "persons", self._list_query(film_uuid, filter_name, sort), self.LIST_FIELDS, page_size,
+            (page_number - 1) * page_size, cursor
+        ):
+            with timing.span("model"):
+                persons = [PersonBrief.trusted(**person["_source"]) for person in persons_info]
+            yield persons
 
-        key = self._get_key(film_uuid, filter_name, sort, page_size, page_number)
-        data = await self.cache.get(key)
-        if not data:
-            return []
-        films = [PersonBrief(**film) for film in orjson.loads(data)]
-        return films
+    @staticmethod
+    def _list_query(film_uuid: Optional[UUID], filter_name: Optional[str], sort: Optional[str]) -> SearchQuery:
+        search_query = SearchQuery().sort(sort or "full_name.raw")
+        if film_uuid:
+            search_query.nested_term("films", "films.id", film_uuid)
+        if filter_name:
+            search_query.match("full_name", filter_name)
+        return search_query
 
-    async def _put_list_to_cache(
-        self,
-        persons: List[PersonBrief],
-        film_uuid: Optional[UUID],
-        filter_name: Optional[str],
-        sort: str,
-        page_size: int,
-        page_number: int,
-    ):
-        key = self._get_key(film_uuid, filter_name, sort, page_size, page_number)
-        json = "[{}]".format(",".join(film.json() for film in persons))
-        await self.cache.set(key, json, self.CACHE_EXPIRE_IN_SECONDS)
+    @staticmethod
+    def _parse_list(data: bytes) -> Page:
+        """
+        Разбор страницы списка людей, прочитанной из кэша
+        """
+        return Page.parse_raw(data, PersonBrief)
+
+    @staticmethod
+    def _dump_list(persons: Page) -> bytes:
+        """
+        Сериализация страницы списка людей для записи в кэш
+        """
+        return persons.dumps()
 
 
 @lru_cache()
@@ -0,0 +1,56 @@
+import asyncio
+import logging
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List
+
+from core import config
+from db.cache import MemoryCache, popularity_key
+
+logger = logging.getLogger(__name__)
+
+# Обращения к сущностям, накопленные процессом с последней записи в общий рейтинг
+hits: Dict[str, Counter] = defaultdict(Counter)
+# Обращения не от клиентов (прогрев кэша) в рейтинг не попадают
+_recording: ContextVar[bool] = ContextVar('popularity_recording', default=True)
+
+
+def record(namespace: str, entity_id: str):
+    """
+    Учесть обращение к сущности. Счетчик копится в памяти процесса,
+    чтобы не добавлять запрос к Redis в каждый ответ API
+    """
+    if _recording.get():
+        hits[namespace][entity_id] += 1
+
+
+@contextmanager
+def paused():
+    """Не учитывать обращения, выполненные внутри блока и в запущенных из него задачах"""
+    token = _recording.set(False)
+    try:
+        yield
+    finally:
+        _recording.reset(token)
+
+
+async def flush(cache: MemoryCache):
+    """Перенести накопленные счетчики обращений в общий рейтинг в Redis"""
+    for namespace in list(hits):
+        counter = hits.pop(namespace)
+        await cache.incr_scores(popularity_key(namespace), dict(counter), config.POPULARITY_MAX_SIZE)
+
+
+async def keep_flushing(cache: MemoryCache, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await flush(cache)
+        except Exception as e:
+            logger.warning('Не удалось записать рейтинг обращений: %r', e)
+
+
+async def most_popular(cache: MemoryCache, namespace: str, count: int) -> List[str]:
+    """Идентификаторы сущностей, к которым обращались чаще всего"""
+    return await cache.top(popularity_key(namespace), count)
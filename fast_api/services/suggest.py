@@ -0,0 +1,170 @@
+"""
+Подсказки при вводе поискового запроса.
+
+Названия фильмов и имена людей хранятся в индексах префиксов в памяти
+процесса, поэтому ответ не требует обращений ни к ElasticSearch, ни к Redis.
+Индексы строятся при запуске и обновляются по уведомлениям ETL
+"""
+import asyncio
+import logging
+from typing import AsyncIterator, List, Optional, Tuple
+
+import orjson
+from core import config
+from db.cache import MemoryCache
+from db.prefix_index import PrefixIndex
+from db.query import SearchQuery
+from db.storage import AbstractStorage
+
+logger = logging.getLogger(__name__)
+
+service: Optional['SuggestService'] = None
+
+# Блокировка построения индексов и снимок построенных индексов, общие для процессов API
+LOCK_KEY = 'lock:suggest'
+SNAPSHOT_KEY = 'suggest:snapshot'
+SNAPSHOT_POLL_IN_SECONDS = 0.5
+
+
+class SuggestService:
+    """
+    Сервис подсказок: фильмы ранжируются по рейтингу, люди - по числу фильмов
+    """
+
+    FILM_FIELDS = ["id", "title", "imdb_rating"]
+    PERSON_FIELDS = ["id", "full_name", "films"]
+
+    def __init__(self, storage: AbstractStorage, cache: Optional[MemoryCache] = None):
+        self.storage = storage
+        self.cache = cache
+        self.films = PrefixIndex(config.SUGGEST_MAX_WORDS)
+        self.persons = PrefixIndex(config.SUGGEST_MAX_WORDS)
+
+    def suggest(self, prefix: str, limit: int) -> dict:
+        """
+        Подсказки в виде SuggestApi. Собираются словарями без моделей pydantic:
+        данные индекса уже проверены при построении, а валидация заняла бы больше времени, чем сам поиск
+        """
+        films = []
+        for film_id in self.films.find(prefix, limit):
+            title, rating = self.films.get(film_id)
+            films.append({"uuid": film_id, "title": title, "imdb_rating": rating or None})
+        persons = [
+            {"uuid": person_id, "full_name": self.persons.get(person_id)[0]}
+            for person_id in self.persons.find(prefix, limit)
+        ]
+        return {"films": films, "persons": persons}
+
+    async def build(self):
+        """
+        Прочитать все фильмы и всех людей из ElasticSearch. Если процессов API несколько,
+        ElasticSearch читает только процесс, первым захвативший блокировку в Redis:
+        построенные индексы он оставляет снимком, а остальные строят индексы по снимку
+        """
+        snapshot, token = None, None
+        if self.cache is not None:
+            try:
+                snapshot, token = await self._wait_snapshot()
+            except Exception as e:
+                logger.warning('Снимок индекса подсказок недоступен: %r', e)
+        if snapshot is not None:
+            data = orjson.loads(snapshot)
+            self.films.replace(tuple(doc) for doc in data["films"])
+            self.persons.replace(tuple(doc) for doc in data["persons"])
+        else:
+            try:
+                await self._build_films()
+                await self._build_persons()
+                if token:
+                    await self._save_snapshot()
+            finally:
+                if token:
+                    await self._release(token)
+        logger.info('Индекс подсказок построен: фильмов %d, людей %d', len(self.films), len(self.persons))
+
+    async def _wait_snapshot(self) -> Tuple[Optional[bytes], Optional[str]]:
+        """
+        Снимок индексов, построенный другим процессом API, или токен блокировки,
+        если индексы должен построить этот процесс. Без снимка за время ожидания
+        возвращается (None, None), и процесс строит индексы сам
+        """
+        loop = asyncio.get_event_loop()
+        wait_until = loop.time() + config.SUGGEST_BUILD_WAIT_IN_SECONDS
+        snapshot = await self.cache.get(SNAPSHOT_KEY)
+        if snapshot is None:
+            token = await self.cache.acquire_lock(LOCK_KEY, int(config.SUGGEST_BUILD_WAIT_IN_SECONDS * 1000))
+            if token:
+                return None, token
+        while snapshot is None and loop.time() < wait_until:
+            await asyncio.sleep(SNAPSHOT_POLL_IN_SECONDS)
+            snapshot = await self.cache.get(SNAPSHOT_KEY)
+        if snapshot is None:
+            logger.warning('Снимок индекса подсказок не появился, индекс строится из ElasticSearch')
+        return snapshot, None
+
+    async def _save_snapshot(self):
+        data = orjson.dumps({"films": self.films.items(), "persons": self.persons.items()})
+        try:
+            await self.cache.set(SNAPSHOT_KEY, data, config.SUGGEST_SNAPSHOT_EXPIRE_IN_SECONDS)
+        except Exception as e:
+            logger.warning('Не удалось сохранить снимок индекса подсказок: %r', e)
+
+    async def _release(self, token: str):
+        # Процессы, запущенные позже, найдут снимок, а если построить индекс не удалось,
+        # блокировка не должна мешать следующей попытке
+        try:
+            await self.cache.release_lock(LOCK_KEY, token)
+        except Exception as e:
+            logger.warning('Не удалось снять блокировку индекса подсказок: %r', e)
+
+    async def _build_films(self):
+        self.films.replace([self._film(doc) async for doc in self._scan("movies", self.FILM_FIELDS)])
+
+    async def _build_persons(self):
+        self.persons.replace([self._person(doc) async for doc in self._scan("persons", self.PERSON_FIELDS)])
+
+    async def refresh(self, message: dict):
+        """
+        Обновить индекс по уведомлению ETL: перечитать записанные документы,
+        а после переиндексации - индекс целиком
+        """
+        if message['index'] == "movies":
+            index, fields, make, build = self.films, self.FILM_FIELDS, self._film, self._build_films
+        elif message['index'] == "persons":
+            index, fields, make, build = self.persons, self.PERSON_FIELDS, self._person, self._build_persons
+        else:
+            return
+        if message.get('reindex'):
+            # Каждый процесс API перечитывает индекс сам: уведомление о переиндексации
+            # приходит всем процессам сразу, а переиндексация бывает редко
+            await build()
+            return
+        doc = await self.storage.get_many(message['index'], message['ids'], fields)
+        for item in doc["docs"]:
+            if item.get("found"):
+                index.add(*make(item["_source"]))
+            else:
+                index.remove(item["_id"])
+
+    async def _scan(self, some_index: str, es_fields: List[str]) -> AsyncIterator[dict]:
+        cursor = None
+        while True:
+            hits, cursor = await self.storage.search_page(
+                some_index, SearchQuery(), es_fields, config.SUGGEST_BUILD_PAGE_SIZE, 1, cursor
+            )
+            for hit in hits:
+                yield hit["_source"]
+            if cursor is None:
+                return
+
+    @staticmethod
+    def _film(source: dict):
+        return source["id"], source["title"], source.get("imdb_rating") or 0
+
+    @staticmethod
+    def _person(source: dict):
+        return source["id"], source["full_name"], len(source.get("films") or [])
+
+
+async def get_suggest_service() -> SuggestService:
+    return service
@@ -0,0 +1,161 @@
+import hashlib
+from typing import Any, AsyncIterable, Callable, Iterable, Optional, Union
+
+import orjson
+from core import config, deadline, timing
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+from models._base import OrjsonModel, model_fields
+
+# Длина ETag в шестнадцатеричных символах, им начинается закэшированный ответ
+ETAG_LENGTH = 16
+# Заголовок ответа с курсором следующей страницы списка
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+# Потоковый ответ: по документу JSON в строке
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def dump_models(models: Union[OrjsonModel, Iterable[OrjsonModel]]) -> bytes:
+    """
+    Сериализовать модель ответа API или список моделей в байты JSON
+    """
+    with timing.span('render'):
+        if isinstance(models, OrjsonModel):
+            return models.dumps()
+        return orjson.dumps(list(models), default=model_fields)
+
+
+def wants_ndjson(accept: Optional[str]) -> bool:
+    """Клиент просит потоковый ответ NDJSON в заголовке Accept"""
+    return bool(accept) and NDJSON_MEDIA_TYPE in accept
+
+
+async def ndjson_response(
+        chunks: AsyncIterable[Iterable[Any]], convert: Callable[[Any], OrjsonModel]
+) -> Optional[StreamingResponse]:
+    """
+    Потоковый ответ NDJSON из частей списка, которые читаются по мере отправки,
+    поэтому память не зависит от длины списка. Первая часть читается до начала
+    ответа, чтобы на пустой список ответить 404, как и без потока (возвращается None).
+    Ответ уже начат, поэтому каждая следующая часть получает свой срок
+    """
+    chunks = chunks.__aiter__()
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        return None
+
+    async def lines():
+        chunk = first
+        while True:
+            yield b"".join(orjson.dumps(convert(item), default=model_fields) + b"\n" for item in chunk)
+            deadline.renew(config.REQUEST_TIMEOUT_IN_SECONDS)
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                return
+
+    # nginx не должен копить ответ у себя, иначе клиент не получает его по частям
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE, headers={"X-Accel-Buffering": "no"})
+
+
+def json_response(body: bytes) -> Response:
+    """
+    Отдать готовое тело ответа без повторной валидации и сериализации
+    """
+    return Response(content=body, media_type="application/json")
+
+
+class CachedBody:
+    """
+    Готовое тело ответа вместе с его ETag и курсором следующей страницы.
+    В кэше хранятся рядом, чтобы не считать хэш тела при каждом запросе.
+    Формат записи: ETag, курсор, перевод строки и тело.
+    max_age в кэш не записывается: сколько еще ответ свежий, определяется при его получении
+    """
+
+    __slots__ = ('etag', 'body', 'next_cursor', 'max_age')
+
+    def __init__(self, etag: str, body: bytes, next_cursor: Optional[str] = None, max_age: Optional[int] = None):
+        self.etag = etag
+        self.body = body
+        self.next_cursor = next_cursor
+        self.max_age = max_age
+
+    def __bool__(self):
+        return bool(self.body)
+
+    @classmethod
+    def from_body(cls, body: Optional[bytes], next_cursor: Optional[str] = None) -> Optional['CachedBody']:
+        if not body:
+            return None
+        return cls(hashlib.blake2b(body, digest_size=ETAG_LENGTH // 2).hexdigest(), body, next_cursor)
+
+    @classmethod
+    def loads(cls, data: bytes) -> 'CachedBody':
+        end = data.index(b'\n', ETAG_LENGTH)
+        return cls(data[:ETAG_LENGTH].decode(), data[end + 1:], data[ETAG_LENGTH:end].decode() or None)
+
+    def dumps(self) -> bytes:
+        return b''.join((self.etag.encode(), (self.next_cursor or '').encode(), b'\n', self.body))
+
+
+def cached_json_response(cached: CachedBody, max_age: int) -> Response:
+    """
+    Отдать закэшированное тело ответа с ETag. Клиент может хранить ответ
+    не дольше, чем он считается свежим в кэше API: устаревший ответ
+    или ответ из теневых копий отдается с max-age=0
+    """
+    if cached.max_age is not None:
+        max_age = min(max_age, cached.max_age)
+    headers = {"ETag": f'"{cached.etag}"', "Cache-Control": f"max-age={max_age}"}
+    if cached.next_cursor:
+        headers[NEXT_CURSOR_HEADER] = cached.next_cursor
+    return Response(content=cached.body, media_type="application/json", headers=headers)
+
+
+class ConditionalGetMiddleware:
+    """
+    Отвечает 304 без тела, если ETag ответа совпал с одним из If-None-Match запроса
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] not in ('GET', 'HEAD'):
+            await self.app(scope, receive, send)
+            return
+        if_none_match = next((value for name, value in scope['headers'] if name == b'if-none-match'), None)
+        if if_none_match is None:
+            await self.app(scope, receive, send)
+            return
+        client_etags = {_strip_weak(etag.strip()) for etag in if_none_match.split(b',')}
+        not_modified = False
+
+        async def send_conditional(message):
+            nonlocal not_modified
+            if message['type'] == 'http.response.start':
+                headers = message.get('headers', [])
+                etag = next((value for name, value in headers if name == b'etag'), None)
+                if message['status'] == 200 and etag and (etag in client_etags or b'*' in client_etags):
+                    not_modified = True
+                    message = {
+                        'type': 'http.response.start',
+                        'status': 304,
+                        'headers': [(name, value) for name, value in headers
+                                    if name not in (b'content-length', b'content-type')],
+                    }
+            elif not_modified:
+                # Тело ответа не отправляем, но клиенту нужно одно пустое сообщение в конце
+                if message.get('more_body', False):
+                    return
+                message = {'type': 'http.response.body', 'body': b''}
+            await send(message)
+
+        await self.app(scope, receive, send_conditional)
+
+
+def _strip_weak(etag: bytes) -> bytes:
+    """Тело ответа не меняется при сжатии nginx, поэтому слабый ETag сравниваем как сильный"""
+    return etag[2:] if etag.startswith(b'W/') else etag
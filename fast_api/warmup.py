@@ -0,0 +1,115 @@
+"""
+Прогрев кэша после запуска API.
+
+Прогрев вызывает те же обработчики, что и запросы клиентов,
+поэтому заполняет те же ключи: и данные из ElasticSearch, и готовые ответы
+"""
+import asyncio
+import logging
+import time
+from functools import partial
+from typing import Awaitable, Callable
+
+from api.v1 import film, genre, person
+from core import config
+from fastapi import HTTPException
+from services import popularity
+from services.film import FilmService
+from services.genre import GenreService
+from services.person import PersonService
+
+logger = logging.getLogger(__name__)
+
+# Блокировка прогрева, общая для всех процессов и экземпляров API
+LOCK_KEY = 'lock:warmup'
+
+
+class Warmup:
+    """
+    Прогрев кэша с ограничением по времени и числу одновременных запросов
+    """
+
+    def __init__(self, film_service: FilmService, genre_service: GenreService, person_service: PersonService,
+                 timeout: float, concurrency: int):
+        self.film_service = film_service
+        self.genre_service = genre_service
+        self.person_service = person_service
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.warmed = 0
+        self.failed = 0
+
+    async def run(self) -> int:
+        """Прогреть кэш. Возвращает число прогретых ответов"""
+        started = time.monotonic()
+        try:
+            # Прогрев запрашивает самые популярные сущности, и его обращения только закрепили бы их в рейтинге
+            with popularity.paused():
+                await asyncio.wait_for(self._warm_all(), self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Прогрев кэша прерван через %.0f с', self.timeout)
+        logger.info('Прогрев кэша: прогрето %d ответов, ошибок %d, за %.1f с',
+                    self.warmed, self.failed, time.monotonic() - started)
+        return self.warmed
+
+    async def run_once(self) -> int:
+        """
+        Прогреть кэш, если его еще не прогревает другой процесс API: кэш Redis общий,
+        поэтому прогрев выполняет только процесс, первым захвативший блокировку.
+        Блокировка не снимается до конца срока прогрева, так что процессы,
+        запущенные вместе с ним, прогрев не повторяют
+        """
+        try:
+            token = await self.film_service.cache.acquire_lock(LOCK_KEY, int(self.timeout * 1000))
+        except Exception as e:
+            logger.warning('Прогрев кэша пропущен, блокировка недоступна: %r', e)
+            return 0
+        if not token:
+            logger.info('Кэш прогревает другой процесс API')
+            return 0
+        return await self.run()
+
+    async def _warm_all(self):
+        film_ids = await popularity.most_popular(self.film_service.cache, 'film', config.WARMUP_POPULAR_COUNT)
+        person_ids = await popularity.most_popular(self.person_service.cache, 'person', config.WARMUP_POPULAR_COUNT)
+        # Все параметры обработчиков передаются явно: без запроса FastAPI их не заполнит,
+        # и значением станет само объявление параметра (Query, Header)
+        jobs = [
+            partial(film.film_list, '-imdb_rating', None, config.WARMUP_PAGE_SIZE, page_number,
+                    cursor=None, accept=None, film_service=self.film_service)
+            for page_number in range(1, config.WARMUP_FILM_PAGES + 1)
+        ]
+        jobs += [partial(film.film_details, film_id, self.film_service) for film_id in film_ids]
+        jobs += [partial(person.person_details, person_id, self.person_service) for person_id in person_ids]
+        await asyncio.gather(self._warm_genres(), *(self._warm(job) for job in jobs))
+
+    async def _warm_genres(self):
+        """Прогреть все страницы списка жанров и каждый жанр"""
+        page_size = config.WARMUP_PAGE_SIZE
+        page_number = 1
+        while True:
+            if not await self._warm(partial(genre.genre_list, 'name.raw', None, page_size, page_number,
+                                            cursor=None, accept=None, genre_service=self.genre_service)):
+                return
+            # Страница уже в кэше, поэтому повторное чтение не доходит до ElasticSearch
+            genres = await self.genre_service.get_list(None, 'name.raw', page_size, page_number)
+            await asyncio.gather(*(
+                self._warm(partial(genre.genre_details, str(item.id), self.genre_service)) for item in genres
+            ))
+            if len(genres) < page_size:
+                return
+            page_number += 1
+
+    async def _warm(self, handler: Callable[[], Awaitable]) -> bool:
+        async with self.semaphore:
+            try:
+                await handler()
+            except HTTPException:
+                # Пустой ответ тоже закэширован, но прогретым его не считаем
+                return False
+            except Exception as e:
+                self.failed += 1
+                logger.debug('Ошибка при прогреве кэша: %r', e)
+                return False
+        self.warmed += 1
+        return True
@@ -1,6 +1,8 @@
+import json
 import logging
 import requests
 from elasticsearch import Elasticsearch, helpers
+from redis import Redis, RedisError
 from typing import List
 
 from settings.settings import Settings
@@ -13,6 +15,7 @@ logger = logging.getLogger(__name__)
 class ESSaver(Settings, Schemes):
 
     __es_con = None
+    __redis_con = None
 
     SCHEMES = {
         "movies": 'film_scheme',
@@ -26,13 +29,39 @@ class ESSaver(Settings, Schemes):
 
     @backoff()
     def save_many(self, docs: List[dict], index: str):
-        helpers.bulk(self.__get_connection(), [{'_index': index, '_id': doc['id'], **doc} for doc in docs])
+        # Дожидаемся обновления индекса, чтобы API не закэшировал старую версию после уведомления
+        helpers.bulk(
+            self.__get_connection(),
+            [{'_index': index, '_id': doc['id'], **doc} for doc in docs],
+            refresh='wait_for',
+        )
+        # Сообщаем API идентификаторы записанных документов, чтобы он удалил зависящие от них ключи кэша
+        self.__publish({'index': index, 'ids': [str(doc['id']) for doc in docs]})
+
+    def __publish(self, message: dict):
+        """
+        Отправить уведомление в канал кэша API. Ошибка уведомления не останавливает
+        загрузку, в худшем случае ключи кэша истекут по времени жизни
+        """
+        redis_params = self.get_settings().api_cache_redis
+        if not redis_params:
+            return
+        try:
+            self.__get_redis_connection().publish(redis_params.channel, json.dumps(message))
+        except RedisError as e:
+            logger.warning(f"Не удалось отправить уведомление об изменении {message['index']}: {e}")
 
     def __get_connection(self):
         if not self.__es_con:
             self.__es_con = Elasticsearch(self.__get_es_link())
         return self.__es_con
 
+    def __get_redis_connection(self):
+        if not self.__redis_con:
+            redis_params = self.get_settings().api_cache_redis
+            self.__redis_con = Redis(redis_params.host, port=redis_params.port, password=redis_params.password)
+        return self.__redis_con
+
     def __get_es_link(self):
         es_params = dict(self.get_settings().film_work_es)
         return f"http://{es_params['host']}:{es_params['port']}"
@@ -43,3 +72,6 @@ class ESSaver(Settings, Schemes):
         resp = requests.put("{}/{}".format(self.__get_es_link(), index), json=scheme)
         if resp.status_code != 200:
             logger.warning(f"Ошибка создания поискового индекса: {index}")
+            return
+        # Индекс пересоздан, API должен сбросить все закэшированные списки этого индекса
+        self.__publish({'index': index, 'reindex': True})
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseModel
 
 
@@ -14,9 +16,19 @@ class ElasticsearchSettings(BaseModel):
     port: int
 
 
+class RedisSettings(BaseModel):
+    host: str
+    port: int
+    password: Optional[str] = None
+    # Канал, в который публикуются идентификаторы записанных документов
+    channel: str = 'cache:etl'
+
+
 class AllSettings(BaseModel):
     film_work_pg: PostgresSettings
     film_work_es: ElasticsearchSettings
+    # Redis кэша API. Если не задан, об изменениях никто не уведомляется
+    api_cache_redis: Optional[RedisSettings] = None
 
 
 class Settings:
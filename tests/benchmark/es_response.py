@@ -0,0 +1,81 @@
+"""
+Сравнение размера и времени разбора ответов ElasticSearch на запрос
+страницы краткого списка фильмов:
+
+- envelope - полный ответ с _source, как до filter_path;
+- filter_path - ответ без служебных полей;
+- docvalues - ответ без служебных полей с полями из doc values.
+
+Ответы собираются в том виде, в каком их отдает ElasticSearch 7, и разбираются
+сериализатором клиента elasticsearch. Выигрыш doc values на стороне ElasticSearch
+(не нужно читать и распаковывать _source) здесь не измеряется.
+
+Запуск: python es_response.py [размер страницы]
+"""
+import json
+import random
+import sys
+import timeit
+import uuid
+
+from elasticsearch.serializer import JSONSerializer
+
+WORDS = ["star", "wars", "dust", "north", "love", "night", "city", "dark", "return", "empire"]
+
+
+def make_films(count: int) -> list:
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "title": " ".join(random.choices(WORDS, k=random.randint(1, 5))).capitalize(),
+            "imdb_rating": round(random.uniform(1, 10), 1),
+        }
+        for _ in range(count)
+    ]
+
+
+def envelope(films: list) -> dict:
+    return {
+        "took": 3,
+        "timed_out": False,
+        "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+        "hits": {
+            "total": {"value": 999, "relation": "eq"},
+            "max_score": None,
+            "hits": [
+                {"_index": "movies", "_type": "_doc", "_id": film["id"], "_score": None,
+                 "_source": film, "sort": [film["imdb_rating"], film["id"]]}
+                for film in films
+            ],
+        },
+    }
+
+
+def filter_path(films: list) -> dict:
+    return {"hits": {"hits": [{"_source": film, "sort": [film["imdb_rating"], film["id"]]} for film in films]}}
+
+
+def docvalues(films: list) -> dict:
+    return {"hits": {"hits": [
+        {"fields": {"id": [film["id"]], "title.raw": [film["title"]], "imdb_rating": [str(film["imdb_rating"])]},
+         "sort": [film["imdb_rating"], film["id"]]}
+        for film in films
+    ]}}
+
+
+def main(page_size: int):
+    serializer = JSONSerializer()
+    films = make_films(page_size)
+    baseline = None
+    print(f"Страница из {page_size} фильмов")
+    print(f"{'ответ':<12} {'байт':>8} {'экономия':>9} {'разбор, мкс':>12}")
+    for name, make in (("envelope", envelope), ("filter_path", filter_path), ("docvalues", docvalues)):
+        body = json.dumps(make(films), separators=(",", ":"))
+        number = 2000
+        seconds = timeit.timeit(lambda: serializer.loads(body), number=number) / number
+        baseline = baseline or len(body)
+        print(f"{name:<12} {len(body):>8} {1 - len(body) / baseline:>8.0%} {seconds * 1e6:>12.1f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
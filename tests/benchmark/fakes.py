@@ -0,0 +1,377 @@
+"""
+Хранилище и кэш в памяти процесса для замеров API без ElasticSearch и Redis.
+
+Каждое обращение ждет заданную задержку, как сетевой запрос, а данные
+проходят через orjson, как ответы настоящих клиентов: сервисы получают
+новые объекты и разбирают их так же, как в работе
+"""
+import asyncio
+import random
+import time
+import uuid
+from collections import defaultdict
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import orjson
+from core import config
+from db.cache import CacheWrites, MemoryCache, shadow_key
+from db.cursor import Cursor
+from db.prefix_index import normalize
+from db.query import DocValue, SearchQuery
+from db.storage import AbstractStorage
+from elasticsearch import NotFoundError
+
+WORDS = ["star", "wars", "dust", "north", "love", "night", "city", "dark", "return", "empire",
+         "river", "king", "ghost", "winter", "last", "road", "blue", "iron", "silent", "garden"]
+NAMES = ["John", "Anna", "Peter", "Maria", "George", "Helen", "Paul", "Olga", "Mark", "Emma"]
+SURNAMES = ["Smith", "Lucas", "Ford", "Fisher", "Hamill", "Jones", "Taylor", "Brown", "Ivanov", "Petrov"]
+GENRES = ["Action", "Adventure", "Comedy", "Drama", "Fantasy", "Horror", "Mystery", "Romance", "Sci-Fi",
+          "Thriller", "Western", "Animation", "Documentary", "Family", "History", "Music", "War", "Crime"]
+
+
+def make_dataset(films: int, persons: int, seed: int = 0) -> Dict[str, List[dict]]:
+    """Документы индексов movies, genres и persons в формате, который пишет ETL"""
+    rnd = random.Random(seed)
+
+    def new_id() -> str:
+        return str(uuid.UUID(int=rnd.getrandbits(128)))
+
+    genres = [{"id": new_id(), "name": name, "description": f"{name} films", "films": []} for name in GENRES]
+    people = [
+        {"id": new_id(), "full_name": f"{rnd.choice(NAMES)} {rnd.choice(SURNAMES)}", "birth_date": "", "films": []}
+        for _ in range(persons)
+    ]
+    movies = []
+    for _ in range(films):
+        film = {
+            "id": new_id(),
+            "title": " ".join(rnd.choices(WORDS, k=rnd.randint(1, 4))).capitalize(),
+            "imdb_rating": round(rnd.uniform(1, 10), 1),
+            "description": " ".join(rnd.choices(WORDS, k=30)),
+            "director": rnd.choice(people)["full_name"],
+        }
+        film_genres = rnd.sample(genres, rnd.randint(1, 3))
+        actors = rnd.sample(people, rnd.randint(2, 8))
+        writers = rnd.sample(people, rnd.randint(1, 2))
+        film["genre"] = film_genres[0]["name"]
+        film["genres"] = [{"id": genre["id"], "name": genre["name"]} for genre in film_genres]
+        film["actors"] = [{"id": person["id"], "name": person["full_name"]} for person in actors]
+        film["writers"] = [{"id": person["id"], "name": person["full_name"]} for person in writers]
+        film["actors_names"] = [person["full_name"] for person in actors]
+        film["writers_names"] = [person["full_name"] for person in writers]
+        for genre in film_genres:
+            genre["films"].append({"id": film["id"], "title": film["title"]})
+        for role, members in (("actor", actors), ("writer", writers)):
+            for person in members:
+                person["films"].append({"id": film["id"], "title": film["title"], "role": role})
+        movies.append(film)
+    return {"movies": movies, "genres": genres, "persons": people}
+
+
+class FakeStorage(AbstractStorage):
+    """
+    Хранилище с документами в памяти. Понимает запросы, которые строит SearchQuery:
+    match по словам поля, term и nested term по идентификаторам, сортировку и search_after
+    """
+
+    def __init__(self, dataset: Dict[str, List[dict]], latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+        self.__docs = {index: {doc["id"]: doc for doc in docs} for index, docs in dataset.items()}
+        self.__sorted: Dict[Tuple[str, tuple], List[dict]] = {}
+
+    async def get(self, some_index, some_id, es_fields):
+        await self.__wait()
+        doc = self.__docs[some_index].get(some_id)
+        if doc is None:
+            raise NotFoundError(404, "not_found", {"found": False})
+        return _transport({"_source": _select(doc, es_fields)})
+
+    async def get_many(self, some_index, some_ids, es_fields):
+        await self.__wait()
+        docs = self.__docs[some_index]
+        return _transport({"docs": [
+            {"_id": doc_id, "found": True, "_source": _select(docs[doc_id], es_fields)} if doc_id in docs
+            else {"_id": doc_id, "found": False}
+            for doc_id in some_ids
+        ]})
+
+    async def search(self, some_index, some_body, es_fields, request_cache=None):
+        await self.__wait()
+        body = orjson.loads(some_body) if isinstance(some_body, (bytes, str)) else some_body
+        return {"hits": {"hits": self.__hits(some_index, body, es_fields, None)}}
+
+    async def search_page(self, some_index, query: SearchQuery, es_fields, page_size, page_number,
+                          cursor: Optional[Cursor] = None,
+                          docvalues: Optional[Sequence[DocValue]] = None) -> Tuple[List[dict], Optional[Cursor]]:
+        await self.__wait()
+        if not query.sorted:
+            query.sort("_score", "desc")
+        query.sort("id", "asc")
+        if cursor and cursor.search_after:
+            query.after(page_size, cursor.search_after)
+        else:
+            query.page(page_size, page_number)
+        hits = self.__hits(some_index, query.build(), es_fields, docvalues)
+        if hits and len(hits) == page_size:
+            return hits, Cursor(hits[-1]["sort"], None)
+        return hits, None
+
+    async def scan(self, some_index, query: SearchQuery, es_fields, size, offset=0,
+                   cursor: Optional[Cursor] = None,
+                   docvalues: Optional[Sequence[DocValue]] = None) -> AsyncIterator[List[dict]]:
+        if not query.sorted:
+            query.sort("_score", "desc")
+        query.sort("id", "asc")
+        search_after = cursor.search_after if cursor else None
+        while size > 0:
+            await self.__wait()
+            chunk_size = min(size, config.STREAM_CHUNK_SIZE)
+            if search_after:
+                query.after(chunk_size, search_after)
+            else:
+                query.window(chunk_size, offset)
+            hits = self.__hits(some_index, query.build(), es_fields, docvalues)
+            if hits:
+                yield hits
+            if len(hits) < chunk_size:
+                return
+            size -= chunk_size
+            search_after = hits[-1]["sort"]
+
+    def __hits(self, some_index: str, body: dict, es_fields, docvalues: Optional[Sequence[DocValue]]) -> List[dict]:
+        sort = [next(iter(item.items())) for item in body.get("sort", [])]
+        docs = [doc for doc in self.__ordered(some_index, sort) if _matches(doc, body.get("query", {"match_all": {}}))]
+        if "search_after" in body:
+            after = tuple(body["search_after"])
+            docs = [doc for doc in docs if _after(_sort_values(doc, sort), after, sort)]
+        start = body.get("from", 0)
+        # Размер страницы по умолчанию, как у ElasticSearch
+        page = docs[start:start + body.get("size", 10)]
+        if docvalues:
+            es_fields = [field.name for field in docvalues]
+        # Поля из doc values ElasticSearch отдает списками в fields, без _source
+        docvalue_fields = [
+            item["field"] if isinstance(item, dict) else item for item in body.get("docvalue_fields", [])
+        ]
+        return _transport({"hits": {"hits": [
+            {"fields": {field: [_sort_value(doc, field)] for field in docvalue_fields},
+             "sort": list(_sort_values(doc, sort))} if docvalue_fields
+            else {"_source": _select(doc, es_fields), "sort": list(_sort_values(doc, sort))}
+            for doc in page
+        ]}})["hits"]["hits"]
+
+    def __ordered(self, some_index: str, sort: List[Tuple[str, dict]]) -> List[dict]:
+        key = (some_index, tuple((field, order["order"]) for field, order in sort))
+        ordered = self.__sorted.get(key)
+        if ordered is None:
+            ordered = list(self.__docs[some_index].values())
+            # Устойчивая сортировка с последнего поля дает порядок по всем полям сразу
+            for field, order in reversed(sort):
+                ordered.sort(key=lambda doc: _sort_value(doc, field), reverse=order["order"] == "desc")
+            self.__sorted[key] = ordered
+        return ordered
+
+    async def __wait(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class FakeCache(MemoryCache):
+    """
+    Кэш в памяти со временем жизни ключей. Значения хранятся байтами, как в Redis
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+        self.__data: Dict[str, Tuple[Any, float]] = {}
+        self.__tags: Dict[str, set] = defaultdict(set)
+        self.__scores: Dict[str, Dict[str, float]] = defaultdict(dict)
+
+    def clear(self):
+        self.__data.clear()
+        self.__tags.clear()
+
+    async def set(self, key, data, expire):
+        await self.__wait()
+        self.__put(key, data, expire)
+
+    async def get(self, key):
+        await self.__wait()
+        return self.__read(key)
+
+    async def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        if not keys:
+            return []
+        await self.__wait()
+        return [self.__read(key) for key in keys]
+
+    async def set_many(self, items: Dict[str, Any], expire):
+        if not items:
+            return
+        await self.__wait()
+        for key, data in items.items():
+            self.__put(key, data, expire)
+
+    async def delete_many(self, keys: Iterable[str]):
+        await self.__wait()
+        for key in keys:
+            self.__data.pop(key, None)
+
+    async def write(self, writes: CacheWrites):
+        if not writes:
+            return
+        await self.__wait()
+        for key, (data, expire) in writes.values.items():
+            self.__put(key, data, expire)
+        for key, (data, expire) in writes.shadows.items():
+            self.__put(shadow_key(key), data, expire)
+        for key, (tags, _) in writes.tags.items():
+            for tag in tags:
+                self.__tags[tag].add(key)
+
+    async def incr(self, key) -> int:
+        await self.__wait()
+        value = int(self.__read(key) or 0) + 1
+        self.__put(key, value, 0)
+        return value
+
+    async def tag_many(self, items: Dict[str, Iterable[str]], expire):
+        await self.__wait()
+        for key, tags in items.items():
+            for tag in tags:
+                self.__tags[tag].add(key)
+
+    async def invalidate_tags(self, tags: Iterable[str]) -> List[str]:
+        await self.__wait()
+        keys = list(set().union(*(self.__tags.pop(tag, set()) for tag in tags)))
+        for key in keys:
+            self.__data.pop(key, None)
+        return keys
+
+    async def acquire_lock(self, key, expire_ms) -> Optional[str]:
+        await self.__wait()
+        if self.__read(key) is not None:
+            return None
+        token = uuid.uuid4().hex
+        self.__put(key, token, expire_ms / 1000)
+        return token
+
+    async def release_lock(self, key, token):
+        await self.__wait()
+        if self.__read(key) == token.encode():
+            self.__data.pop(key, None)
+
+    async def incr_scores(self, key, scores: Dict[str, float], max_size: int):
+        await self.__wait()
+        ranking = self.__scores[key]
+        for member, score in scores.items():
+            ranking[member] = ranking.get(member, 0) + score
+
+    async def top(self, key, count: int) -> List[str]:
+        await self.__wait()
+        ranking = self.__scores[key]
+        return sorted(ranking, key=ranking.get, reverse=True)[:count]
+
+    def __put(self, key, data, expire):
+        if isinstance(data, int):
+            data = str(data)
+        if isinstance(data, str):
+            data = data.encode()
+        self.__data[key] = (data, time.monotonic() + expire if expire else 0)
+
+    def __read(self, key) -> Optional[bytes]:
+        item = self.__data.get(key)
+        if item is None:
+            return None
+        data, expires_at = item
+        if expires_at and expires_at < time.monotonic():
+            del self.__data[key]
+            return None
+        return data
+
+    async def __wait(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class FakePublisher:
+    """
+    Канал рассылки сброса локальных кэшей. Других экземпляров API при замерах нет,
+    поэтому сообщения никуда не уходят, но каждая рассылка ждет задержку обращения к Redis
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    def pipeline(self) -> '_Pipeline':
+        return _Pipeline(self.latency)
+
+
+class _Pipeline:
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.commands = 0
+
+    def publish(self, channel, message):
+        self.commands += 1
+
+    async def execute(self) -> List[int]:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return [0] * self.commands
+
+
+def _transport(response: dict) -> dict:
+    """Ответ в том виде, в каком его вернул бы клиент после разбора JSON"""
+    return orjson.loads(orjson.dumps(response))
+
+
+def _select(doc: dict, es_fields: Optional[List[str]]) -> dict:
+    if not es_fields:
+        return doc
+    return {field: doc[field] for field in es_fields if field in doc}
+
+
+def _matches(doc: dict, query: dict) -> bool:
+    if "match_all" in query:
+        return True
+    clauses = query["bool"]
+    for clause in clauses.get("must", []):
+        field, text = next(iter(clause["match"].items()))
+        if not set(normalize(text)) & set(normalize(str(doc.get(field, "")))):
+            return False
+    for clause in clauses.get("filter", []):
+        if "term" in clause:
+            field, value = next(iter(clause["term"].items()))
+            if doc.get(field) != value:
+                return False
+        else:
+            path = clause["nested"]["path"]
+            field, value = next(iter(clause["nested"]["query"]["term"].items()))
+            field = field[len(path) + 1:]
+            if not any(item.get(field) == value for item in doc.get(path) or []):
+                return False
+    return True
+
+
+def _sort_value(doc: dict, field: str):
+    if field == "_score":
+        return 1.0
+    value = doc.get(field[:-len(".raw")] if field.endswith(".raw") else field)
+    return value if value is not None else ""
+
+
+def _sort_values(doc: dict, sort: List[Tuple[str, dict]]) -> tuple:
+    return tuple(_sort_value(doc, field) for field, _ in sort)
+
+
+def _after(values: tuple, after: tuple, sort: List[Tuple[str, dict]]) -> bool:
+    for value, last, (_, order) in zip(values, after, sort):
+        if value != last:
+            return value > last if order["order"] == "asc" else value < last
+    return False
@@ -0,0 +1,112 @@
+"""
+Стоимость моделей на один элемент страницы списка фильмов:
+validated - с валидацией pydantic и сериализацией через dict()/json(),
+как было раньше, trusted - модели trusted() и сериализация dumps().
+
+- es_hits - краткие модели из найденных в ElasticSearch документов;
+- cache_read - страница краткой информации, прочитанная из кэша;
+- cache_write - запись страницы в кэш;
+- response - модели ответа API из кратких моделей и тело ответа;
+- details - подробная модель фильма из кэша, модель ответа API по ней и тело ответа.
+
+Запуск: python model_build.py [размер страницы]
+"""
+import random
+import sys
+import timeit
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "fast_api"))
+
+import orjson  # noqa: E402
+from models.film import Film, FilmApi, FilmBrief, FilmBriefApi, FilmGenreApi, FilmPeopleApi  # noqa: E402
+from models.page import Page  # noqa: E402
+from utils.response import dump_models  # noqa: E402
+
+WORDS = ["star", "wars", "dust", "north", "love", "night", "city", "dark", "return", "empire"]
+
+
+def make_film() -> dict:
+    people = [{"id": str(uuid.uuid4()), "name": f"Actor {index}"} for index in range(6)]
+    return {
+        "uuid": str(uuid.uuid4()),
+        "title": " ".join(random.choices(WORDS, k=3)).capitalize(),
+        "imdb_rating": round(random.uniform(1, 10), 1),
+        "description": " ".join(random.choices(WORDS, k=40)),
+        "genres": [{"id": str(uuid.uuid4()), "name": "Action"}, {"id": str(uuid.uuid4()), "name": "Drama"}],
+        "actors": people[:4],
+        "writers": people[4:],
+        "director": "John Smith",
+    }
+
+
+def film_api(film: Film, build) -> FilmApi:
+    return build(FilmApi)(
+        uuid=film.uuid,
+        title=film.title,
+        imdb_rating=film.imdb_rating,
+        description=film.description,
+        genre=[build(FilmGenreApi)(uuid=genre["id"], name=genre["name"]) for genre in film.genres],
+        actors=[build(FilmPeopleApi)(uuid=actor["id"], full_name=actor["name"]) for actor in film.actors],
+        writers=[build(FilmPeopleApi)(uuid=writer["id"], full_name=writer["name"]) for writer in film.writers],
+        director=film.director,
+    )
+
+
+def validated(model):
+    return model
+
+
+def trusted(model):
+    return model.trusted
+
+
+def main(page_size: int):
+    hits = [{"_source": {"id": str(uuid.uuid4()), "title": " ".join(random.choices(WORDS, k=3)),
+                         "imdb_rating": round(random.uniform(1, 10), 1)}} for _ in range(page_size)]
+    cached = Page([FilmBrief(**hit["_source"]) for hit in hits]).dumps()
+    briefs = [FilmBrief(**hit["_source"]) for hit in hits]
+    film = make_film()
+    cached_film = Film(**film).dumps()
+
+    cases = {
+        "es_hits": {
+            "validated": lambda: [FilmBrief(**hit["_source"]) for hit in hits],
+            "trusted": lambda: [FilmBrief.trusted(**hit["_source"]) for hit in hits],
+        },
+        "cache_read": {
+            "validated": lambda: [FilmBrief(**item) for item in orjson.loads(cached)["items"]],
+            "trusted": lambda: Page.parse_raw(cached, FilmBrief),
+        },
+        "cache_write": {
+            "validated": lambda: '{{"items":[{}],"next":null}}'.format(",".join(item.json() for item in briefs)),
+            "trusted": lambda: Page(briefs).dumps(),
+        },
+        "response": {
+            "validated": lambda: orjson.dumps([
+                FilmBriefApi(uuid=item.id, title=item.title, imdb_rating=item.imdb_rating).dict() for item in briefs
+            ]),
+            "trusted": lambda: dump_models(
+                FilmBriefApi.trusted(uuid=item.id, title=item.title, imdb_rating=item.imdb_rating) for item in briefs
+            ),
+        },
+        "details": {
+            "validated": lambda: orjson.dumps(film_api(Film.parse_raw(cached_film), validated).dict()),
+            "trusted": lambda: dump_models(film_api(Film.parse_trusted(cached_film), trusted)),
+        },
+    }
+    print(f"Страница из {page_size} фильмов, мкс на элемент (details - на фильм)")
+    print(f"{'case':<12}{'validated':>11}{'trusted':>9}{'speedup':>9}")
+    for name, variants in cases.items():
+        items = 1 if name == "details" else page_size
+        times = {}
+        for variant, build in variants.items():
+            number, _ = timeit.Timer(build).autorange()
+            times[variant] = min(timeit.repeat(build, number=number, repeat=5)) / number / items * 1e6
+        print(f"{name:<12}{times['validated']:>11.2f}{times['trusted']:>9.2f}"
+              f"{times['validated'] / times['trusted']:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
@@ -0,0 +1,322 @@
+"""
+Замер пропускной способности и задержек API без ElasticSearch и Redis.
+
+Приложение FastAPI вызывается в том же процессе через ASGI со всеми
+middleware, а вместо ElasticSearch и Redis подставляются хранилище и кэш
+в памяти (fakes.py) с заданной задержкой каждого обращения. Для каждого
+обработчика в каждом режиме кэша считаются запросы в секунду, перцентили
+задержки, прирост памяти на запрос и число обращений к хранилищу и кэшу:
+
+- cold - кэш очищается перед каждым запросом;
+- warm - те же запросы выполняются дважды, замеряется второй проход;
+- mixed - кэш очищается перед запросом с вероятностью --mixed-cold.
+
+Результаты сохраняются в results/ и сравниваются с предыдущим запуском
+с теми же настройками. Сравнивать имеет смысл только запуски на одной машине.
+
+Запуск: python throughput.py [--requests 500] [--concurrency 10] [--es-latency 2] [--redis-latency 0.3]
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT / "fast_api"))
+
+import orjson  # noqa: E402
+from db import cache, storage  # noqa: E402
+from db.local_cache import LocalCache  # noqa: E402
+from fakes import FakeCache, FakePublisher, FakeStorage, make_dataset  # noqa: E402
+from main import app  # noqa: E402
+from services import suggest as suggest_service  # noqa: E402
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+MODES = ["cold", "warm", "mixed"]
+# Прирост памяти считается в отдельном проходе: tracemalloc сильно замедляет запросы
+ALLOC_REQUESTS = 100
+
+# Запрос: метод, путь, строка параметров и тело
+Request = Tuple[str, str, str, Optional[bytes]]
+
+
+class Endpoint(NamedTuple):
+    name: str
+    make: Callable[[random.Random, Dict[str, List[dict]]], Request]
+
+
+def _get(path: str, query: str = "") -> Request:
+    return "GET", path, query, None
+
+
+def _batch(path: str, docs: List[dict], rnd: random.Random) -> Request:
+    return "POST", path, "", orjson.dumps({"ids": [doc["id"] for doc in rnd.sample(docs, 20)]})
+
+
+ENDPOINTS = [
+    Endpoint("film_details", lambda rnd, data: _get(f"/api/v1/film/{rnd.choice(data['movies'])['id']}")),
+    Endpoint("film_list", lambda rnd, data: _get(
+        "/api/v1/film/", f"sort=-imdb_rating&page[size]=50&page[number]={rnd.randint(1, 5)}"
+    )),
+    Endpoint("film_list_genre", lambda rnd, data: _get(
+        "/api/v1/film/", f"filter[genre]={rnd.choice(data['genres'])['id']}&page[size]=50"
+    )),
+    Endpoint("film_search", lambda rnd, data: _get(
+        "/api/v1/film/search", f"query_string={rnd.choice(data['movies'])['title'].split()[0]}&page[size]=50"
+    )),
+    Endpoint("film_batch", lambda rnd, data: _batch("/api/v1/film/batch", data["movies"], rnd)),
+    Endpoint("genre_details", lambda rnd, data: _get(f"/api/v1/genre/{rnd.choice(data['genres'])['id']}")),
+    Endpoint("genre_list", lambda rnd, data: _get("/api/v1/genre/", "page[size]=50")),
+    Endpoint("person_details", lambda rnd, data: _get(f"/api/v1/person/{rnd.choice(data['persons'])['id']}")),
+    Endpoint("person_search", lambda rnd, data: _get(
+        "/api/v1/person/", f"search[name]={rnd.choice(data['persons'])['full_name'].split()[-1]}&page[size]=50"
+    )),
+    Endpoint("suggest", lambda rnd, data: _get(
+        "/api/v1/suggest", f"prefix={rnd.choice(data['movies'])['title'][:rnd.randint(1, 4)]}"
+    )),
+]
+
+
+async def call(request: Request) -> int:
+    """Выполнить запрос к приложению через ASGI, вернуть статус ответа"""
+    method, path, query, body = request
+    headers = [(b"host", b"benchmark")]
+    if body is not None:
+        headers += [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": query.encode(),
+        "headers": headers,
+        "client": ("127.0.0.1", 50000),
+        "server": ("benchmark", 80),
+    }
+    status = 0
+    received = False
+
+    async def receive():
+        nonlocal received
+        if received:
+            # Тело прочитано, дальше приложение ждет только разрыва соединения
+            await asyncio.Event().wait()
+        received = True
+        return {"type": "http.request", "body": body or b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+class Bench:
+    """
+    Замеры одного набора настроек: данные, хранилище и кэш общие для всех обработчиков
+    """
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.data = make_dataset(args.films, args.persons, args.seed)
+        self.storage = FakeStorage(self.data, args.es_latency / 1000)
+        self.remote = FakeCache(args.redis_latency / 1000)
+        self.local = LocalCache(args.local_cache_size, 60)
+        self.cache = cache.LayeredCache(self.remote, self.local, FakePublisher(args.redis_latency / 1000))
+        app.dependency_overrides[cache.get_cache] = lambda: self.cache
+        app.dependency_overrides[storage.get_storage] = lambda: self.storage
+
+    async def prepare(self):
+        suggest_service.service = suggest_service.SuggestService(self.storage)
+        await suggest_service.service.build()
+
+    def clear(self):
+        self.remote.clear()
+        self.local.clear()
+
+    def before(self, mode: str, rnd: random.Random):
+        if mode == "cold" or (mode == "mixed" and rnd.random() < self.args.mixed_cold):
+            self.clear()
+
+    async def run(self, endpoint: Endpoint, mode: str) -> dict:
+        requests = [endpoint.make(random.Random(self.args.seed + index), self.data)
+                    for index in range(self.args.requests)]
+        self.clear()
+        if mode == "warm":
+            await self.drive(requests, mode)
+        es_calls, redis_calls = self.storage.calls, self.remote.calls
+        gc.collect()
+        started = time.perf_counter()
+        latencies, errors = await self.drive(requests, mode)
+        elapsed = time.perf_counter() - started
+        es_calls, redis_calls = self.storage.calls - es_calls, self.remote.calls - redis_calls
+        latencies.sort()
+        return {
+            "endpoint": endpoint.name,
+            "mode": mode,
+            "rps": round(len(requests) / elapsed, 1),
+            "p50_ms": round(_percentile(latencies, 50) * 1000, 3),
+            "p95_ms": round(_percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(_percentile(latencies, 99) * 1000, 3),
+            "alloc_kib": round(await self.allocations(requests[:ALLOC_REQUESTS], mode), 1),
+            "es_calls": round(es_calls / len(requests), 2),
+            "redis_calls": round(redis_calls / len(requests), 2),
+            "errors": errors,
+        }
+
+    async def drive(self, requests: List[Request], mode: str) -> Tuple[List[float], int]:
+        """Выполнить запросы в --concurrency потоков, вернуть задержки и число ошибок"""
+        latencies = []
+        errors = 0
+        pending = iter(requests)
+        rnd = random.Random(self.args.seed)
+
+        async def worker():
+            nonlocal errors
+            for request in pending:
+                self.before(mode, rnd)
+                started = time.perf_counter()
+                status = await call(request)
+                latencies.append(time.perf_counter() - started)
+                errors += status != 200
+
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+        return latencies, errors
+
+    async def allocations(self, requests: List[Request], mode: str) -> float:
+        """Средний прирост памяти процесса за время одного запроса, КиБ"""
+        rnd = random.Random(self.args.seed)
+        total = 0
+        tracemalloc.start()
+        try:
+            for request in requests:
+                self.before(mode, rnd)
+                tracemalloc.reset_peak()
+                current, _ = tracemalloc.get_traced_memory()
+                await call(request)
+                total += tracemalloc.get_traced_memory()[1] - current
+        finally:
+            tracemalloc.stop()
+        return total / len(requests) / 1024
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def _settings(args: argparse.Namespace) -> dict:
+    names = ["requests", "concurrency", "es_latency", "redis_latency", "mixed_cold", "films", "persons",
+             "local_cache_size", "seed"]
+    return {name: getattr(args, name) for name in names}
+
+
+def _revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(args: argparse.Namespace, results: List[dict]) -> Path:
+    RESULTS_DIR.mkdir(exist_ok=True)
+    path = RESULTS_DIR / f"throughput-{datetime.now():%Y%m%d-%H%M%S}.json"
+    path.write_bytes(orjson.dumps({
+        "revision": _revision(),
+        "python": platform.python_version(),
+        "machine": platform.node(),
+        "settings": _settings(args),
+        "results": results,
+    }, option=orjson.OPT_INDENT_2))
+    return path
+
+
+def previous(args: argparse.Namespace, current: Optional[Path]) -> Optional[dict]:
+    """Последний сохраненный запуск с теми же настройками"""
+    if args.compare:
+        return json.loads(Path(args.compare).read_text())
+    settings = _settings(args)
+    for path in sorted(RESULTS_DIR.glob("throughput-*.json"), reverse=True):
+        if path == current:
+            continue
+        run = json.loads(path.read_text())
+        if run["settings"] == settings:
+            return run
+    return None
+
+
+def report(results: List[dict], baseline: Optional[dict], threshold: float) -> bool:
+    """Напечатать таблицу результатов. Возвращает True, если найдено замедление больше threshold процентов"""
+    before = {(item["endpoint"], item["mode"]): item for item in (baseline or {}).get("results", [])}
+    regressed = False
+    print(f"{'endpoint':<16}{'mode':<7}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'KiB/req':>9}{'es/req':>8}{'redis/req':>10}{'errors':>7}  vs previous")
+    for item in results:
+        line = (f"{item['endpoint']:<16}{item['mode']:<7}{item['rps']:>9.1f}{item['p50_ms']:>9.2f}"
+                f"{item['p95_ms']:>9.2f}{item['p99_ms']:>9.2f}{item['alloc_kib']:>9.1f}{item['es_calls']:>8.2f}"
+                f"{item['redis_calls']:>10.2f}{item['errors']:>7}")
+        old = before.get((item["endpoint"], item["mode"]))
+        if old:
+            rps = (item["rps"] / old["rps"] - 1) * 100
+            p95 = (item["p95_ms"] / old["p95_ms"] - 1) * 100 if old["p95_ms"] else 0
+            slower = rps < -threshold or p95 > threshold
+            regressed = regressed or slower
+            line += f"  req/s {rps:+.1f}%, p95 {p95:+.1f}%{'  <-- slower' if slower else ''}"
+        print(line)
+    return regressed
+
+
+async def main(args: argparse.Namespace) -> List[dict]:
+    bench = Bench(args)
+    await bench.prepare()
+    endpoints = [endpoint for endpoint in ENDPOINTS if not args.endpoints or endpoint.name in args.endpoints]
+    results = []
+    for endpoint in endpoints:
+        for mode in args.modes:
+            results.append(await bench.run(endpoint, mode))
+    return results
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=500, help="запросов к обработчику в каждом режиме")
+    parser.add_argument("--concurrency", type=int, default=10, help="одновременных запросов")
+    parser.add_argument("--es-latency", type=float, default=2.0, help="задержка обращения к хранилищу, мс")
+    parser.add_argument("--redis-latency", type=float, default=0.3, help="задержка обращения к кэшу, мс")
+    parser.add_argument("--mixed-cold", type=float, default=0.1, help="доля запросов с очисткой кэша в режиме mixed")
+    parser.add_argument("--films", type=int, default=1000)
+    parser.add_argument("--persons", type=int, default=300)
+    parser.add_argument("--local-cache-size", type=int, default=10000, help="0 - без локального кэша процесса")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("--endpoints", nargs="+", choices=[endpoint.name for endpoint in ENDPOINTS])
+    parser.add_argument("--compare", help="файл результатов для сравнения вместо предыдущего запуска")
+    parser.add_argument("--threshold", type=float, default=10.0, help="допустимое замедление, %%")
+    parser.add_argument("--no-save", action="store_true", help="не сохранять результаты")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    arguments = parse_args()
+    run_results = asyncio.get_event_loop().run_until_complete(main(arguments))
+    saved = None if arguments.no_save else save(arguments, run_results)
+    slower_than_before = report(run_results, previous(arguments, saved), arguments.threshold)
+    if saved:
+        print(f"Результаты сохранены в {saved}")
+    sys.exit(1 if slower_than_before else 0)
@@ -195,10 +195,30 @@ def empty_person_index(request):
 def make_get_request(session):
     """Фикстура для получения результата сформированного запроса"""
 
-    async def inner(query: str, params: dict = None) -> HTTPResponse:
+    async def inner(query: str, params: dict = None, headers: dict = None) -> HTTPResponse:
         params = params or {}
         url = SERVICE_URL + "/api/v1" + query
-        async with session.get(url, params=params) as response:
+        async with session.get(url, params=params, headers=headers) as response:
+            try:
+                res_body = await response.json()
+            except Exception as E:
+                res_body = ""
+            return HTTPResponse(
+                body=res_body,
+                headers=response.headers,
+                status=response.status,
+            )
+
+    return inner
+
+
+@pytest.fixture
+def make_post_request(session):
+    """Фикстура для получения результата POST-запроса с телом в JSON"""
+
+    async def inner(query: str, body: dict) -> HTTPResponse:
+        url = SERVICE_URL + "/api/v1" + query
+        async with session.post(url, json=body) as response:
             try:
                 res_body = await response.json()
             except Exception as E:
@@ -55,3 +55,55 @@ async def test_no_index(flush_redis, make_get_request):
     """Тест запускается без индекса и API должен вернуть ошибку 500"""
     response = await make_get_request("/film/bb74a838-584e-11ec-9885-c13c488d29c0")
     assert response.status == HTTPStatus.INTERNAL_SERVER_ERROR
+
+
+@pytest.mark.asyncio
+async def test_film_batch(some_film, flush_redis, make_post_request):
+    """Проверяем, что пакетный запрос сохраняет порядок и сообщает о ненайденных"""
+    with open("testdata/some_film.json") as docs_json:
+        docs = json.load(docs_json)
+    missing_id = "bb74a838-584e-11ec-9885-c13c488d29c0"
+    ids = [doc["id"] for doc in reversed(docs)] + [missing_id]
+    for _ in range(2):
+        # Второй запрос обслуживается из кэша и должен вернуть то же самое
+        response = await make_post_request("/film/batch", {"ids": ids})
+        assert response.status == HTTPStatus.OK
+        data = response.body
+        assert [film["uuid"] for film in data["items"]] == ids[:-1]
+        assert data["missing"] == [missing_id]
+
+
+@pytest.mark.asyncio
+async def test_film_not_modified(some_film, flush_redis, make_get_request):
+    """Проверяем, что повторный запрос с полученным ETag возвращает 304 без тела"""
+    with open("testdata/some_film.json") as docs_json:
+        doc = json.load(docs_json)[0]
+    response = await make_get_request(f"/film/{doc['id']}")
+    assert response.status == HTTPStatus.OK
+    etag = response.headers["ETag"]
+    assert "max-age" in response.headers["Cache-Control"]
+    response = await make_get_request(
+        f"/film/{doc['id']}", headers={"If-None-Match": etag}
+    )
+    assert response.status == HTTPStatus.NOT_MODIFIED
+    assert response.headers["ETag"] == etag
+
+
+@pytest.mark.asyncio
+async def test_film_cursor(some_film, flush_redis, make_get_request):
+    """Проверяем, что обход по курсору дает те же фильмы, что и по номерам страниц"""
+    with open("testdata/some_film.json") as docs_json:
+        docs = json.load(docs_json)
+    by_cursor = []
+    params = {"page[size]": 1}
+    while True:
+        response = await make_get_request("/film/", params)
+        if response.status == HTTPStatus.NOT_FOUND:
+            break
+        by_cursor += [film["uuid"] for film in response.body]
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+        params = {"page[size]": 1, "page[cursor]": cursor}
+    response = await make_get_request("/film/", {"page[size]": len(docs)})
+    assert by_cursor == [film["uuid"] for film in response.body]
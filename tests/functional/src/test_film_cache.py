@@ -35,9 +35,34 @@ async def test_some_film_cache(some_film, make_get_request):
         maxsize=20,
         password=os.getenv("REDIS_PASSWORD", "password"),
     )
-    cached = await redis.get(f"{doc_id}")
+    # Ключ фильма состоит из пространства имен, версии формата и идентификатора.
+    # Версия меняется вместе с моделями, поэтому ключ берем из набора ключей,
+    # которые API сбрасывает при изменении фильма
+    keys = await redis.zrange(f"tags:film:{doc_id}", encoding="utf-8")
+    film_keys = [key for key in keys if key.startswith("film:v") and key.endswith(f":{doc_id}")]
+    assert len(film_keys) == 1
+    cached = await redis.get(film_keys[0])
     assert cached is not None
     # AIORedis возвращает строку bytes с объектом в JSON формате. Проверяем,
     # что в ней есть идентификатор и название фидьма
     assert f'"uuid":"{doc["id"]}"' in str(cached)
     assert f'"title":"{doc["title"]}"' in str(cached)
+
+
+@pytest.mark.asyncio
+async def test_empty_search_cache(empty_film_index, flush_redis, make_get_request):
+    """Проверяем, что пустой результат поиска кэшируется компактной меткой"""
+    response = await make_get_request("/film/search", {"query_string": "nothing"})
+    assert response.status == HTTPStatus.NOT_FOUND
+
+    redis = await aioredis.create_redis_pool(
+        (os.getenv("REDIS_HOST", "redis"), os.getenv("REDIS_PORT", 6379)),
+        maxsize=20,
+        password=os.getenv("REDIS_PASSWORD", "password"),
+    )
+    keys = [key for key in await redis.keys("*") if not key.startswith(b"tags:")]
+    values = [await redis.get(key) for key in keys]
+    assert any(value and value.startswith(b"!") for value in values)
+    # Повторный запрос отдается из кэша с тем же ответом
+    response = await make_get_request("/film/search", {"query_string": "nothing"})
+    assert response.status == HTTPStatus.NOT_FOUND
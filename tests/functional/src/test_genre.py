@@ -39,7 +39,7 @@ async def test_empty_index(empty_genre_index):  # pylint: disable=unused-argumen
 
 
 @pytest.mark.asyncio
-async def test_no_index():
+async def test_no_index(flush_redis):  # pylint: disable=unused-argument
     """Тест запускается без индекса и API должен вернуть ошибку 500"""
     async with aiohttp.ClientSession() as session:
         async with session.get(f"http://{API_HOST}/api/v1/genre") as ans:
@@ -2,15 +2,21 @@
 Тесты поиска фильмов по подстроке наименования фильма
 """
 
+import asyncio
 import json
 import os
 from http import HTTPStatus
 
 import aiohttp
+import aioredis
 import pytest
 
 # Строка с именем хоста и портом
 API_HOST = os.getenv("API_HOST", "localhost:8000")
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = os.getenv("REDIS_PORT", "6379")
+REDIS_PASSWORD = os.getenv("REDIS_PASSWORD", "password")
+ETL_CHANNEL = os.getenv("ETL_CHANNEL", "cache:etl")
 
 
 @pytest.mark.asyncio
@@ -51,3 +57,21 @@ async def test_no_index(make_get_request, flush_redis):
     # async with aiohttp.ClientSession() as session:
     #     async with session.get(f"http://{API_HOST}/api/v1/film/search=") as ans:
     #         assert ans.status == HTTPStatus.INTERNAL_SERVER_ERROR
+
+
+@pytest.mark.asyncio
+async def test_suggest_film(some_film, make_get_request):
+    """Проверяем, что фильм попадает в подсказки по началу слова после уведомления ETL"""
+    with open("testdata/some_film.json") as docs_json:
+        docs = json.load(docs_json)
+        doc = docs[0]
+    redis = await aioredis.create_redis_pool((REDIS_HOST, REDIS_PORT), password=REDIS_PASSWORD)
+    await redis.publish_json(ETL_CHANNEL, {"index": "movies", "ids": [doc["id"]]})
+    redis.close()
+    await redis.wait_closed()
+    # Индекс подсказок обновляется в фоне
+    await asyncio.sleep(0.5)
+    response = await make_get_request("/suggest", {"prefix": doc["title"].split()[-1][:3]})
+    assert response.status == HTTPStatus.OK
+    assert response.body["films"][0]["uuid"] == doc["id"]
+    assert response.body["films"][0]["title"] == doc["title"]
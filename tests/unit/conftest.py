@@ -0,0 +1,36 @@
+"""
+Модульные тесты API без ElasticSearch и Redis: хранилище и кэш
+в памяти процесса из tests/benchmark/fakes.py
+"""
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT / "fast_api"))
+sys.path.insert(0, str(ROOT / "tests" / "benchmark"))
+
+from db.cache import LayeredCache  # noqa: E402
+from db.local_cache import LocalCache  # noqa: E402
+from fakes import FakeCache, FakePublisher, FakeStorage, make_dataset  # noqa: E402
+
+
+@pytest.fixture()
+def dataset():
+    return make_dataset(films=50, persons=30, seed=1)
+
+
+@pytest.fixture()
+def remote_cache():
+    return FakeCache()
+
+
+@pytest.fixture()
+def cache(remote_cache):
+    return LayeredCache(remote_cache, LocalCache(1000, 60), FakePublisher())
+
+
+@pytest.fixture()
+def storage(dataset):
+    return FakeStorage(dataset)
@@ -0,0 +1,167 @@
+"""
+Тесты загрузки значений при промахе кэша: общая загрузка одного ключа
+и теневые копии при недоступном хранилище
+"""
+import asyncio
+import time
+
+from api.v1 import film
+from core import deadline
+from core.breaker import CircuitOpenError
+from db.entry import pack_entry, pack_negative
+from elasticsearch import ConnectionError as ElasticConnectionError
+from services.abstract import _Fallback, _fallback
+from services.film import FilmService
+from utils.response import CachedBody
+
+INNER_KEY = "film:v0:shared"
+
+
+def text(data: bytes) -> str:
+    return data.decode()
+
+
+def test_single_flight_waiters_see_shadow_fallback(cache, remote_cache, storage):
+    """Запрос, дождавшийся чужой загрузки из теневой копии, не кэширует свой результат как свежий"""
+    service = FilmService(cache, storage)
+
+    async def storage_down():
+        await asyncio.sleep(0.05)
+        raise ElasticConnectionError("N/A", "unavailable", None)
+
+    async def inner():
+        return await service._get_or_load(INNER_KEY, storage_down, text, str)
+
+    async def outer(key):
+        return await service._get_or_load(key, inner, text, str)
+
+    async def run():
+        await cache.set_shadows({INNER_KEY: pack_entry(b"old", 0, 0)}, 60)
+        return await asyncio.gather(outer("film:v0:outer-a"), outer("film:v0:outer-b"))
+
+    assert asyncio.run(run()) == ["old", "old"]
+    assert asyncio.run(remote_cache.get("film:v0:outer-a")) is None
+    assert asyncio.run(remote_cache.get("film:v0:outer-b")) is None
+
+
+def test_single_flight_keeps_waiter_deadlines_apart(cache, storage):
+    """Короткий срок одного запроса не обрывает общую загрузку для запроса с долгим сроком"""
+    service = FilmService(cache, storage)
+    loads = 0
+
+    async def slow_load():
+        nonlocal loads
+        loads += 1
+        await asyncio.sleep(0.1)
+        return "fresh"
+
+    async def request(timeout):
+        deadline.renew(timeout)
+        return await service._get_or_load("film:v0:slow", slow_load, text, str)
+
+    async def run():
+        return await asyncio.gather(
+            asyncio.ensure_future(request(0.01)), asyncio.ensure_future(request(5)), return_exceptions=True
+        )
+
+    short, long = asyncio.run(run())
+    assert isinstance(short, deadline.DeadlineExceeded)
+    assert long == "fresh"
+    assert loads == 1
+
+
+def test_load_survives_redis_outage_after_storage_answered(monkeypatch, cache, remote_cache, storage):
+    """Блокировка и запись в кэш необязательны: без Redis запрос получает загруженное значение"""
+    service = FilmService(cache, storage)
+
+    async def redis_down(*args, **kwargs):
+        raise CircuitOpenError("redis is unavailable")
+
+    async def load():
+        return "fresh"
+
+    monkeypatch.setattr(remote_cache, "write", redis_down)
+    monkeypatch.setattr(remote_cache, "acquire_lock", redis_down)
+    assert asyncio.run(service._get_or_load("film:v0:down", load, text, str)) == "fresh"
+
+    monkeypatch.undo()
+    monkeypatch.setattr(remote_cache, "release_lock", redis_down)
+    assert asyncio.run(service._get_or_load("film:v0:down", load, text, str)) == "fresh"
+
+
+def test_lease_waiter_accepts_negative_entry(cache, remote_cache, storage):
+    """Ожидающий блокировку запрос не идет в хранилище, если ее владелец записал "не найдено" """
+    service = FilmService(cache, storage)
+    loads = 0
+
+    async def load():
+        nonlocal loads
+        loads += 1
+        return "fresh"
+
+    async def holder():
+        await asyncio.sleep(0.1)
+        await remote_cache.set("film:v0:missing", pack_negative(time.time() + 30), 30)
+
+    async def run():
+        await remote_cache.acquire_lock("lease:film:v0:missing", 3000)
+        started = time.monotonic()
+        value, _ = await asyncio.gather(service._get_or_load("film:v0:missing", load, text, str), holder())
+        return value, time.monotonic() - started
+
+    value, elapsed = asyncio.run(run())
+    assert value == []
+    assert loads == 0
+    assert elapsed < service.LEASE_WAIT_IN_SECONDS
+
+
+def test_background_refresh_keeps_request_fallback_apart(cache, storage):
+    """Теневая копия в фоновом обновлении не отмечает ответ запроса, который его запустил"""
+    service = FilmService(cache, storage)
+
+    async def storage_down():
+        raise ElasticConnectionError("N/A", "unavailable", None)
+
+    async def run():
+        await cache.set_shadows({INNER_KEY: pack_entry(b"old", 0, 0)}, 60)
+        fallback = _Fallback(None)
+        _fallback.set(fallback)
+        service._refresh_in_background(INNER_KEY, storage_down, text, str)
+        await asyncio.gather(*service._refreshing)
+        return fallback.used
+
+    assert asyncio.run(run()) is False
+
+
+def test_shadows_kept_for_data_not_responses(cache, remote_cache, storage, dataset):
+    """Теневая копия есть у сущности, но не у готового ответа, собранного из нее"""
+    service = FilmService(cache, storage)
+    film_id = dataset["movies"][0]["id"]
+
+    async def run():
+        await film.film_details(film_id, service)
+        response_key = await service._get_list_key("film_details", film_id)
+        return await remote_cache.get_shadows([service._get_entity_key(film_id), response_key])
+
+    entity_shadow, response_shadow = asyncio.run(run())
+    assert entity_shadow is not None
+    assert response_shadow is None
+
+
+def test_stale_response_is_not_cached_downstream(cache, remote_cache, storage, dataset):
+    """Устаревший ответ отдается с max-age=0, свежий - не дольше, чем он остается свежим"""
+    service = FilmService(cache, storage)
+    fresh_id, stale_id = dataset["movies"][0]["id"], dataset["movies"][1]["id"]
+
+    async def run():
+        stale_key = await service._get_list_key("film_details", stale_id)
+        body = CachedBody.from_body(b'{"uuid": "stale"}')
+        await remote_cache.set(stale_key, pack_entry(body.dumps(), time.time() - 1, 0), 60)
+        fresh = await film.film_details(fresh_id, service)
+        stale = await film.film_details(stale_id, service)
+        await asyncio.gather(*service._refreshing)
+        return fresh.headers["cache-control"], stale.headers["cache-control"]
+
+    fresh, stale = asyncio.run(run())
+    assert 0 < int(fresh.split("=")[1]) <= service.CACHE_EXPIRE_IN_SECONDS
+    assert stale == "max-age=0"
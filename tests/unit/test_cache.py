@@ -0,0 +1,95 @@
+"""
+Тесты подписок кэша на каналы Redis
+"""
+import asyncio
+
+import orjson
+from core import config
+from db.cache import CacheWrites, _consume_etl, listen_etl, listen_invalidation
+from db.local_cache import LocalCache
+
+
+class FakeChannel:
+    """Канал Redis с заранее опубликованными сообщениями"""
+
+    def __init__(self, messages):
+        self.messages = list(messages)
+
+    async def wait_message(self):
+        return bool(self.messages)
+
+    async def get(self, encoding=None):
+        return self.messages.pop(0).decode()
+
+    async def get_json(self):
+        return orjson.loads(self.messages.pop(0))
+
+
+class FakeSubscriber:
+    """
+    Подписки на канал по очереди: каждая отдает свои сообщения и обрывается,
+    None - подписаться не удалось
+    """
+
+    def __init__(self, *sessions):
+        self.sessions = list(sessions)
+        self.done = asyncio.Event()
+
+    async def subscribe(self, name):
+        if not self.sessions:
+            self.done.set()
+            await asyncio.sleep(10)
+        messages = self.sessions.pop(0)
+        if messages is None:
+            raise ConnectionRefusedError()
+        return [FakeChannel(messages)]
+
+
+async def until_done(subscriber, listen):
+    task = asyncio.ensure_future(listen)
+    await asyncio.wait_for(subscriber.done.wait(), 1)
+    task.cancel()
+
+
+def test_listen_etl_skips_bad_messages(remote_cache):
+    """Некорректные уведомления пропускаются, следующие за ними обрабатываются"""
+    received = []
+
+    async def listener(message):
+        received.append(message)
+
+    async def run():
+        writes = CacheWrites()
+        writes.set("film:v0:1", b"cached", 60)
+        writes.tag("film:v0:1", ["film:1"], 60)
+        await remote_cache.write(writes)
+        messages = [b"not json", b"[]", b'{"ids": ["1"]}', b'{"index": "movies", "ids": ["1"]}']
+        await _consume_etl(FakeChannel(messages), remote_cache, [listener])
+        return await remote_cache.get("film:v0:1")
+
+    assert asyncio.run(run()) is None
+    assert received == [{"index": "movies", "ids": ["1"]}]
+
+
+def test_listeners_resubscribe_and_forget_lost_messages(monkeypatch, remote_cache):
+    """После разрыва подписка повторяется, а пропущенные сообщения восполняются сбросом"""
+    monkeypatch.setattr(config, "RESUBSCRIBE_MIN_DELAY_IN_SECONDS", 0.001)
+    local_cache = LocalCache(100, 60)
+    received = []
+
+    async def listener(message):
+        received.append(message)
+
+    async def run():
+        local_cache.set("film:v0:1", "cached", 60)
+        local_cache.set("film:v0:2", "cached", 60)
+        invalidation = FakeSubscriber([b"film:v0:1"], None, [])
+        await until_done(invalidation, listen_invalidation(invalidation, local_cache))
+        assert local_cache.get("film:v0:1") is None
+        etl = FakeSubscriber([], None, [b'{"index": "persons", "ids": ["1"]}'])
+        await until_done(etl, listen_etl(etl, remote_cache, [listener]))
+
+    asyncio.run(run())
+    assert len(local_cache) == 0
+    reindexed = [{"index": index, "reindex": True} for index in config.INDEX_NAMESPACES]
+    assert received == reindexed + [{"index": "persons", "ids": ["1"]}]
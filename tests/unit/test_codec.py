@@ -0,0 +1,40 @@
+"""
+Тесты сжатия значений кэша
+"""
+import os
+
+from db import codec
+from db.entry import pack_entry, pack_negative
+
+ZLIB = codec.ZlibCodec()
+
+
+def test_round_trip():
+    data = pack_entry(b'{"title": "Star Wars"}' * 50, 0, 0)
+    packed = codec.compress(data, ZLIB, 64)
+
+    assert packed.startswith(ZLIB.marker)
+    assert len(packed) < len(data)
+    assert codec.decompress(packed) == data
+
+
+def test_small_values_are_stored_as_is():
+    data = pack_negative(0)
+    assert codec.compress(data, ZLIB, 64) == data
+
+
+def test_incompressible_values_are_stored_as_is():
+    data = os.urandom(512)
+    assert codec.compress(data, ZLIB, 64) == data
+
+
+def test_uncompressed_values_pass_through():
+    """Записи без маркера алгоритма (несжатые и записанные до сжатия) читаются как есть"""
+    for data in (pack_entry(b"value", 0, 0), pack_negative(0), b'{"uuid": "1"}', b"", None):
+        assert codec.decompress(data) == data
+
+
+def test_every_marker_differs_from_entry_marks():
+    """Маркер алгоритма не должен совпадать с первым байтом несжатых записей"""
+    first_bytes = {pack_entry(b"", 0, 0)[:1], pack_negative(0)[:1], b"{", b"["}
+    assert not first_bytes & set(codec.CODECS)
@@ -0,0 +1,54 @@
+"""
+Тесты формата записей кэша: мягкое истечение и вероятностное досрочное обновление
+"""
+import time
+
+from db.entry import CacheEntry, pack_entry, pack_negative, unpack_entry
+
+
+def test_entry_round_trip():
+    soft_expire_at = time.time() + 60
+    entry = unpack_entry(pack_entry('{"uuid": "1"}', soft_expire_at, 0.25), bytes.decode)
+
+    assert entry.value == '{"uuid": "1"}'
+    assert abs(entry.soft_expire_at - soft_expire_at) < 0.001
+    assert entry.delta == 0.25
+    assert not entry.is_stale()
+
+
+def test_value_may_contain_entry_mark():
+    """Заголовок отделяется по первой метке после начала, тильды в значении не мешают"""
+    entry = unpack_entry(pack_entry(b"~a~b~", time.time() + 60, 0.1), bytes)
+    assert entry.value == b"~a~b~"
+
+
+def test_negative_entry():
+    entry = unpack_entry(pack_negative(time.time() + 30), bytes)
+    assert entry.value == []
+    assert not entry.is_stale()
+    assert unpack_entry(pack_negative(time.time() - 1), bytes).is_stale()
+
+
+def test_entry_without_header_is_stale():
+    """Значения, записанные до появления заголовка, читаются и сразу обновляются"""
+    entry = unpack_entry(b'{"uuid": "1"}', bytes)
+    assert entry.value == b'{"uuid": "1"}'
+    assert entry.is_stale()
+
+
+def test_xfetch_never_refreshes_instant_values_early():
+    entry = CacheEntry("value", time.time() + 60, 0.0)
+    assert not any(entry.should_refresh() for _ in range(1000))
+
+
+def test_xfetch_refreshes_slow_values_near_expiry():
+    """Чем дольше вычисляется значение и чем ближе истечение, тем чаще оно обновляется заранее"""
+    near = CacheEntry("value", time.time() + 0.5, 1.0)
+    far = CacheEntry("value", time.time() + 60, 1.0)
+    near_refreshes = sum(near.should_refresh() for _ in range(1000))
+    far_refreshes = sum(far.should_refresh() for _ in range(1000))
+
+    assert near_refreshes > 300
+    assert far_refreshes < near_refreshes
+    assert not any(CacheEntry("value", time.time() + 60, 1.0).should_refresh(beta=0) for _ in range(1000))
+    assert CacheEntry("value", time.time() - 1, 0.0).should_refresh()
@@ -0,0 +1,81 @@
+"""
+Тесты индекса префиксов для подсказок
+"""
+import random
+
+from db.prefix_index import PrefixIndex
+
+FILMS = [
+    ("1", "Star Wars", 8.6),
+    ("2", "Star Trek", 7.9),
+    ("3", "Wars of the Roses", 6.1),
+    ("4", "Ёлки", 5.5),
+    ("5", "The Lone Star", 7.0),
+]
+
+
+def make_index(**kwargs) -> PrefixIndex:
+    index = PrefixIndex(max_words=8, **kwargs)
+    index.replace(FILMS)
+    return index
+
+
+def test_find_by_start_of_any_word():
+    index = make_index()
+    assert index.find("star", 10) == ["1", "2", "5"]
+    assert index.find("wars", 10) == ["1", "3"]
+    assert index.find("ar", 10) == []
+
+
+def test_find_normalizes_prefix():
+    index = make_index()
+    assert index.find("  STAR   w", 10) == ["1"]
+    assert index.find("елк", 10) == ["4"]
+    assert index.find("!!", 10) == []
+
+
+def test_find_respects_limit_and_rank():
+    index = make_index()
+    assert index.find("star", 2) == ["1", "2"]
+
+
+def test_add_replaces_text_and_rank():
+    index = make_index()
+    index.add("2", "Space Trek", 9.5)
+
+    assert index.find("star", 10) == ["1", "5"]
+    assert index.find("s", 10)[0] == "2"
+    assert index.get("2") == ("Space Trek", 9.5)
+    assert len(index) == len(FILMS)
+
+
+def test_remove():
+    index = make_index()
+    index.remove("1")
+    index.remove("missing")
+
+    assert index.find("star", 10) == ["2", "5"]
+    assert index.find("wars", 10) == ["3"]
+    assert index.get("1") is None
+    assert len(index) == len(FILMS) - 1
+
+
+def test_max_words_limits_keys():
+    index = PrefixIndex(max_words=2)
+    index.add("1", "one two three", 1.0)
+    assert index.find("two", 10) == ["1"]
+    assert index.find("three", 10) == []
+
+
+def test_wide_prefix_scan_matches_narrow_search():
+    """Перебор по рангу для короткого префикса дает тот же результат, что и просмотр диапазона"""
+    rnd = random.Random(1)
+    words = ["star", "stone", "storm", "sun", "moon", "sea"]
+    docs = [(str(n), " ".join(rnd.choices(words, k=3)), float(rnd.randint(1, 5))) for n in range(300)]
+    narrow, wide = PrefixIndex(8, scan_limit=10 ** 6), PrefixIndex(8, scan_limit=5)
+    narrow.replace(docs)
+    for doc in docs:
+        wide.add(*doc)
+
+    for prefix in ("s", "st", "sto", "m", "sea"):
+        assert wide.find(prefix, 7) == narrow.find(prefix, 7)
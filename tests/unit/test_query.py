@@ -0,0 +1,59 @@
+"""
+Тесты шаблонов запросов поиска: тело по шаблону совпадает с телом,
+собранным словарем, при любой форме запроса и любых значениях
+"""
+import orjson
+import pytest
+from db.query import DocValue, SearchQuery, compile_template
+
+
+def film_search(query: str) -> SearchQuery:
+    return SearchQuery().match("title", query).sort("_score", "desc").sort("id").page(10, 3)
+
+
+QUERIES = [
+    lambda: SearchQuery(),
+    lambda: SearchQuery().page(50, 1),
+    lambda: film_search("star wars"),
+    lambda: SearchQuery().term("genre", "Sci-Fi").sort("imdb_rating", "desc").after(20, [8.5, "id-1"]),
+    lambda: SearchQuery().nested_term("genres", "genres.id", "g-1").match("title", "x").page(5, 2),
+    lambda: SearchQuery().sort("id").after(10, ["id-9"]).pit("pit-id", "1m"),
+    lambda: SearchQuery().sort("id").window(100, 0).docvalues([
+        DocValue("id", "id"), DocValue("imdb_rating", "imdb_rating", "0.0", float),
+    ]),
+]
+
+
+@pytest.mark.parametrize("make_query", QUERIES)
+def test_template_matches_build(make_query):
+    query = make_query()
+    assert orjson.loads(query.render()) == query.build()
+
+
+@pytest.mark.parametrize("value", [
+    'say "hello"', "back\\slash", "__param_0__", '"__param_1__"', "юникод", "",
+])
+def test_values_cannot_break_the_template(value):
+    """Значения сериализуются при подстановке: кавычки и имена мест параметров остаются значениями"""
+    query = film_search(value)
+    assert orjson.loads(query.render()) == query.build()
+    assert query.build()["query"]["bool"]["must"] == [{"match": {"title": value}}]
+
+
+def test_one_template_per_shape():
+    compile_template.cache_clear()
+    for value in ("star", "wars", "trek"):
+        film_search(value).render()
+    SearchQuery().term("genre", "Drama").render()
+
+    assert compile_template.cache_info().misses == 2
+    assert compile_template.cache_info().hits == 2
+
+
+def test_template_splits_at_every_param():
+    query = SearchQuery().sort("id").after(10, ["id-9"]).pit("pit-id", "1m")
+    template = compile_template(query.shape())
+
+    assert len(template.parts) == len(template.indexes) + 1
+    assert sorted(template.indexes) == list(range(len(query.params())))
+    assert not any(b"__param_" in part for part in template.parts)
@@ -0,0 +1,55 @@
+"""
+Тесты обращений к ElasticSearch: зависший сервис размыкает предохранитель,
+а истекший срок самого запроса сбоем не считается
+"""
+import asyncio
+
+import pytest
+from core import config, deadline
+from core.breaker import OPEN, CircuitOpenError
+from db import storage
+from db.storage import ElasticStorage
+
+
+class HangingElastic:
+    """Клиент ElasticSearch, который не отвечает"""
+
+    async def get(self, **kwargs):
+        await asyncio.sleep(10)
+
+
+@pytest.fixture()
+def breaker():
+    yield storage.breaker
+    storage.breaker._success()
+
+
+def test_hanging_elastic_opens_breaker(monkeypatch, breaker):
+    monkeypatch.setattr(config, "ELASTIC_CALL_TIMEOUT_IN_SECONDS", 0.01)
+    elastic = ElasticStorage(HangingElastic())
+
+    async def get():
+        deadline.renew(5)
+        return await elastic.get("movies", "1", ["id"])
+
+    for _ in range(config.BREAKER_FAILURE_THRESHOLD):
+        with pytest.raises(asyncio.TimeoutError) as error:
+            asyncio.run(get())
+        assert storage.is_unavailable(error.value)
+
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(get())
+
+
+def test_request_deadline_is_not_a_failure(monkeypatch, breaker):
+    monkeypatch.setattr(config, "ELASTIC_CALL_TIMEOUT_IN_SECONDS", 5)
+    elastic = ElasticStorage(HangingElastic())
+
+    async def get():
+        deadline.renew(0.01)
+        return await elastic.get("movies", "1", ["id"])
+
+    with pytest.raises(deadline.DeadlineExceeded):
+        asyncio.run(get())
+    assert breaker.failures == 0
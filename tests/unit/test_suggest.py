@@ -0,0 +1,24 @@
+"""
+Тесты построения индекса подсказок несколькими процессами API
+"""
+import asyncio
+
+from fakes import FakeStorage
+from services.suggest import SuggestService
+
+
+def test_workers_build_suggest_index_once(remote_cache, dataset):
+    """ElasticSearch читает только первый процесс, второй строит индекс по его снимку"""
+    first = SuggestService(FakeStorage(dataset, latency=0.01), remote_cache)
+    second = SuggestService(FakeStorage(dataset, latency=0.01), remote_cache)
+
+    async def build_both():
+        await asyncio.gather(first.build(), second.build())
+
+    asyncio.run(build_both())
+
+    assert first.storage.calls > 0
+    assert second.storage.calls == 0
+    assert sorted(second.films.items()) == sorted(first.films.items())
+    assert sorted(second.persons.items()) == sorted(first.persons.items())
+    assert second.suggest("a", 5) == first.suggest("a", 5)
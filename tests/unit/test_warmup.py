@@ -0,0 +1,73 @@
+"""
+Тесты прогрева кэша: прогрев вызывает обработчики API напрямую,
+поэтому ловит изменения их параметров
+"""
+import asyncio
+
+import pytest
+from api.v1 import film
+from core import config
+from db.cache import popularity_key
+from fastapi import HTTPException
+from services import popularity
+from services.film import FilmService
+from services.genre import GenreService
+from services.person import PersonService
+from warmup import Warmup
+
+
+def test_warmup_runs_every_handler(cache, storage, dataset):
+    warmup = Warmup(
+        FilmService(cache, storage), GenreService(cache, storage), PersonService(cache, storage),
+        timeout=5, concurrency=4,
+    )
+
+    asyncio.run(warmup.run())
+
+    assert warmup.failed == 0
+    # Страницы списка фильмов, страницы списка жанров и каждый жанр
+    genre_pages = -(-len(dataset["genres"]) // config.WARMUP_PAGE_SIZE)
+    assert warmup.warmed == config.WARMUP_FILM_PAGES + genre_pages + len(dataset["genres"])
+
+
+@pytest.fixture()
+def hits():
+    popularity.hits.clear()
+    yield popularity.hits
+    popularity.hits.clear()
+
+
+def test_warmup_does_not_feed_popularity(cache, storage, dataset, hits):
+    """Прогрев самых популярных сущностей не добавляет им обращений"""
+    film_id = dataset["movies"][0]["id"]
+    warmup = Warmup(
+        FilmService(cache, storage), GenreService(cache, storage), PersonService(cache, storage),
+        timeout=5, concurrency=4,
+    )
+
+    async def run():
+        await cache.incr_scores(popularity_key("film"), {film_id: 1}, config.POPULARITY_MAX_SIZE)
+        await warmup.run()
+
+    asyncio.run(run())
+    assert warmup.failed == 0
+    assert not any(hits.values())
+
+
+def test_missing_entities_are_not_recorded(cache, storage, dataset, hits):
+    """Обращения к несуществующим сущностям (ответ 404) в рейтинг не попадают"""
+    film_service = FilmService(cache, storage)
+    film_id = dataset["movies"][0]["id"]
+    missing_id = "00000000-0000-0000-0000-000000000000"
+
+    async def render_none():
+        return None
+
+    async def run():
+        await film.film_details(film_id, film_service)
+        await film_service.get_response("film_details", (missing_id,), render_none, entity_id=missing_id)
+        with pytest.raises(HTTPException):
+            await film.film_details(missing_id, film_service)
+
+    asyncio.run(run())
+    assert dict(hits["film"]) == {film_id: 1}